@@ -1,49 +1,338 @@
 import asyncio
+import hashlib
 import json
+import logging
 import os
-from typing import Dict, Any, final
+import re
+import sqlite3
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Any, Optional, final
+import numpy as np
+import json_utils
 from langchain.prompts import PromptTemplate
 from response_format import Response
 import dotenv
-from embedding.faiss_embedding import EmbeddingServiceWrapper, build_hnsw_from_texts, semantic_search
+from embedding.faiss_embedding import get_shared_embedder
 from agents.specific_product_agent import SpecificProductAgent
 from agents.feature_product_agents import FeatureProductAgent
 from system_prompts.product_features_system_prompts import system_msg_extracting_product_features, samples_extracting_product_features
-from features_list import features_dict
+from features_list import features_dict, find_feature_key, persian_to_eng_features
 from system_prompts.comparison_system_prompt import *
 from system_prompts.comparison_feature_system_prompt import *
 from system_prompts.comparison_shop_system_prompt import *
 from system_prompts.comparison_final_decide_system_prompt import comparison_final_decide_system_prompt, compare_final_decide_samples
 from system_prompts.comparison_find_feature_general import find_main_feature_of_general_comapre_system_prompt, find_main_feature_of_general_comapre_samples
+from cache_utils import LRUCache
+from db.create_db import product_stats_select
+from embedding.persistent_cache import embed_cached
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+# ---- Static prompt prefixes ----
+# Built once at import so the leading system message is byte-identical across
+# calls and the provider's automatic prompt caching can reuse it; only the
+# user turn carries the query.
+def _build_examples_str(samples, output_of):
+    examples_str = ""
+    for sample in samples:
+        examples_str += f"ورودی: {sample['input']}\n"
+        examples_str += f"خروجی: {json.dumps(output_of(sample), ensure_ascii=False)}\n\n"
+    return examples_str
+
+
+_ROUTE_PREFIX = (
+    "تو یک مسیریاب هوشمند برای تشخیص نوع مقایسه محصولات هستی.\n\n"
+    f"{route_task_comparison_system_prompt}\n\nمثال‌ها:\n"
+    + _build_examples_str(route_task_comparison_samples, lambda sample: {k: v for k, v in sample.items() if k != 'input'})
+)
+_CMP_FEATURE_PREFIX = (
+    "تو یک استخراج‌کننده ویژگی مقایسه هستی.\n\n"
+    f"{comparison_feature_system_prompt}\n\nمثال‌ها:\n"
+    + _build_examples_str(comparison_feature_samples, lambda sample: {'compare_feature': sample['compare_feature']})
+)
+_SHOP_PREFIX = (
+    "تو یک مسیریاب هوشمند برای تشخیص نوع مقایسه فروشگاهی هستی.\n\n"
+    f"{comparison_shop_system_prompt}\n\nمثال‌ها:\n"
+    + _build_examples_str(comparison_shop_samples, lambda sample: {'shop_task': sample['comparison_type']})
+)
+_FINAL_DECIDE_PREFIX = comparison_final_decide_system_prompt + "\n\n" + "\n".join(
+    f"ورودی: {sample['final_explanation']}\nخروجی: {json.dumps(sample, ensure_ascii=False, separators=(',', ':'))}"
+    for sample in compare_final_decide_samples
+)
+_FIND_FEATURE_PREFIX = find_main_feature_of_general_comapre_system_prompt + "\n\n" + "\n".join(
+    f"ورودی: {sample['input']}\nخروجی: {json.dumps(sample, ensure_ascii=False, separators=(',', ':'))}"
+    for sample in find_main_feature_of_general_comapre_samples
+)
+
+
+# Server-side enforced shape of the routing answer
+_ROUTE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "comparison_route",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "comparison_type": {
+                    "type": "string",
+                    "enum": ["feature_level", "shop_level", "warranty_level", "city_level", "general"]
+                },
+                "product_name_1": {"type": "string"},
+                "product_random_key_1": {"type": ["string", "null"]},
+                "product_name_2": {"type": "string"},
+                "product_random_key_2": {"type": ["string", "null"]}
+            },
+            "required": ["comparison_type", "product_name_1", "product_random_key_1",
+                         "product_name_2", "product_random_key_2"],
+            "additionalProperties": False
+        }
+    }
+}
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+# Closed-set classification over four labels: the schema pins the output to
+# the enum, so the cheapest chat model is enough and the answer is a few tokens.
+_SHOP_TASK_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "shop_task",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "shop_task": {
+                    "type": "string",
+                    "enum": ["compare_count_of_shops", "compare_mean_price", "compare_least_price", "compare_most_price"]
+                }
+            },
+            "required": ["shop_task"],
+            "additionalProperties": False
+        }
+    }
+}
+
+
+_EMPTY_PRODUCT_STATS = {
+    "shop_count": 0, "mean_price": 0, "min_price": 0, "max_price": 0, "warranty_count": 0, "city_count": 0
+}
+# Only the columns _get_product_stats reads, not SELECT *
+_PRODUCT_STATS_COLUMNS = ", ".join(("random_key", *_EMPTY_PRODUCT_STATS))
+
+# Shop-level comparison task -> (product stats column, Persian label for the final prompt)
+_SHOP_STAT_LABELS = {
+    "compare_count_of_shops": ("shop_count", "تعداد فروشگاه‌های محصول"),
+    "compare_mean_price": ("mean_price", "میانگین قیمت محصول"),
+    "compare_least_price": ("min_price", "کمترین قیمت محصول"),
+    "compare_most_price": ("max_price", "بیشترین قیمت محصول"),
+}
+
+_PRODUCTS_NOT_FOUND_MESSAGE = "متأسفم، نتوانستم محصولات را برای مقایسه پیدا کنم."
+_FINAL_ANSWER_ERROR_MESSAGE = "متأسفم، نتوانستم پاسخ مناسبی برای مقایسه این محصولات ارائه دهم."
+
+# Offline callers (evaluation, enrichment) can send final decisions through the
+# Batch API: cheaper, but answers arrive within the completion window.
+_BATCH_POLL_SECONDS = float(os.getenv("COMPARISON_BATCH_POLL_SECONDS", "30"))
+_BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _chat_model() -> str:
+    return os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini"
+
+
+def _parse_final_decision(content: str):
+    """(final_explanation, winner_random_key) from the final-decision JSON; a tie means no winner"""
+    response_json = json_utils.loads(content or "{}")
+    if response_json["winner_random_key"] == "مساوی":
+        response_json["winner_random_key"] = None
+    return response_json["final_explanation"], response_json["winner_random_key"]
+
+
+def _classifier_model() -> str:
+    return os.getenv("CLASSIFIER_MODEL") or "gpt-4.1-nano"
+
+
+def _query_turn(query: str) -> str:
+    return f"ورودی: {query}\nخروجی:"
+
+
+def _partial_json_string(buffer: str, field: str) -> str:
+    """
+    Decoded (possibly incomplete) value of a string field in a JSON object
+    that is still being streamed; "" until the field has started.
+    """
+    marker = re.search(r'"%s"\s*:\s*"' % re.escape(field), buffer)
+    if not marker:
+        return ""
+    raw = buffer[marker.end():]
+    escaped = False
+    for i, ch in enumerate(raw):
+        if escaped:
+            escaped = False
+        elif ch == "\\":
+            escaped = True
+        elif ch == '"':
+            raw = raw[:i]
+            break
+    # A trailing escape sequence may be cut mid-way (at most 6 chars, e.g. \u06cc)
+    for cut in range(7):
+        try:
+            return json.loads('"' + raw[:len(raw) - cut] + '"')
+        except json.JSONDecodeError:
+            continue
+    return ""
+
+
+def _log_prompt_cache_usage(method: str, response) -> None:
+    """Log how much of the prompt the provider served from its prefix cache"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None)
+    logger.debug("%s: prompt_tokens=%s cached_tokens=%s", method, getattr(usage, "prompt_tokens", None), cached_tokens)
+
+# Normalized feature-value matrices keyed by sha256(extra_features) and embeddings
+# keyed by sha256(text); both outlive the per-request agent instances created by the router.
+_feature_index_cache = LRUCache(maxsize=512)
+_feature_text_embedding_cache = LRUCache(maxsize=20000)
+
+# LLM answers keyed on the exact normalized query. Routing echoes product names and
+# keys from the query, and "least price" / "most price" embed almost identically,
+# so a semantic (near-duplicate) hit could hand back another query's products or label.
+_llm_answer_cache = LRUCache(maxsize=2048, ttl=300)
+# Settled answers of process_query, keyed by the resolved product keys and the
+# normalized query: the winner key must belong to exactly these two products.
+_response_cache = LRUCache(maxsize=1024, ttl=300)
+# Optional queue receiving the final_explanation text of the comparison running in
+# this context as the model writes it; None when nobody renders it progressively.
+_explanation_sink: ContextVar[Optional[asyncio.Queue]] = ContextVar("_explanation_sink", default=None)
+# The _ComparisonBatch collecting the final decision of the process_query running in
+# this context (see process_queries_batch); None for online requests.
+_batch_slot: ContextVar[Optional["_ComparisonBatch"]] = ContextVar("_batch_slot", default=None)
+
+
+class _ComparisonBatch:
+    """
+    Final decisions of concurrent process_query(mode="batch") calls, sent as one
+    Batch API job. A job is flushed once every query is either waiting for its
+    decision or finished without needing one.
+    """
+
+    def __init__(self, agent, size):
+        self.agent = agent
+        self.running = size
+        self.items = []
+        self.futures = []
+
+    def submit(self, query, data) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.items.append({"query": query, "data": data})
+        self.futures.append(future)
+        self.running -= 1
+        self._maybe_flush()
+        return future
+
+    def finished(self) -> None:
+        """A query ended without submitting (cache hit, no products, error)"""
+        self.running -= 1
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if self.running or not self.items:
+            return
+        items, futures = self.items, self.futures
+        self.items, self.futures = [], []
+        job = asyncio.ensure_future(self.agent._get_final_comparison_answer_batch(items))
+
+        def _deliver(job):
+            results = job.result() if not job.cancelled() and job.exception() is None else None
+            for i, future in enumerate(futures):
+                if not future.done():
+                    future.set_result(results[i] if results else (_FINAL_ANSWER_ERROR_MESSAGE, None))
+
+        job.add_done_callback(_deliver)
+
+
+def _answer_key(method: str, model_name: str, query: str):
+    return method, model_name, " ".join(query.split()).lower()
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+async def _embed_texts_cached(texts, embedder) -> np.ndarray:
+    """Embed texts; misses fall through to the on-disk cache and then the embedder"""
+    keys = [_sha256(t) for t in texts]
+    vectors = [_feature_text_embedding_cache.get(k) for k in keys]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        fresh = await embed_cached([texts[i] for i in missing], embedder)
+        for i, vec in zip(missing, fresh):
+            _feature_text_embedding_cache.set(keys[i], vec)
+            vectors[i] = vec
+    return np.vstack(vectors).astype(np.float32)
+
+
+def _l2_normalize(mat: np.ndarray) -> np.ndarray:
+    return mat / (np.linalg.norm(mat, axis=-1, keepdims=True) + 1e-12)
+
+
+def exact_cosine_top1(matrix: np.ndarray, query_vec: np.ndarray):
+    """
+    Brute-force cosine top-1 over a row-normalized matrix.
+    Feature lists are a few dozen strings, where a single BLAS matvec beats
+    building any ANN graph.
+    """
+    scores = matrix @ _l2_normalize(query_vec)
+    best = int(np.argmax(scores))
+    return best, float(scores[best])
+
 class ComparisonAgent(FeatureProductAgent):
-    def __init__(self, prompt_template: PromptTemplate, db_path: str | None = None):
+    def __init__(self, prompt_template: PromptTemplate | None = None, db_path: str | None = None):
         # Properly initialize parent so we have self.prompt_template, self.client, etc.
         super().__init__(prompt_template, db_path)
 
+    async def _match_feature_value(self, extra_features_str, persian_feature_names, feature_name, embedder):
+        """Top-1 (id, score) of feature_name among the product's feature values"""
+        cache_key = _sha256(extra_features_str)
+        matrix = _feature_index_cache.get(cache_key)
+        if matrix is None:
+            # Query and candidates go to the embedder in a single batch
+            vectors = await _embed_texts_cached([feature_name, *persian_feature_names], embedder)
+            query_vec, matrix = vectors[0], _l2_normalize(vectors[1:])
+            _feature_index_cache.set(cache_key, matrix)
+        else:
+            query_vec = (await _embed_texts_cached([feature_name], embedder))[0]
+        return exact_cosine_top1(matrix, query_vec)
+
     async def _route_task_type(self, query: str) -> Dict[str, Any]:
         try:
-            # Create few-shot examples string
-            examples_str = ""
-            for sample in route_task_comparison_samples:
-                examples_str += f"ورودی: {sample['input']}\n"
-                examples_str += f"خروجی: {json.dumps({k: v for k, v in sample.items() if k != 'input'}, ensure_ascii=False)}\n\n"
-            
-            # Create the full prompt
-            full_prompt = f"{route_task_comparison_system_prompt}\n\nمثال‌ها:\n{examples_str}\nورودی: {query}\nخروجی:"
-            
+            model_name = _chat_model()
+            cache_key = _answer_key("_route_task_type", model_name, query)
+            cached = _llm_answer_cache.get(cache_key)
+            if cached is not None:
+                return dict(cached)
+
             # Call the LLM
             response = await self.client.chat.completions.create(
-                model=os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
+                model=model_name,
                 messages=[
-                    {"role": "system", "content": "تو یک مسیریاب هوشمند برای تشخیص نوع مقایسه محصولات هستی."},
-                    {"role": "user", "content": full_prompt}
-                ]
+                    {"role": "system", "content": _ROUTE_PREFIX},
+                    {"role": "user", "content": _query_turn(query)}
+                ],
+                response_format=_ROUTE_RESPONSE_FORMAT,
+                temperature=0,
+                max_tokens=256
             )
+            _log_prompt_cache_usage("_route_task_type", response)
             
             # Parse the JSON response
-            result = json.loads(response.choices[0].message.content)
+            result = json_utils.loads(response.choices[0].message.content)
+            _llm_answer_cache.set(cache_key, dict(result))
             
             return result
             
@@ -68,164 +357,211 @@ class ComparisonAgent(FeatureProductAgent):
 
     async def _search_compare_feature(self, query, product_random_key_1, product_name_1, product_random_key_2, product_name_2):
         try:
-            # Create few-shot examples string
-            examples_str = ""
-            for sample in comparison_feature_samples:
-                examples_str += f"ورودی: {sample['input']}\n"
-                examples_str += f"خروجی: {json.dumps({'compare_feature': sample['compare_feature']}, ensure_ascii=False)}\n\n"
-            
-            # Create the full prompt
-            full_prompt = f"{comparison_feature_system_prompt}\n\nمثال‌ها:\n{examples_str}\nورودی: {query}\nخروجی:"
-            
-            # Call the LLM
-            response = await self.client.chat.completions.create(
-                model=os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "تو یک استخراج‌کننده ویژگی مقایسه هستی."},
-                    {"role": "user", "content": full_prompt}
-                ]
-            )
-            
-            # Parse the JSON response
-            result = json.loads(response.choices[0].message.content)
-            compare_feature_fa = result.get("compare_feature", "نامشخص")
+            model_name = _chat_model()
+            cache_key = _answer_key("_search_compare_feature", model_name, query)
+            compare_feature_fa = _llm_answer_cache.get(cache_key)
+            if compare_feature_fa is None:
+                # Call the LLM
+                response = await self.client.chat.completions.create(
+                    model=model_name,
+                    messages=[
+                        {"role": "system", "content": _CMP_FEATURE_PREFIX},
+                        {"role": "user", "content": _query_turn(query)}
+                    ],
+                    response_format=_JSON_RESPONSE_FORMAT
+                )
+                _log_prompt_cache_usage("_search_compare_feature", response)
+                
+                # Parse the JSON response
+                result = json_utils.loads(response.choices[0].message.content)
+                compare_feature_fa = result.get("compare_feature", "نامشخص")
+                _llm_answer_cache.set(cache_key, compare_feature_fa)
+
+            # Find English name of the feature using exact match first;
+            # the product's features are only read on a miss
+            find_compare_feature_en = find_feature_key(compare_feature_fa)
+            if find_compare_feature_en:
+                return find_compare_feature_en, compare_feature_fa
 
-            extra_features_product_result = self.db.query(
-                "SELECT extra_features FROM base_products WHERE random_key = ? LIMIT 1",
-                (product_random_key_1,)
+            extra_features_product_str, extra_features_product_dict = await asyncio.to_thread(
+                self._load_extra_features, product_random_key_1
             )
-            extra_features_product = dict(extra_features_product_result[0])
-            extra_features_product_str = extra_features_product['extra_features']
-            extra_features_product_dict = json.loads(extra_features_product_str)
-
-            # Find English name of the feature using exact match first
-            find_compare_feature_en = None
-            for eng_key, persian_value in features_dict.items():
-                if persian_value == compare_feature_fa or compare_feature_fa in persian_value or persian_value in compare_feature_fa:
-                    find_compare_feature_en = eng_key
-                    break
             
             # If exact match not found, use semantic search
-            if not find_compare_feature_en:
+            if extra_features_product_dict:
                 try:
                     # Get all Persian feature names from features_dict
                     persian_feature_names = list(extra_features_product_dict.values())
                     
                     # Use faiss_embedding.py for embedding similarity search
-                    embedder = EmbeddingServiceWrapper()
-                    
-                    # Build HNSW index from Persian feature names
-                    c = await build_hnsw_from_texts(persian_feature_names, embedder, metric='cosine', m=32, ef_construction=300, ef_search=128)
+                    embedder = get_shared_embedder()
                     
-                    # Search for similarity
-                    hits = await semantic_search(c, [compare_feature_fa], embedder, top_k=1)
+                    # Exact cosine scan over the (cached) Persian feature names
+                    best_match_index, score = await self._match_feature_value(extra_features_product_str, persian_feature_names, compare_feature_fa, embedder)
                     
                     # If similarity is more than 0.75, use the match
-                    if hits[0][0]['score'] > 0.75:
-                        best_match_index = hits[0][0]['id']
+                    if score > 0.75:
                         best_match = persian_feature_names[best_match_index]
                         
                         # Find the English key for this Persian feature name
-                        for eng_key, persian_value in features_dict.items():
-                            if persian_value == best_match:
-                                find_compare_feature_en = eng_key
-                                compare_feature_fa = persian_value
-                                break
+                        if best_match in persian_to_eng_features:
+                            find_compare_feature_en = persian_to_eng_features[best_match]
+                            compare_feature_fa = best_match
                                 
                 except Exception as e:
-                    print(f"Error in embedding similarity search: {e}")
+                    logger.error("Error in embedding similarity search: %s", e)
             if not find_compare_feature_en:
                 p = [compare_feature_fa]
                 find_compare_feature_en = await self._find_features_with_llm(product_random_key_1, p, extra_features_product_dict, product_name_1)
             return find_compare_feature_en, compare_feature_fa
             
         except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response: {e}")
+            logger.error("Error parsing JSON response: %s", e)
             return None, "نامشخص"
         except Exception as e:
-            print(f"Error in feature extraction: {e}")
+            logger.error("Error in feature extraction: %s", e)
             return None, "نامشخص"
 
-    def _get_feature_value(self, product_random_key, find_compare_feature_en):
-        """Get feature value for a specific product using its random key and feature name"""
-        if not product_random_key or not find_compare_feature_en:
-            return None
-            
-        try:
-            result = self.db.query(
-                "SELECT extra_features FROM base_products WHERE random_key = ? LIMIT 1",
-                (product_random_key,)
-            )
-            if result:
-                product_data = dict(result[0])
-                extra_features_str = product_data['extra_features']
-                extra_features_dict = json.loads(extra_features_str)
-                
-                # Return the feature value if it exists
-                if find_compare_feature_en in extra_features_dict:
-                    return extra_features_dict[find_compare_feature_en]
-                else:
-                    return None
-            return None
-        except Exception as e:
-            print(f"Error getting feature value: {e}")
-            return None
+    def _read_product_bundles(self, keys):
+        """{random_key: {"extra_features": dict, "stats": dict}}: everything the comparison branches read"""
+        extra_features = self._load_extra_features_many(keys)
+        stats = self._get_product_stats(keys)
+        return {
+            key: {"extra_features": extra_features[key][1], "stats": stats[key]}
+            for key in keys if key
+        }
 
-    async def _get_final_comparison_answer_feature_level(self, query, data):
-        """Generate final comparison answer using LLM"""
-        try:
-            # استفاده از نمونه‌ها برای few-shot learning
-            few_shot_examples = "\n".join([
-                f"ورودی: {sample['final_explanation']}\nخروجی: {json.dumps(sample, ensure_ascii=False, separators=(',', ':'))}"
-                for sample in compare_final_decide_samples  # استفاده از 3 نمونه اول
-            ])
-            
-            user_content = f"""
+    async def _fetch_product_bundles(self, keys):
+        """Both products' data in one worker-thread hop (one batched query per source)"""
+        return await asyncio.to_thread(self._read_product_bundles, tuple(keys))
+
+    def _final_answer_messages(self, query, data):
+        user_content = f"""
             پرسش کاربر: {query}
             
             داده‌های مقایسه:
-            {json.dumps(data, ensure_ascii=False, indent=2)}
-            
-            {few_shot_examples}
+            {json_utils.dumps(data, indent=True)}
             
             لطفاً بر اساس داده‌های بالا، مقایسه نهایی را انجام داده و برنده را مشخص کن.
             """
-            
-            response = await self.client.chat.completions.create(
-                model=os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": comparison_final_decide_system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
-                temperature=0
+        return [
+            {"role": "system", "content": _FINAL_DECIDE_PREFIX},
+            {"role": "user", "content": user_content}
+        ]
+
+    async def _get_final_comparison_answer_feature_level(self, query, data):
+        """
+        Generate final comparison answer using LLM. The reply is streamed; while it
+        arrives, the new final_explanation text goes to _explanation_sink (if set).
+        """
+        try:
+            stream = await self.client.chat.completions.create(
+                model=_chat_model(),
+                messages=self._final_answer_messages(query, data),
+                temperature=0,
+                response_format=_JSON_RESPONSE_FORMAT,
+                stream=True,
+                stream_options={"include_usage": True}
             )
-            response_text = (response.choices[0].message.content or "").strip()
-            
-            # Clean the response text to remove markdown code blocks if present
-            if response_text.startswith('```json'):
-                response_text = response_text[7:]  # Remove ```json
-            if response_text.startswith('```'):
-                response_text = response_text[3:]   # Remove ```
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]  # Remove trailing ```
-            
-            response_text = response_text.strip()
-            response_json = json.loads(response_text)
-            if response_json["winner_random_key"] == "مساوی":
-                response_json["winner_random_key"] = None
-            if response_json:
-                return response_json["final_explanation"], response_json["winner_random_key"]
-            else:
-                return None, None
+            sink = _explanation_sink.get()
+            buffer = ""
+            sent = 0
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    _log_prompt_cache_usage("_get_final_comparison_answer_feature_level", chunk)
+                if not (chunk.choices and chunk.choices[0].delta.content):
+                    continue
+                buffer += chunk.choices[0].delta.content
+                if sink is not None:
+                    explanation = _partial_json_string(buffer, "final_explanation")
+                    if len(explanation) > sent:
+                        sink.put_nowait(explanation[sent:])
+                        sent = len(explanation)
+            return _parse_final_decision(buffer)
             
         except Exception as e:
-            print(f"Error generating final answer: {e}")
-            return "متأسفم، نتوانستم پاسخ مناسبی برای مقایسه این محصولات ارائه دهم."
+            logger.error("Error generating final answer: %s", e)
+            return _FINAL_ANSWER_ERROR_MESSAGE, None
 
-    async def _feature_level_comparison(self, query, product_random_key_1, product_name_1, product_random_key_2, product_name_2):
-        find_compare_feature_en, find_compare_feature_fa = await self._search_compare_feature(query,product_random_key_1, product_name_1, product_random_key_2, product_name_2)
-        value_compare_feature_product_1 = self._get_feature_value(product_random_key_1, find_compare_feature_en)
-        value_compare_feature_product_2 = self._get_feature_value(product_random_key_2, find_compare_feature_en)
+    async def _get_final_comparison_answer_batch(self, items):
+        """
+        Final decisions for many comparisons in one Batch API job.
+        items: [{"query": ..., "data": ...}]; returns [(final_explanation, winner_random_key)]
+        in the same order. Blocks (asynchronously) until the batch finishes.
+        """
+        if not items:
+            return []
+        results = [(_FINAL_ANSWER_ERROR_MESSAGE, None)] * len(items)
+        try:
+            model_name = _chat_model()
+            lines = [
+                json_utils.dumps({
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model_name,
+                        "messages": self._final_answer_messages(item["query"], item["data"]),
+                        "temperature": 0,
+                        "response_format": _JSON_RESPONSE_FORMAT,
+                    },
+                })
+                for i, item in enumerate(items)
+            ]
+            batch_file = await self.client.files.create(
+                file=("comparison_final_answers.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch"
+            )
+            batch = await self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            while batch.status not in _BATCH_TERMINAL_STATUSES:
+                await asyncio.sleep(_BATCH_POLL_SECONDS)
+                batch = await self.client.batches.retrieve(batch.id)
+            if batch.status != "completed" or not batch.output_file_id:
+                logger.error("Comparison batch %s ended with status %s", batch.id, batch.status)
+                return results
+
+            output = await self.client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                # One malformed record only loses its own answer
+                try:
+                    record = json_utils.loads(line)
+                    content = record["response"]["body"]["choices"][0]["message"]["content"]
+                    results[int(record["custom_id"])] = _parse_final_decision(content)
+                except (KeyError, IndexError, TypeError, ValueError) as e:
+                    logger.error("Error parsing batch answer line %r: %s", line[:80], e)
+        except Exception as e:
+            logger.error("Error running comparison batch: %s", e)
+        return results
+
+    async def _final_comparison_answer(self, query, data, mode="online"):
+        """
+        mode="online" streams the answer now; mode="batch" goes through the Batch API,
+        in the job shared by process_queries_batch when there is one
+        """
+        if mode == "batch":
+            batch = _batch_slot.get()
+            if batch is not None:
+                _batch_slot.set(None)
+                return await batch.submit(query, data)
+            return (await self._get_final_comparison_answer_batch([{"query": query, "data": data}]))[0]
+        return await self._get_final_comparison_answer_feature_level(query, data)
+
+    async def _feature_level_comparison(self, query, product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode="online", bundles=None):
+        if not product_random_key_1 or not product_random_key_2:
+            return _PRODUCTS_NOT_FOUND_MESSAGE, None
+        # Resolve the feature name while both products' data is fetched (or prefetched by process_query)
+        (find_compare_feature_en, find_compare_feature_fa), bundles = await asyncio.gather(
+            self._search_compare_feature(query, product_random_key_1, product_name_1, product_random_key_2, product_name_2),
+            bundles or self._fetch_product_bundles((product_random_key_1, product_random_key_2)),
+        )
+        value_compare_feature_product_1 = bundles[product_random_key_1]["extra_features"].get(find_compare_feature_en) if find_compare_feature_en else None
+        value_compare_feature_product_2 = bundles[product_random_key_2]["extra_features"].get(find_compare_feature_en) if find_compare_feature_en else None
         data =  {
             "نام محصول ۱": product_name_1,
             "random_key محصول ۱": product_random_key_1,
@@ -234,203 +570,119 @@ class ComparisonAgent(FeatureProductAgent):
             find_compare_feature_fa + " محصول ۱": value_compare_feature_product_1,
             find_compare_feature_fa + " محصول ۲": value_compare_feature_product_2
         }
-        final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
+        final_answer, winner_random_key = await self._final_comparison_answer(query, data, mode)
         return final_answer, winner_random_key
 
     async def _detect_shop_comparison_task(self, query):
         """Detect the type of shop comparison task from user query"""
         try:
-            # Create few-shot examples string
-            examples_str = ""
-            for sample in comparison_shop_samples:
-                examples_str += f"ورودی: {sample['input']}\n"
-                examples_str += f"خروجی: {json.dumps({'shop_task': sample['comparison_type']}, ensure_ascii=False)}\n\n"
-            
-            # Create the full prompt
-            full_prompt = f"{comparison_shop_system_prompt}\n\nمثال‌ها:\n{examples_str}\nورودی: {query}\nخروجی:"
-            
+            model_name = _classifier_model()
+            cache_key = _answer_key("_detect_shop_comparison_task", model_name, query)
+            cached = _llm_answer_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
             # Call the LLM
             response = await self.client.chat.completions.create(
-                model=os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
+                model=model_name,
                 messages=[
-                    {"role": "system", "content": "تو یک مسیریاب هوشمند برای تشخیص نوع مقایسه فروشگاهی هستی."},
-                    {"role": "user", "content": full_prompt}
-                ]
+                    {"role": "system", "content": _SHOP_PREFIX},
+                    {"role": "user", "content": _query_turn(query)}
+                ],
+                response_format=_SHOP_TASK_RESPONSE_FORMAT,
+                temperature=0,
+                max_tokens=20
             )
+            _log_prompt_cache_usage("_detect_shop_comparison_task", response)
             
             # Parse the JSON response
-            result = json.loads(response.choices[0].message.content)
+            result = json_utils.loads(response.choices[0].message.content)
             shop_task = result.get("shop_task", "unknown")
+            if shop_task != "unknown":
+                _llm_answer_cache.set(cache_key, shop_task)
             
             return shop_task
             
         except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response: {e}")
+            logger.error("Error parsing JSON response: %s", e)
             return "unknown"
         except Exception as e:
-            print(f"Error in shop task detection: {e}")
+            logger.error("Error in shop task detection: %s", e)
             return "unknown"
 
-    def _get_count_of_shops(self, random_key):
-        """Get count of shops that have this product"""
-        if not random_key:
-            return 0
-            
-        try:
-            query = """
-            SELECT COUNT(DISTINCT m.shop_id) as shop_count
-            FROM members m
-            WHERE m.base_random_key = ?
-            """
-            result = self.db.query(query, (random_key,))
-            if result:
-                return result[0]['shop_count']
-            return 0
-        except Exception as e:
-            print(f"Error getting shop count: {e}")
-            return 0
-
-    def _get_mean_price_of_product(self, random_key):
-        """Get mean price of product across all shops"""
-        if not random_key:
-            return 0
-            
-        try:
-            query = """
-            SELECT AVG(m.price) as mean_price
-            FROM members m
-            WHERE m.base_random_key = ?
-            """
-            result = self.db.query(query, (random_key,))
-            if result and result[0]['mean_price'] is not None:
-                return round(result[0]['mean_price'], 2)
-            return 0
-        except Exception as e:
-            print(f"Error getting mean price: {e}")
-            return 0
-
-    def _get_least_price_of_product(self, random_key):
-        """Get least price of product across all shops"""
-        if not random_key:
-            return 0
-            
-        try:
-            query = """
-            SELECT MIN(m.price) as least_price
-            FROM members m
-            WHERE m.base_random_key = ?
-            """
-            result = self.db.query(query, (random_key,))
-            if result and result[0]['least_price'] is not None:
-                return result[0]['least_price']
-            return 0
-        except Exception as e:
-            print(f"Error getting least price: {e}")
-            return 0
+    def _get_product_stats(self, keys):
+        """
+        Shop count, mean/min/max price, warranty shop count and city count for
+        several products. Read from the product_stats table (one indexed row per
+        product); keys missing from it (products loaded after it was built, or no
+        table at all) are aggregated live from members.
+        Returns {random_key: stats}; products without offers get zeros.
+        """
+        keys = tuple(k for k in keys if k)
+        stats = {k: dict(_EMPTY_PRODUCT_STATS) for k in keys}
+        if not keys:
+            return stats
 
-    def _get_most_price_of_product(self, random_key):
-        """Get most price of product across all shops"""
-        if not random_key:
-            return 0
-            
         try:
-            query = """
-            SELECT MAX(m.price) as most_price
-            FROM members m
-            WHERE m.base_random_key = ?
-            """
-            result = self.db.query(query, (random_key,))
-            if result and result[0]['most_price'] is not None:
-                return result[0]['most_price']
-            return 0
+            try:
+                rows = self.db.query(
+                    f"SELECT {_PRODUCT_STATS_COLUMNS} FROM product_stats WHERE random_key IN ({','.join('?' * len(keys))})", keys
+                )
+            except sqlite3.OperationalError:
+                rows = []
+            missing = tuple(set(keys).difference(row['random_key'] for row in rows))
+            if missing:
+                rows = list(rows) + self.db.query(
+                    f"{product_stats_select} WHERE m.base_random_key IN ({','.join('?' * len(missing))}) GROUP BY m.base_random_key",
+                    missing
+                )
+            for row in rows:
+                stats[row['random_key']] = {
+                    name: (row[name] if row[name] is not None else 0) for name in _EMPTY_PRODUCT_STATS
+                }
+                stats[row['random_key']]['mean_price'] = round(stats[row['random_key']]['mean_price'], 2)
         except Exception as e:
-            print(f"Error getting most price: {e}")
-            return 0
+            logger.error("Error getting product stats: %s", e)
+        return stats
 
-    async def _shop_level_comparison(self, query,product_random_key_1, product_name_1, product_random_key_2, product_name_2):
+    async def _shop_level_comparison(self, query,product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode="online", bundles=None):
         """
         here for now we have some task:
             compare_count_of_shops
             compare_mean_price
             compare_least_price
             compare_most_price
+        mode="batch" sends the final decision through the Batch API (offline callers only).
         """
-        compare_shop_task = await self._detect_shop_comparison_task(query)
-        final_answer = "متأسفم، نتوانستم پاسخ مناسبی برای مقایسه این محصولات ارائه دهم."
+        if not product_random_key_1 or not product_random_key_2:
+            return _PRODUCTS_NOT_FOUND_MESSAGE, None
+        # Task detection (LLM) and both products' stats (one aggregate query) run together
+        compare_shop_task, bundles = await asyncio.gather(
+            self._detect_shop_comparison_task(query),
+            bundles or self._fetch_product_bundles((product_random_key_1, product_random_key_2)),
+        )
+        stats_1, stats_2 = bundles[product_random_key_1]["stats"], bundles[product_random_key_2]["stats"]
+        final_answer = _FINAL_ANSWER_ERROR_MESSAGE
         winner_random_key = None
-        if compare_shop_task == "compare_count_of_shops":
-            count_shops_product_1 = self._get_count_of_shops(product_random_key_1)
-            count_shops_product_2 = self._get_count_of_shops(product_random_key_2)
-            data = {
-                "نام محصول ۱": product_name_1,
-                "random_key محصول ۱": product_random_key_1,
-                "نام محصول ۲": product_name_2,
-                "random_key محصول ۲": product_random_key_2,
-                "تعداد فروشگاه‌های محصول ۱": count_shops_product_1,
-                "تعداد فروشگاه‌های محصول ۲": count_shops_product_2
-            }
-            final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
-        if compare_shop_task == "compare_mean_price":
-            mean_price_product_1 = self._get_mean_price_of_product(product_random_key_1)
-            mean_price_product_2 = self._get_mean_price_of_product(product_random_key_2)
-            data = {
-                "نام محصول ۱": product_name_1,
-                "random_key محصول ۱": product_random_key_1,
-                "نام محصول ۲": product_name_2,
-                "random_key محصول ۲": product_random_key_2,
-                "میانگین قیمت محصول ۱": mean_price_product_1,
-                "میانگین قیمت محصول ۲": mean_price_product_2
-            }
-            final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
-        if compare_shop_task == "compare_least_price":
-            least_price_product_1 = self._get_least_price_of_product(product_random_key_1)
-            least_price_product_2 = self._get_least_price_of_product(product_random_key_2)
-            data = {
-                "نام محصول ۱": product_name_1,
-                "random_key محصول ۱": product_random_key_1,
-                "نام محصول ۲": product_name_2,
-                "random_key محصول ۲": product_random_key_2,
-                "کمترین قیمت محصول ۱": least_price_product_1,
-                "کمترین قیمت محصول ۲": least_price_product_2
-            }
-            final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
-        if compare_shop_task == "compare_most_price":
-            most_price_product_1 = self._get_most_price_of_product(product_random_key_1)
-            most_price_product_2 = self._get_most_price_of_product(product_random_key_2)
+        if compare_shop_task in _SHOP_STAT_LABELS:
+            stat_name, label = _SHOP_STAT_LABELS[compare_shop_task]
             data = {
                 "نام محصول ۱": product_name_1,
                 "random_key محصول ۱": product_random_key_1,
                 "نام محصول ۲": product_name_2,
                 "random_key محصول ۲": product_random_key_2,
-                "بیشترین قیمت محصول ۱": most_price_product_1,
-                "بیشترین قیمت محصول ۲": most_price_product_2
+                f"{label} ۱": stats_1[stat_name],
+                f"{label} ۲": stats_2[stat_name]
             }
-            final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
+            final_answer, winner_random_key = await self._final_comparison_answer(query, data, mode)
         return final_answer, winner_random_key
 
-    def _get_warranty_count(self, random_key):
-        """Get count of shops that have this product with warranty"""
-        if not random_key:
-            return 0
-            
-        try:
-            query = """
-            SELECT COUNT(DISTINCT m.shop_id) as warranty_shop_count
-            FROM members m
-            JOIN shops s ON m.shop_id = s.id
-            WHERE m.base_random_key = ? AND s.has_warranty = 1
-            """
-            result = self.db.query(query, (random_key,))
-            if result:
-                return result[0]['warranty_shop_count']
-            return 0
-        except Exception as e:
-            print(f"Error getting warranty count: {e}")
-            return 0
-
-    async def _warranty_level_comparison(self, query,product_random_key_1, product_name_1, product_random_key_2, product_name_2):
-        number_of_warranty_product_1 = self._get_warranty_count(product_random_key_1)
-        number_of_warranty_product_2 = self._get_warranty_count(product_random_key_2)
+    async def _warranty_level_comparison(self, query,product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode="online", bundles=None):
+        if not product_random_key_1 or not product_random_key_2:
+            return _PRODUCTS_NOT_FOUND_MESSAGE, None
+        bundles = await (bundles or self._fetch_product_bundles((product_random_key_1, product_random_key_2)))
+        number_of_warranty_product_1 = bundles[product_random_key_1]["stats"]['warranty_count']
+        number_of_warranty_product_2 = bundles[product_random_key_2]["stats"]['warranty_count']
         data = {
             "نام محصول ۱": product_name_1,
             "random_key محصول ۱": product_random_key_1,
@@ -439,33 +691,15 @@ class ComparisonAgent(FeatureProductAgent):
             "تعداد فروشگاههای دارای محصول ۱ همراه با گارانتی": number_of_warranty_product_1,
             "تعداد فروشگاههای دارای محصول ۲ همراه با گارانتی": number_of_warranty_product_2
         }
-        final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
+        final_answer, winner_random_key = await self._final_comparison_answer(query, data, mode)
         return final_answer, winner_random_key
 
-    def _get_number_of_cities_has_product(self, random_key):
-        """Get count of cities that have this product"""
-        if not random_key:
-            return 0
-            
-        try:
-            query = """
-            SELECT COUNT(DISTINCT c.id) as city_count
-            FROM members m
-            JOIN shops s ON m.shop_id = s.id
-            JOIN cities c ON s.city_id = c.id
-            WHERE m.base_random_key = ?
-            """
-            result = self.db.query(query, (random_key,))
-            if result:
-                return result[0]['city_count']
-            return 0
-        except Exception as e:
-            print(f"Error getting city count: {e}")
-            return 0
-
-    async def _city_level_comparison(self, query, product_random_key_1, product_name_1, product_random_key_2, product_name_2):
-        numver_of_cities_has_product_1 = self._get_number_of_cities_has_product(product_random_key_1)
-        numver_of_cities_has_product_2 = self._get_number_of_cities_has_product(product_random_key_2)
+    async def _city_level_comparison(self, query, product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode="online", bundles=None):
+        if not product_random_key_1 or not product_random_key_2:
+            return _PRODUCTS_NOT_FOUND_MESSAGE, None
+        bundles = await (bundles or self._fetch_product_bundles((product_random_key_1, product_random_key_2)))
+        numver_of_cities_has_product_1 = bundles[product_random_key_1]["stats"]['city_count']
+        numver_of_cities_has_product_2 = bundles[product_random_key_2]["stats"]['city_count']
         data = {
             "نام محصول ۱": product_name_1,
             "random_key محصول ۱": product_random_key_1,
@@ -474,21 +708,24 @@ class ComparisonAgent(FeatureProductAgent):
             "تعداد شهرهای دارای محصول ۱": numver_of_cities_has_product_1,
             "تعداد شهرهای دارای محصول ۲": numver_of_cities_has_product_2
         }
-        final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
+        final_answer, winner_random_key = await self._final_comparison_answer(query, data, mode)
         return final_answer, winner_random_key
 
-    def check_random_key_is_valid(self, random_key):
-        if random_key is None:
-            return False
-        else:
-            # Query the database to check if the random key exists
-            try:
-                query = "SELECT random_key FROM base_products WHERE random_key = ?"
-                result = self.db.query(query, (random_key,))
-                return len(result) > 0
-            except Exception as e:
-                print(f"Error checking random key validity: {e}")
-                return False
+    def _validate_keys(self, keys):
+        """Subset of the given random keys that exist in base_products, in one query"""
+        keys = tuple(k for k in keys if k)
+        if not keys:
+            return set()
+        try:
+            placeholders = ",".join("?" * len(keys))
+            rows = self.db.query(
+                f"SELECT random_key FROM base_products WHERE random_key IN ({placeholders})",
+                keys
+            )
+            return {row['random_key'] for row in rows}
+        except Exception as e:
+            logger.error("Error validating random keys: %s", e)
+            return set()
 
     async def _find_feature_for_compare_in_general(self, query: str) -> str:
         """
@@ -498,129 +735,87 @@ class ComparisonAgent(FeatureProductAgent):
         if not query or not query.strip():
             return "عمومی"
 
+        model_name = _chat_model()
+        cache_key = _answer_key("_find_feature_for_compare_in_general", model_name, query)
+        cached = _llm_answer_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         try:
-            # استفاده از نمونه‌ها برای few-shot learning
-            few_shot_examples = "\n".join([
-                f"ورودی: {sample['input']}\nخروجی: {json.dumps(sample, ensure_ascii=False, separators=(',', ':'))}"
-                for sample in find_main_feature_of_general_comapre_samples  # استفاده از 5 نمونه اول
-            ])
-            
-            user_content = f"{few_shot_examples}\n\nورودی: {query}\nخروجی:"
-            
-            model_name = os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini"
-            
             resp = await self.client.chat.completions.create(
                 model=model_name,
                 messages=[
-                    {"role": "system", "content": find_main_feature_of_general_comapre_system_prompt},
-                    {"role": "user", "content": user_content}
+                    {"role": "system", "content": _FIND_FEATURE_PREFIX},
+                    {"role": "user", "content": _query_turn(query)}
                 ],
-                temperature=0
+                temperature=0,
+                response_format=_JSON_RESPONSE_FORMAT
             )
+            _log_prompt_cache_usage("_find_feature_for_compare_in_general", resp)
             
-            response_text = (resp.choices[0].message.content or "").strip()
-            
-            # تلاش برای پارس کردن JSON
-            try:
-                result = json.loads(response_text)
-                if "comparison_feature" in result:
-                    return result["comparison_feature"]
-            except json.JSONDecodeError:
-                pass
-            
-            # در صورت خطا در پارس، تلاش برای استخراج JSON از متن
-            import re
-            json_match = re.search(r'\{[^}]*\}', response_text)
-            if json_match:
-                try:
-                    result = json.loads(json_match.group())
-                    if "comparison_feature" in result:
-                        return result["comparison_feature"]
-                except json.JSONDecodeError:
-                    pass
-            
-            # در صورت عدم موفقیت، تلاش برای استخراج مستقیم از متن
-            if "comparison_feature" in response_text:
-                import re
-                feature_match = re.search(r'"comparison_feature":\s*"([^"]+)"', response_text)
-                if feature_match:
-                    return feature_match.group(1)
+            result = json_utils.loads(resp.choices[0].message.content or "{}")
+            if result.get("comparison_feature"):
+                _llm_answer_cache.set(cache_key, result["comparison_feature"])
+                return result["comparison_feature"]
             
         except Exception as e:
-            print(f"Error in _find_feature_for_compare_in_general: {e}")
+            logger.error("Error in _find_feature_for_compare_in_general: %s", e)
         
         # در صورت خطا، بازگشت به حالت پیش‌فرض
         return None
     
-    async def _feature_level_comparison_genral(self, query, product_random_key_1, product_name_1, product_random_key_2, product_name_2, find_feature_to_compare):
+    async def _feature_level_comparison_genral(self, query, product_random_key_1, product_name_1, product_random_key_2, product_name_2, find_feature_to_compare, mode="online", bundles=None):
         """
         مقایسه در سطح ویژگی برای سوالات عمومی
         در این تابع ویژگی مقایسه‌ای از قبل استخراج شده و نیازی به استخراج مجدد نیست
         """
+        if not product_random_key_1 or not product_random_key_2:
+            return _PRODUCTS_NOT_FOUND_MESSAGE, None
         try:
             # تبدیل نام فارسی ویژگی به انگلیسی
-            find_compare_feature_en = None
-            for eng_key, persian_value in features_dict.items():
-                if persian_value == find_feature_to_compare or find_feature_to_compare in persian_value or persian_value in find_feature_to_compare:
-                    find_compare_feature_en = eng_key
-                    break
+            find_compare_feature_en = find_feature_key(find_feature_to_compare)
             
             # اگر تطبیق دقیق پیدا نشد، از جستجوی معنایی استفاده کن
+            extra_features_product_str = None
             if not find_compare_feature_en:
+                # دریافت ویژگی‌های اضافی محصول اول (فقط یک بار، و فقط وقتی تطبیق دقیق نبود)
+                extra_features_product_str, extra_features_product_dict = await asyncio.to_thread(
+                    self._load_extra_features, product_random_key_1
+                )
                 try:
-                    # دریافت ویژگی‌های اضافی محصول اول
-                    extra_features_product_result = self.db.query(
-                        "SELECT extra_features FROM base_products WHERE random_key = ? LIMIT 1",
-                        (product_random_key_1,)
-                    )
-                    if extra_features_product_result:
-                        extra_features_product = dict(extra_features_product_result[0])
-                        extra_features_product_str = extra_features_product['extra_features']
-                        extra_features_product_dict = json.loads(extra_features_product_str)
-                        
+                    if extra_features_product_str:
                         # دریافت نام‌های فارسی ویژگی‌ها
                         persian_feature_names = list(extra_features_product_dict.values())
                         
                         # استفاده از جستجوی معنایی
-                        embedder = EmbeddingServiceWrapper()
-                        c = await build_hnsw_from_texts(persian_feature_names, embedder, metric='cosine', m=32, ef_construction=300, ef_search=128)
-                        hits = await semantic_search(c, [find_feature_to_compare], embedder, top_k=1)
+                        embedder = get_shared_embedder()
+                        best_match_index, score = await self._match_feature_value(extra_features_product_str, persian_feature_names, find_feature_to_compare, embedder)
                         
                         # اگر شباهت بیش از 0.75 باشد، از تطبیق استفاده کن
-                        if hits[0][0]['score'] > 0.75:
-                            best_match_index = hits[0][0]['id']
+                        if score > 0.75:
                             best_match = persian_feature_names[best_match_index]
                             
                             # پیدا کردن کلید انگلیسی برای این نام فارسی
-                            for eng_key, persian_value in features_dict.items():
-                                if persian_value == best_match:
-                                    find_compare_feature_en = eng_key
-                                    find_feature_to_compare = persian_value
-                                    break
+                            if best_match in persian_to_eng_features:
+                                find_compare_feature_en = persian_to_eng_features[best_match]
+                                find_feature_to_compare = best_match
                                     
                 except Exception as e:
-                    print(f"Error in embedding similarity search: {e}")
+                    logger.error("Error in embedding similarity search: %s", e)
             
             # اگر هنوز کلید انگلیسی پیدا نشد، از LLM استفاده کن
-            if not find_compare_feature_en:
-                extra_features_product_result = self.db.query(
-                    "SELECT extra_features FROM base_products WHERE random_key = ? LIMIT 1",
-                    (product_random_key_1,)
-                )
-                if extra_features_product_result:
-                    extra_features_product = dict(extra_features_product_result[0])
-                    extra_features_product_str = extra_features_product['extra_features']
-                    extra_features_product_dict = json.loads(extra_features_product_str)
-                    p = [find_feature_to_compare]
-                    find_compare_feature_en = await self._find_features_with_llm(product_random_key_1, p, extra_features_product_dict, product_name_1)
+            if not find_compare_feature_en and extra_features_product_str:
+                p = [find_feature_to_compare]
+                find_compare_feature_en = await self._find_features_with_llm(product_random_key_1, p, extra_features_product_dict, product_name_1)
             
             # اگر کلید انگلیسی پیدا نشد، از نام فارسی استفاده کن
             if not find_compare_feature_en:
                 find_compare_feature_en = find_feature_to_compare
             
             # دریافت مقادیر ویژگی برای هر دو محصول
-            value_compare_feature_product_1 = self._get_feature_value(product_random_key_1, find_compare_feature_en)
-            value_compare_feature_product_2 = self._get_feature_value(product_random_key_2, find_compare_feature_en)
+            bundles = await (bundles or self._fetch_product_bundles((product_random_key_1, product_random_key_2)))
+            value_compare_feature_product_1 = bundles[product_random_key_1]["extra_features"].get(find_compare_feature_en)
+            value_compare_feature_product_2 = bundles[product_random_key_2]["extra_features"].get(find_compare_feature_en)
             
             # آماده‌سازی داده‌ها برای مقایسه نهایی
             data = {
@@ -633,14 +828,15 @@ class ComparisonAgent(FeatureProductAgent):
             }
             
             # دریافت پاسخ نهایی مقایسه
-            final_answer, winner_random_key = await self._get_final_comparison_answer_feature_level(query, data)
+            final_answer, winner_random_key = await self._final_comparison_answer(query, data, mode)
             return final_answer, winner_random_key
             
         except Exception as e:
-            print(f"Error in _feature_level_comparison_genral: {e}")
+            logger.error("Error in _feature_level_comparison_genral: %s", e)
             return "خطا در مقایسه ویژگی‌ها", None
 
-    async def process_query(self, query: str) -> Response:
+    async def process_query(self, query: str, mode: str = "online") -> Response:
+        """mode="batch" sends the final decision through the Batch API (offline callers only)"""
         extract_prompt_data = await self._route_task_type(query)
         comparison_type, product_name_1, product_random_key_1, product_name_2, product_random_key_2 = (
             extract_prompt_data.get("comparison_type", "general"),
@@ -649,38 +845,104 @@ class ComparisonAgent(FeatureProductAgent):
             extract_prompt_data.get("product_name_2", "نامشخص"),
             extract_prompt_data.get("product_random_key_2")
         )
-        print(f"Comparison type: {comparison_type}, Product 1: {product_name_1} ({product_random_key_1}), Product 2: {product_name_2} ({product_random_key_2})")
-        check_random_key_1_is_valid = self.check_random_key_is_valid(product_random_key_1)
-        if product_random_key_1 is None or not check_random_key_1_is_valid:
-            product_result = await self.search_product(product_name_1)
-            product_random_key_1 = product_result['random_key'] if product_result else None
-        check_random_key_2_is_valid = self.check_random_key_is_valid(product_random_key_2)
-        if product_random_key_2 is None or not check_random_key_2_is_valid:
-            product_result = await self.search_product(product_name_2)
-            product_random_key_2 = product_result['random_key'] if product_result else None
-        final_answer = "متأسفم، نتوانستم محصولات را برای مقایسه پیدا کنم."
+        logger.info("Comparison type: %s, Product 1: %s (%s), Product 2: %s (%s)", comparison_type, product_name_1, product_random_key_1, product_name_2, product_random_key_2)
+        # Both extracted keys are checked in one round trip
+        valid_keys = await asyncio.to_thread(self._validate_keys, (product_random_key_1, product_random_key_2))
+        # Products whose key is missing or invalid are searched by name, concurrently
+        keys = [product_random_key_1, product_random_key_2]
+        needed = [(slot, name) for slot, name in enumerate((product_name_1, product_name_2)) if keys[slot] not in valid_keys]
+        if needed:
+            results = await asyncio.gather(*(self.search_product(name) for _, name in needed))
+            for (slot, _), product_result in zip(needed, results):
+                keys[slot] = product_result['random_key'] if product_result else None
+        product_random_key_1, product_random_key_2 = keys
+        cache_key = _answer_key("process_query", _chat_model(), query) + (comparison_type, product_random_key_1, product_random_key_2)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            return cached.model_copy(deep=True)
+        # Both products' data is read while the branch below runs its LLM call
+        bundles = None
+        if product_random_key_1 and product_random_key_2:
+            bundles = asyncio.ensure_future(self._fetch_product_bundles(keys))
+        final_answer = _PRODUCTS_NOT_FOUND_MESSAGE
         winner_random_key = None
         if comparison_type == "feature_level":
-            final_answer, winner_random_key = await self._feature_level_comparison(query, product_random_key_1, product_name_1, product_random_key_2, product_name_2)
+            final_answer, winner_random_key = await self._feature_level_comparison(query, product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode=mode, bundles=bundles)
         elif comparison_type == "shop_level":
-            final_answer, winner_random_key =  await self._shop_level_comparison(query,product_random_key_1, product_name_1, product_random_key_2, product_name_2)
+            final_answer, winner_random_key =  await self._shop_level_comparison(query,product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode=mode, bundles=bundles)
         elif comparison_type == "warranty_level":
-            final_answer, winner_random_key =  await self._warranty_level_comparison(query,product_random_key_1, product_name_1, product_random_key_2, product_name_2)
+            final_answer, winner_random_key =  await self._warranty_level_comparison(query,product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode=mode, bundles=bundles)
         elif comparison_type == "city_level":
-            final_answer, winner_random_key =  await self._city_level_comparison(query,product_random_key_1, product_name_1, product_random_key_2, product_name_2)
+            final_answer, winner_random_key =  await self._city_level_comparison(query,product_random_key_1, product_name_1, product_random_key_2, product_name_2, mode=mode, bundles=bundles)
         elif comparison_type == "general":
             find_feature_to_compare = await self._find_feature_for_compare_in_general(query)
             if not find_feature_to_compare or find_feature_to_compare.lower() == "عمومی":
+                if bundles:
+                    bundles.cancel()
                 final_answer = "متأسفم، نتوانستم ویژگی خاصی برای مقایسه این محصولات تشخیص دهم."
                 winner_random_key = None
                 return Response(message=final_answer, base_random_keys=[], member_random_keys=[])
             else:
-                final_answer, winner_random_key = await self._feature_level_comparison_genral(query, product_random_key_1, product_name_1, product_random_key_2, product_name_2, find_feature_to_compare)
+                final_answer, winner_random_key = await self._feature_level_comparison_genral(query, product_random_key_1, product_name_1, product_random_key_2, product_name_2, find_feature_to_compare, mode=mode, bundles=bundles)
+        elif bundles:
+            bundles.cancel()
         if winner_random_key:
-            return Response(message=final_answer, base_random_keys=[winner_random_key], member_random_keys=[])
+            response = Response(message=final_answer, base_random_keys=[winner_random_key], member_random_keys=[])
+            # Only settled comparisons are reused; misses may be transient lookup failures
+            _response_cache.set(cache_key, response.model_copy(deep=True))
+            return response
         else:
             return Response(message=final_answer, base_random_keys=[], member_random_keys=[])
 
+    async def process_queries_batch(self, queries) -> list:
+        """
+        Answer many comparison queries offline: routing and product lookups run now,
+        and every final decision goes into one Batch API job. Returns the Responses
+        in the order of ``queries``, once the job has finished.
+        """
+        batch = _ComparisonBatch(self, len(queries))
+
+        async def _run(query):
+            # Each task runs in its own context, so the slot is per query
+            _batch_slot.set(batch)
+            try:
+                return await self.process_query(query, mode="batch")
+            finally:
+                # Still set means this query never submitted a final decision
+                if _batch_slot.get() is not None:
+                    batch.finished()
+
+        return await asyncio.gather(*(_run(query) for query in queries))
+
+    async def process_query_stream(self, query: str) -> AsyncIterator[Response]:
+        """
+        Same as process_query, but while the final answer is generated it yields
+        partial Responses holding the explanation written so far; the last
+        Response yielded is the one process_query returns (with the winner key).
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        # The task copies the current context, so it sees the queue
+        token = _explanation_sink.set(queue)
+        try:
+            task = asyncio.ensure_future(self.process_query(query))
+        finally:
+            _explanation_sink.reset(token)
+        message = ""
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+                if getter not in done:
+                    getter.cancel()
+                    break
+                message += getter.result()
+                yield Response(message=message, base_random_keys=[], member_random_keys=[])
+            yield task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+
+
 
 import time
 async def main():
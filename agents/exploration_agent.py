@@ -1,6 +1,11 @@
+import asyncio
 import json
 import os
 import random
+import sqlite3
+import faiss
+import json_utils
+import numpy as np
 from itertools import count
 from typing import Dict, Any, final
 from langchain.prompts import PromptTemplate
@@ -9,20 +14,119 @@ from unicodedata import category
 
 from response_format import Response
 import dotenv
-from embedding.faiss_embedding import EmbeddingServiceWrapper, build_hnsw_from_texts, semantic_search
+from cache_utils import LRUCache
+from embedding.cached_embedder import get_cached_embedder
+from embedding.faiss_embedding import get_shared_embedder
 from system_prompts.product_features_system_prompts import system_msg_extracting_product_features, samples_extracting_product_features
 from features_list import features_dict
 from system_prompts.comparison_system_prompt import *
 from system_prompts.comparison_feature_system_prompt import *
 from system_prompts.comparison_shop_system_prompt import *
 from agents.feature_product_agents import FeatureProductAgent
+from system_prompts.info_extraction_system_prompt import info_extraction_system_prompt, info_extraction_samples
 import itertools
+import logging
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+# One exact inner-product index over the normalized names of every catalog
+# table, shared across requests. Rows are added table by table, so each table
+# owns a contiguous id range and searches are restricted to it with an
+# IDSelectorRange. At catalog sizes (a few thousand names) a flat scan is exact
+# and faster than graph traversal. The cache entry holds "index", "ranges"
+# ({table: (start, end)}), "ids", "names" and a "fingerprint" of
+# (row count, max id) per table, which changes when a table is reloaded; the
+# file mtime can't be used because every exploration turn writes to the database.
+_CATALOG_TABLES = (("brands", "title"), ("cities", "name"))
+# Storage of the catalog vectors: TOROB_EMBED_DTYPE=fp16 halves memory (and
+# the bandwidth the scan needs), int8 quarters it; anything else keeps float32.
+_CATALOG_QUANTIZERS = {"fp16": "QT_fp16", "int8": "QT_8bit"}
+_catalog_index_cache: Dict[str, Any] = {}
+_catalog_index_lock = asyncio.Lock()
+
+# Name column of each {table}_fts table (db.create_db). An FTS hit is taken only when
+# the name covers at least half of the matched title; a short substring of a longer
+# title ("ال" in "ال جی") goes on to the embedding search instead.
+_FTS_COLUMNS = {"brands": "title", "categories": "title", "cities": "name"}
+_FTS_MIN_COVERAGE = 0.5
+
+# Extraction results by normalized query text, so repeating a question (or a
+# retried request) doesn't pay for the LLM call again
+_extraction_cache = LRUCache(maxsize=2048, ttl=3600)
+_EMPTY_EXTRACTION = (None, None, None, None, None, None, None, None, None)
+# Turn results keyed by chat_id, the stored chat state and the normalized query,
+# so a retried request doesn't run the turn again. A hit holds the exploration
+# row the turn wrote (None when it returned a member) and the Response; the row
+# names the chat's own slots, so it is never replayed into another chat.
+_response_cache = LRUCache(maxsize=2048, ttl=300)
+
+# Fixed SQL text for the per-turn statements, so SQLite reuses the prepared
+# statement instead of parsing a differently-shaped query every time.
+# COALESCE keeps the stored value when a field wasn't given this turn.
+_SQL_UPDATE_EXPLORATION = """
+    UPDATE exploration SET
+        counts = ?,
+        base_random_key = COALESCE(?, base_random_key),
+        brand_name = COALESCE(?, brand_name),
+        city_id = COALESCE(?, city_id),
+        category_name = COALESCE(?, category_name),
+        product_name = COALESCE(?, product_name),
+        lower_price = COALESCE(?, lower_price),
+        upper_price = COALESCE(?, upper_price),
+        has_warranty = COALESCE(?, has_warranty),
+        score = COALESCE(?, score)
+    WHERE chat_id = ?
+"""
+# Members of one base product joined to their shops; each optional filter is
+# skipped when its parameter is NULL. The base_random_key equality drives the
+# search through the covering (base_random_key, price, random_key, shop_id) index.
+_SQL_MEMBER_SEARCH = """
+    SELECT DISTINCT m.random_key
+    FROM members m
+    JOIN shops s ON m.shop_id = s.id
+    WHERE m.base_random_key = ?
+      AND (? IS NULL OR s.city_id = ?)
+      AND (? IS NULL OR m.price >= ?)
+      AND (? IS NULL OR m.price <= ?)
+      AND (? IS NULL OR s.has_warranty = ?)
+      AND (? IS NULL OR s.score >= ?)
+    ORDER BY m.price ASC, m.random_key ASC
+"""
+
+# Follow-up question fragments of the exploration dialogue
+_PROMPT_NAME = ("برای پاسخگویی متن نام دقیق محصول را وارد کنید.","لطفا نام دقیق محصول همراه با نام مدل و جزئیات درون نام را وارد کنید")
+_PROMPT_CITY = ("نام شهری که می خواهید از ان محصول را تهیه کنید را وارد کنید.","لطفا نام شهر را وارد کنید")
+_PROMPT_BRAND = ("نام برند اگر مد نظر هست حتما وارد کنید.","لطفا نام برند را وارد کنید")
+_PROMPT_CATEGORY = ("اگر دسته بندی خواستی مد نظر هست حتما وارد کنید.","لطفا نام دسته بندی را وارد کنید")
+_PROMPT_FEATURE = ("برای پاسخگویی متن ویژگی های محصول را وارد کنید.","لطفا ویژگی های محصول را وارد کنید")
+_PROMPT_PRICE = ("اگر بازه قیمتی در نظر دارید حتما به صورت دقیق وارد کنید.","لطفا بازه قیمت را وارد کنید")
+_PROMPT_WARRANTY = ("لطفا اگر ضمانت کالا برای تان مهم هست اشاره کنید.","لطفا اگر دوست دارید محصول مورد نظر ضمانت داشته باشد اشاره کنید")
+_RESPONSE_INTRO = "حتما می خواهیم با هم دیگر پرسخ و پاسخ داشته باشیم تا بتوانیم محصول مورد نظر شما پیدا کنیم."
+_RESPONSE_DEFAULT = "ممنون بایت اطلاعات مفید که در اختیار بنده قرار دادید."
+# The question asked after each turn, keyed by the turn count
+_RESPONSE_BY_TURN = {
+    1: "اگر می توانید نام کامل محصول و ویژگی هایی که این  محصول دارد و همین طور اگر این محصول مدلی دارد یا کد مخصوصی دارد در اختیار من بگذارید." + _PROMPT_CATEGORY[0],
+    2: "نام شهری که می خواهید از ان محصول را تهیه کنید را وارد کنید.",
+    3: "ایا نام برندی خاصی مد نظر شما هست. لطفا اگر دوست دارید محصول مورد نظر ضمانت داشته باشد اشاره کنید. امتیاز فروشنده چقدر باشد؟",
+    4: ".اگر داخل نام محصول مورد نظر کد یا مدل محصول وجود دارد لطفا بیان کنید. اگر بازه قیمتی مد نظر شما حد پایین و حد بالا ان را وارد کنید. امتیاز فروشنده چقدر باشد؟",
+    5: "می خواهم درون پایگاه داده جست و جو انجام دهم ایا اطلاعاتی باقی مانده که مد نظرتان باشد هست که گفته نشده ممنون می شم اگر اطلاعاتی باقی مانده اعلام کنید.",
+}
+
+# Info-extraction prompt: everything but the query is fixed, so build it once
+_INFO_EXTRACTION_EXAMPLES = "".join(
+    f"ورودی: {sample['input']}\n"
+    f"خروجی: {json_utils.dumps({k: v for k, v in sample.items() if k != 'input'})}\n\n"
+    for sample in info_extraction_samples
+)
+_INFO_EXTRACTION_PREFIX = f"{info_extraction_system_prompt}\n\nمثال‌ها:\n{_INFO_EXTRACTION_EXAMPLES}"
+_INFO_EXTRACTION_SYSTEM_MESSAGE = {"role": "system", "content": "تو یک استخراج‌کننده حرفه‌ای اطلاعات محصولات هستی."}
+
 
 class ExplorationAgent(FeatureProductAgent):
-    def __init__(self, prompt_template: PromptTemplate, db_path: str | None = None):
+    def __init__(self, prompt_template: PromptTemplate | None = None, db_path: str | None = None):
         # Properly initialize parent so we have self.prompt_template, self.client, etc.
         super().__init__(prompt_template, db_path)
 
@@ -60,37 +164,37 @@ class ExplorationAgent(FeatureProductAgent):
                 return (chat_id, 1, None,None, None, None, None, None, None, 0, 0)
                 
         except Exception as e:
-            print(f"Error in _get_chat_history: {e}")
+            logger.error("Error in _get_chat_history: %s", e)
             return (chat_id, 1, None, None, None, None, None, None, None, 0, 0)
 
     async def _extract_info_from_query(self, query: str):
         """
         design system prompt and samples to extract product name, city name, brand name, category name, features, lowest price, highest price, has_warranty from query if exist
         """
+        cache_key = " ".join(query.split())
+        cached = _extraction_cache.get(cache_key)
+        if cached is not None:
+            return cached
         try:
-            # Import the system prompt and samples
-            from system_prompts.info_extraction_system_prompt import info_extraction_system_prompt, info_extraction_samples
-            
-            # Create few-shot examples string
-            examples_str = ""
-            for sample in info_extraction_samples:
-                examples_str += f"ورودی: {sample['input']}\n"
-                examples_str += f"خروجی: {json.dumps({k: v for k, v in sample.items() if k != 'input'}, ensure_ascii=False)}\n\n"
-            
             # Create the full prompt
-            full_prompt = f"{info_extraction_system_prompt}\n\nمثال‌ها:\n{examples_str}\nورودی: {query}\nخروجی:"
+            full_prompt = f"{_INFO_EXTRACTION_PREFIX}\nورودی: {query}\nخروجی:"
             
             # Call the LLM
             response = await self.client.chat.completions.create(
                 model=os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
                 messages=[
-                    {"role": "system", "content": "تو یک استخراج‌کننده حرفه‌ای اطلاعات محصولات هستی."},
+                    _INFO_EXTRACTION_SYSTEM_MESSAGE,
                     {"role": "user", "content": full_prompt}
-                ]
+                ],
+                # "features" is an open-ended dict, which strict json_schema can't
+                # express; json_object still guarantees a parseable object
+                response_format={"type": "json_object"},
+                temperature=0,
+                max_tokens=256
             )
             
             # Parse the JSON response
-            result = json.loads(response.choices[0].message.content)
+            result = json_utils.loads(response.choices[0].message.content)
             
             # Extract values with proper defaults
             product_name = result.get("product_name")
@@ -104,22 +208,106 @@ class ExplorationAgent(FeatureProductAgent):
             shop_name = result.get("shop_name")
             score = result.get("score")
             
-            return (product_name, city_name, brand_name, category_name, features, lowest_price, highest_price, has_warranty, score)
+            extracted = (product_name, city_name, brand_name, category_name, features, lowest_price, highest_price, has_warranty, score)
+            _extraction_cache.set(cache_key, extracted)
+            return extracted
             
         except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response: {e}")
-            return (None, None, None, None, None, None, None, None, None)
+            logger.error("Error parsing JSON response: %s", e)
+            return _EMPTY_EXTRACTION
         except Exception as e:
-            print(f"Error in info extraction: {e}")
-            return (None, None, None, None, None, None, None, None, None)
+            logger.error("Error in info extraction: %s", e)
+            return _EMPTY_EXTRACTION
 
 
+    def _fts_lookup(self, table: str, name: str):
+        """
+        Best full-text match for a catalog name (brands / categories / cities),
+        using the {table}_fts tables from db.create_db. Every word of the name
+        must match, and the name must cover _FTS_MIN_COVERAGE of the matched title.
+        Returns the row id, or None on a miss or when the FTS table doesn't exist.
+        """
+        words = [w.replace('"', '') for w in name.split()]
+        words = [w for w in words if w]
+        if not words:
+            return None
+        match = " ".join(f'"{w}"' for w in words)
+        column = _FTS_COLUMNS[table]
+        try:
+            rows = self.db.query(
+                f"SELECT rowid AS id, {column} AS name FROM {table}_fts WHERE {table}_fts MATCH ? ORDER BY rank LIMIT 5",
+                (match,)
+            )
+        except sqlite3.OperationalError:
+            return None
+        length = len(" ".join(words))
+        for row in rows:
+            if row['name'] and length / len(row['name']) >= _FTS_MIN_COVERAGE:
+                return row['id']
+        return None
+
+    async def _catalog_fingerprint(self):
+        fingerprint = []
+        for table, _ in _CATALOG_TABLES:
+            row = await self.db.aquery_one(f"SELECT COUNT(*) AS row_count, MAX(id) AS max_id FROM {table}")
+            fingerprint.append((row['row_count'], row['max_id']))
+        return tuple(fingerprint)
+
+    @staticmethod
+    def _new_catalog_index(dim: int):
+        quantizer = _CATALOG_QUANTIZERS.get(os.getenv("TOROB_EMBED_DTYPE", "fp32").lower())
+        if quantizer is None:
+            return faiss.IndexFlatIP(dim)
+        return faiss.IndexScalarQuantizer(dim, getattr(faiss.ScalarQuantizer, quantizer), faiss.METRIC_INNER_PRODUCT)
+
+    async def _catalog_index(self):
+        """The shared catalog index, built once and rebuilt only when a catalog table changes"""
+        fingerprint = await self._catalog_fingerprint()
+        if _catalog_index_cache.get("fingerprint") == fingerprint:
+            return _catalog_index_cache
+        async with _catalog_index_lock:
+            if _catalog_index_cache.get("fingerprint") == fingerprint:
+                return _catalog_index_cache
+            names, ids, ranges = [], [], {}
+            for table, name_column in _CATALOG_TABLES:
+                rows = await self.db.aquery(f"SELECT id, {name_column} FROM {table}")
+                ranges[table] = (len(names), len(names) + len(rows))
+                names.extend(r[name_column] for r in rows)
+                ids.extend(r['id'] for r in rows)
+            index = None
+            if names:
+                vecs = np.ascontiguousarray(await get_shared_embedder().embed_batch(names), dtype=np.float32)
+                faiss.normalize_L2(vecs)
+                index = self._new_catalog_index(vecs.shape[1])
+                if not index.is_trained:
+                    await asyncio.to_thread(index.train, vecs)
+                await asyncio.to_thread(index.add, vecs)
+            _catalog_index_cache.update(index=index, ranges=ranges, ids=ids, names=names, fingerprint=fingerprint)
+        return _catalog_index_cache
+
+    async def _catalog_search(self, table: str, name: str):
+        """(id, name, cosine score) of the closest catalog entry of one table, or None"""
+        catalog = await self._catalog_index()
+        start, end = catalog["ranges"].get(table, (0, 0))
+        if catalog["index"] is None or start == end:
+            return None
+        query_vec = np.ascontiguousarray(await get_cached_embedder().embed_batch([name]), dtype=np.float32)
+        faiss.normalize_L2(query_vec)
+        selector = faiss.IDSelectorRange(start, end)
+        params = faiss.SearchParameters()
+        params.sel = selector
+        scores, idx = await asyncio.to_thread(catalog["index"].search, query_vec, 1, params=params)
+        position = int(idx[0, 0])
+        if position < 0:
+            return None
+        return catalog["ids"][position], catalog["names"][position], float(scores[0, 0])
+
     async def _get_base_product_id(self, product_name: str, counts: str):
         """ get base product id from product name using specific product agent"""
         # Exact match
         if counts != 1:
             try:
-                result = self.db.query(
+                result = await self.db.aquery(
                     "SELECT random_key, persian_name FROM base_products WHERE persian_name = ? LIMIT 1",
                     (product_name,)
                 )
@@ -144,7 +332,7 @@ class ExplorationAgent(FeatureProductAgent):
                 like_pattern_2 = f"%{part2}%"
                 like_pattern_3 = f"%{part3}%"
                 try:
-                    rows = self.db.query(
+                    rows = await self.db.aquery(
                         "SELECT random_key, persian_name FROM base_products "
                         "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ?",
                         (like_pattern, like_pattern_2, like_pattern_3)
@@ -190,7 +378,7 @@ class ExplorationAgent(FeatureProductAgent):
                     like_pattern = f"%{part}%"
                     like_pattern_2 = f"%{part2}%"
                     try:
-                        rows = self.db.query(
+                        rows = await self.db.aquery(
                             "SELECT random_key, persian_name FROM base_products "
                             "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ?",
                             (like_pattern, like_pattern_2)
@@ -237,42 +425,31 @@ class ExplorationAgent(FeatureProductAgent):
             
         try:
             # First try exact match in database
-            result = self.db.query(
+            result = await self.db.aquery(
                 "SELECT id FROM brands WHERE title = ? LIMIT 1",
                 (brand_name,)
             )
             if result:
                 return result[0]['id']
             
-            # If no exact match, get all brand names for semantic search
-            all_brands = self.db.query("SELECT id, title FROM brands")
-            if not all_brands:
-                return None
-                
-            brand_names = [brand['title'] for brand in all_brands]
-            brand_ids = [brand['id'] for brand in all_brands]
-            
-            # Use faiss_embedding.py for embedding similarity search
-            embedder = EmbeddingServiceWrapper()
+            # Then a full-text match; embeddings only when that finds nothing
+            fts_id = await asyncio.to_thread(self._fts_lookup, "brands", brand_name)
+            if fts_id is not None:
+                return fts_id
             
-            # Build HNSW index from brand names
-            c = await build_hnsw_from_texts(brand_names, embedder, metric='cosine', m=32, ef_construction=300, ef_search=128)
-            
-            # Search for similarity
-            hits = await semantic_search(c, [brand_name], embedder, top_k=1)
+            # If no exact match, search the brand names in the shared catalog index
+            hit = await self._catalog_search("brands", brand_name)
             
             # If similarity is more than 0.75, return the brand id
-            if hits[0][0]['score'] > 0.75:
-                best_match_index = hits[0][0]['id']
-                best_match_brand_id = brand_ids[best_match_index]
-                best_match_name = brand_names[best_match_index]
-                print(f"Found similar brand: {best_match_name} (similarity: {hits[0][0]['score']:.3f}) = ID: {best_match_brand_id}")
+            if hit and hit[2] > 0.75:
+                best_match_brand_id, best_match_name, score = hit
+                logger.info("Found similar brand: %s (similarity: %.3f) = ID: %s", best_match_name, score, best_match_brand_id)
                 return best_match_brand_id
             
             return None
             
         except Exception as e:
-            print(f"Error in _get_brand_id: {e}")
+            logger.error("Error in _get_brand_id: %s", e)
             return None
 
     async def _get_category_id(self, category_name: str):
@@ -282,13 +459,18 @@ class ExplorationAgent(FeatureProductAgent):
             
         try:
             # First try exact match in database
-            result = self.db.query(
+            result = await self.db.aquery(
                 "SELECT id FROM categories WHERE title = ? LIMIT 1",
                 (category_name,)
             )
             if result:
                 return result[0]['id']
             
+            # Then a full-text match; LIKE combinations and embeddings only when that finds nothing
+            fts_id = await asyncio.to_thread(self._fts_lookup, "categories", category_name)
+            if fts_id is not None:
+                return fts_id
+            
             # If no exact match, get all category names for semantic search
                 
             categories_word = category_name.split(" ")
@@ -296,7 +478,7 @@ class ExplorationAgent(FeatureProductAgent):
             for idx, (part, part2) in enumerate(itertools.combinations(categories_word, 2)):
                 a = f"%{part}%"
                 b = f"%{part2}%"
-                result = self.db.query(
+                result = await self.db.aquery(
                     "SELECT id, title FROM categories WHERE title LIKE ? AND title LIKE ?  LIMIT 5",
                     (a, b)
                 )
@@ -316,7 +498,7 @@ class ExplorationAgent(FeatureProductAgent):
 
             for idx, (part) in enumerate(itertools.combinations(categories_word, 1)):
                 a = f"%{part}%"
-                result = self.db.query(
+                result = await self.db.aquery(
                     "SELECT id, title FROM categories WHERE title LIKE ? LIMIT 5",
                     (a,)
                 )
@@ -336,7 +518,7 @@ class ExplorationAgent(FeatureProductAgent):
             return None
             
         except Exception as e:
-            print(f"Error in _get_category_id: {e}")
+            logger.error("Error in _get_category_id: %s", e)
             return None
 
     async def _get_city_id(self, city_name: str):
@@ -346,41 +528,30 @@ class ExplorationAgent(FeatureProductAgent):
             
         try:
             # First try exact match in database
-            result = self.db.query(
+            result = await self.db.aquery(
                 "SELECT id FROM cities WHERE name = ? LIMIT 1",
                 (city_name,)
             )
             if result:
                 return result[0]['id']
             
-            # If no exact match, get all city names for semantic search
-            all_cities = self.db.query("SELECT id, name FROM cities")
-            if not all_cities:
-                return None
-                
-            city_names = [city['name'] for city in all_cities]
-            city_ids = [city['id'] for city in all_cities]
-            
-            # Use faiss_embedding.py for embedding similarity search
-            embedder = EmbeddingServiceWrapper()
-            
-            # Build HNSW index from city names
-            c = await build_hnsw_from_texts(city_names, embedder, metric='cosine', m=32, ef_construction=300, ef_search=128)
+            # Then a full-text match; embeddings only when that finds nothing
+            fts_id = await asyncio.to_thread(self._fts_lookup, "cities", city_name)
+            if fts_id is not None:
+                return fts_id
             
-            # Search for similarity
-            hits = await semantic_search(c, [city_name], embedder, top_k=1)
+            # If no exact match, search the city names in the shared catalog index
+            hit = await self._catalog_search("cities", city_name)
             
             # If similarity is more than 0.75, return the city id
-            if hits[0][0]['score'] > 0.75:
-                best_match_index = hits[0][0]['id']
-                best_match_city_id = city_ids[best_match_index]
-                best_match_name = city_names[best_match_index]
-                print(f"Found similar city: {best_match_name} (similarity: {hits[0][0]['score']:.3f}) = ID: {best_match_city_id}")
+            if hit and hit[2] > 0.75:
+                best_match_city_id, best_match_name, score = hit
+                logger.info("Found similar city: %s (similarity: %.3f) = ID: %s", best_match_name, score, best_match_city_id)
                 return best_match_city_id
             
             return None
         except Exception as e:
-            print(f"Error in _get_city_id: {e}")
+            logger.error("Error in _get_city_id: %s", e)
             return None
 
     # async def _get_features(self, features: list):
@@ -390,99 +561,20 @@ class ExplorationAgent(FeatureProductAgent):
     def _update_exploration_table(self, chat_id, count, base_product_id, product_name_old, city_id, brand_id, cetegory_id,  lowest_price, highest_price, has_warranty, score):
         """ update exploration table if each value is not None"""
         try:
-            # Build the update query dynamically based on which values are not None
-            update_fields = []
-            update_values = []
-            
-            # Always update counts
-            update_fields.append("counts = ?")
-            update_values.append(count)
-            
-            # Update base_product_id if provided
-            if base_product_id is not None:
-                update_fields.append("base_random_key = ?")
-                update_values.append(base_product_id)
-            
-            # Update brand_id if provided
-            if brand_id is not None:
-                update_fields.append("brand_name = ?")
-                update_values.append(brand_id)
-
-            if city_id is not None:
-                update_fields.append("city_id = ?")
-                update_values.append(city_id)
-
-            # Update category_id if provided (note: parameter name has typo but keeping it consistent)
-            if cetegory_id is not None:
-                update_fields.append("category_name = ?")
-                update_values.append(cetegory_id)
-
-            if product_name_old is not None:
-                update_fields.append("product_name = ?")
-                update_values.append(product_name_old)
-            
-            # Update extra_features if provided
-            # if extra_features is not None:
-            #     update_fields.append("extra_features = ?")
-            #     update_values.append(extra_features)
-            
-            # Update lower_price if provided
-            if lowest_price is not None:
-                update_fields.append("lower_price = ?")
-                update_values.append(lowest_price)
-            
-            # Update upper_price if provided
-            if highest_price is not None:
-                update_fields.append("upper_price = ?")
-                update_values.append(highest_price)
-            
-            # Update has_warranty if provided
-            if has_warranty is not None:
-                update_fields.append("has_warranty = ?")
-                update_values.append(has_warranty)
-            
-            # Update score if provided
-            if score is not None:
-                update_fields.append("score = ?")
-                update_values.append(score)
-            
-            # Add chat_id for WHERE clause
-            update_values.append(chat_id)
-            
-            # Build and execute the update query
-            if update_fields:
-                query = f"UPDATE exploration SET {', '.join(update_fields)} WHERE chat_id = ?"
-                self.db.execute(query, update_values)
-                print(f"Updated exploration table for chat_id: {chat_id}")
-            else:
-                print(f"No fields to update for chat_id: {chat_id}")
+            # counts is always written; every other column keeps its stored value when None
+            self.db.execute(
+                _SQL_UPDATE_EXPLORATION,
+                (count, base_product_id, brand_id, city_id, cetegory_id, product_name_old,
+                 lowest_price, highest_price, has_warranty, score, chat_id)
+            )
+            logger.debug("Updated exploration table for chat_id: %s", chat_id)
                 
         except Exception as e:
-            print(f"Error updating exploration table: {e}")
+            logger.error("Error updating exploration table: %s", e)
 
     async def _generate_response_text(self, base_product_id, city_id, brand_id, cetegory_id,  lowest_price, highest_price, has_warranty, score, count):
-        prompt = "حتما می خواهیم با هم دیگر پرسخ و پاسخ داشته باشیم تا بتوانیم محصول مورد نظر شما پیدا کنیم."
-        name_prompt= ["برای پاسخگویی متن نام دقیق محصول را وارد کنید.","لطفا نام دقیق محصول همراه با نام مدل و جزئیات درون نام را وارد کنید"]
-        city_prompt= ["نام شهری که می خواهید از ان محصول را تهیه کنید را وارد کنید.","لطفا نام شهر را وارد کنید"]
-        brand_prompt= ["نام برند اگر مد نظر هست حتما وارد کنید.","لطفا نام برند را وارد کنید"]
-        category_prompt= ["اگر دسته بندی خواستی مد نظر هست حتما وارد کنید.","لطفا نام دسته بندی را وارد کنید"]
-        feature_prompt= ["برای پاسخگویی متن ویژگی های محصول را وارد کنید.","لطفا ویژگی های محصول را وارد کنید"]
-        price_prompt= ["اگر بازه قیمتی در نظر دارید حتما به صورت دقیق وارد کنید.","لطفا بازه قیمت را وارد کنید"]
-        warranty_prompt= ["لطفا اگر ضمانت کالا برای تان مهم هست اشاره کنید.","لطفا اگر دوست دارید محصول مورد نظر ضمانت داشته باشد اشاره کنید"]
-        ## for each prompt select random one from list and join them to main prompt
-        _prompt = "ممنون بایت اطلاعات مفید که در اختیار بنده قرار دادید."
-        if count == 1:
-            _prompt = "اگر می توانید نام کامل محصول و ویژگی هایی که این  محصول دارد و همین طور اگر این محصول مدلی دارد یا کد مخصوصی دارد در اختیار من بگذارید." + category_prompt[0]
-        if count == 2:
-            _prompt = "نام شهری که می خواهید از ان محصول را تهیه کنید را وارد کنید."
-        if count == 3:
-            _prompt = "ایا نام برندی خاصی مد نظر شما هست. لطفا اگر دوست دارید محصول مورد نظر ضمانت داشته باشد اشاره کنید. امتیاز فروشنده چقدر باشد؟"
-        if count == 4:
-            _prompt = ".اگر داخل نام محصول مورد نظر کد یا مدل محصول وجود دارد لطفا بیان کنید. اگر بازه قیمتی مد نظر شما حد پایین و حد بالا ان را وارد کنید. امتیاز فروشنده چقدر باشد؟"
-        if count == 5:
-            _prompt = "می خواهم درون پایگاه داده جست و جو انجام دهم ایا اطلاعاتی باقی مانده که مد نظرتان باشد هست که گفته نشده ممنون می شم اگر اطلاعاتی باقی مانده اعلام کنید."
-        prompt = prompt + _prompt
-        print(prompt)
+        prompt = _RESPONSE_INTRO + _RESPONSE_BY_TURN.get(count, _RESPONSE_DEFAULT)
+        logger.debug("Exploration prompt for turn %s: %s", count, prompt)
         return prompt
 
     def _get_member_random_keys(self, product_name, city_id, brand_name, cetegory_name, extra_features, lowest_price, highest_price, has_warranty, score, count):
@@ -563,62 +655,15 @@ class ExplorationAgent(FeatureProductAgent):
 
             if part_candidates:
                 for candidate in part_candidates:
-                    # Build the query dynamically based on available parameters
-                    query_parts = []
-                    query_values = []
-
-                    # Base query with JOINs to access related tables
-                    base_query = """
-                        SELECT DISTINCT m.random_key 
-                        FROM members m
-                        JOIN base_products bp ON m.base_random_key = bp.random_key
-                        JOIN shops s ON m.shop_id = s.id
-                        WHERE 1=1
-                    """
-
-                    # Add base_product_id filter if available
-                    query_parts.append("m.base_random_key = ?")
-                    query_values.append(candidate["random_key"])
-
-                    # Add city_id filter through shops table
-                    if city_id is not None:
-                        query_parts.append("s.city_id = ?")
-                        query_values.append(city_id)
-
-
-                    # Add price range filters
-                    if lowest_price is not None:
-                        query_parts.append("m.price >= ?")
-                        query_values.append(lowest_price)
-
-                    if highest_price is not None:
-                        query_parts.append("m.price <= ?")
-                        query_values.append(highest_price)
-
-                    # Add warranty filter through shops table
-                    if has_warranty is not None:
-                        query_parts.append("s.has_warranty = ?")
-                        query_values.append(has_warranty)
-
-                    # Add score filter through shops table
-                    if score is not None:
-                        query_parts.append("s.score >= ?")
-                        query_values.append(score)
-
-                    # Build the complete query
-                    if query_parts:
-                        complete_query = base_query + " AND " + " AND ".join(query_parts)
-                    else:
-                        complete_query = base_query
-
-                    # Add ORDER BY for consistent results (by price ascending, then by random_key)
-                    complete_query += " ORDER BY m.price ASC, m.random_key ASC"
-
-                    # Execute the query
-                    result = self.db.query(complete_query, query_values)
+                    # Execute the query (fixed SQL text; unset filters are bound as NULL)
+                    result = self.db.query(
+                        _SQL_MEMBER_SEARCH,
+                        (candidate["random_key"], city_id, city_id, lowest_price, lowest_price,
+                         highest_price, highest_price, has_warranty, has_warranty, score, score)
+                    )
                     if result:
                         if len(result) == 1:
-                            print(candidate["persian_name"])
+                            logger.debug("Exploration member found via %s", candidate["persian_name"])
                             return result[0]["random_key"]
 
 
@@ -626,23 +671,30 @@ class ExplorationAgent(FeatureProductAgent):
 
 
     async def process_query(self, query: str, chat_id) -> Response:
-        chat_id, count, base_product_id, product_name_old, city_id, brand_name_old,  category_name_old, lowest_price_old, highest_price_old, has_warranty_old, score_old = self._get_chat_history(chat_id)
+        # The synchronous DB helpers run in worker threads so the event loop stays free
+        chat_id, count, base_product_id, product_name_old, city_id, brand_name_old,  category_name_old, lowest_price_old, highest_price_old, has_warranty_old, score_old = await asyncio.to_thread(self._get_chat_history, chat_id)
         if count <= 5:
-            product_name, city_name, brand_name, category_name, features, lowest_price, highest_price, has_warranty, score = await self._extract_info_from_query(query)
+            # Every turn is extracted, even with all slots filled, so a later message can
+            # correct an earlier answer; non-empty values replace the stored ones below
+            cache_key = (chat_id, os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini", count, base_product_id, product_name_old, city_id, brand_name_old,
+                         category_name_old, lowest_price_old, highest_price_old, has_warranty_old, score_old, " ".join(query.split()))
+            cached = _response_cache.get(cache_key)
+            if cached is not None:
+                update_row, response = cached
+                if update_row is not None:
+                    await asyncio.to_thread(self._update_exploration_table, chat_id, *update_row)
+                return response.model_copy(deep=True)
+            extracted = await self._extract_info_from_query(query)
+            product_name, city_name, brand_name, category_name, features, lowest_price, highest_price, has_warranty, score = extracted
             if product_name:
                 product_name_old = product_name
-                # product_name_old = product_name
-                # base_product_id_new = await self._get_base_product_id(product_name, count)
-                # if base_product_id_new:
-                #     base_product_id = base_product_id_new
-            if city_name and not city_id:
-                city_id = await self._get_city_id(city_name)
+            if city_name:
+                # brand and category are filtered by name downstream; only the city needs an id
+                city_id = await self._get_city_id(city_name) or city_id
             if brand_name:
                 brand_name_old = brand_name
-            if category_name_old:
+            if category_name:
                 category_name_old = category_name
-            # if features:
-            #     extra_features = await self._get_features(features)
             if lowest_price:
                 lowest_price_old = lowest_price
             if highest_price:
@@ -653,18 +705,23 @@ class ExplorationAgent(FeatureProductAgent):
                 score_old = score
             extra_features = {}
             if count >= 4:
-                result = self._get_member_random_keys(product_name_old, city_id, brand_name, category_name, extra_features, lowest_price_old,
+                result = await asyncio.to_thread(self._get_member_random_keys, product_name_old, city_id, brand_name, category_name, extra_features, lowest_price_old,
                                          highest_price_old, has_warranty_old, score_old, count)
                 if result:
                 # if found member return it
-                    return Response(message="null", base_random_keys=[], member_random_keys=[result])
-            self._update_exploration_table(chat_id, count+1, base_product_id, product_name_old, city_id, brand_name_old, category_name_old, lowest_price_old, highest_price_old, has_warranty_old, score_old)
+                    response = Response(message="null", base_random_keys=[], member_random_keys=[result])
+                    _response_cache.set(cache_key, (None, response.model_copy(deep=True)))
+                    return response
+            update_row = (count+1, base_product_id, product_name_old, city_id, brand_name_old, category_name_old, lowest_price_old, highest_price_old, has_warranty_old, score_old)
+            await asyncio.to_thread(self._update_exploration_table, chat_id, *update_row)
             response_text = await self._generate_response_text(base_product_id, city_id, brand_name_old, category_name_old, lowest_price_old, highest_price_old, has_warranty_old, score_old, count)
-            return Response(message=response_text, base_random_keys=[], member_random_keys=[])
+            response = Response(message=response_text, base_random_keys=[], member_random_keys=[])
+            _response_cache.set(cache_key, (update_row, response.model_copy(deep=True)))
+            return response
         else:
             # after 5 times try to find the member
             extra_features = {}
-            member_random_keys = self._get_member_random_keys(base_product_id, city_id, brand_name_old, category_name_old, extra_features, lowest_price_old, highest_price_old, has_warranty_old, score_old, count)
+            member_random_keys = await asyncio.to_thread(self._get_member_random_keys, base_product_id, city_id, brand_name_old, category_name_old, extra_features, lowest_price_old, highest_price_old, has_warranty_old, score_old, count)
             if member_random_keys:
                 return Response(message="", base_random_keys=[], member_random_keys=[member_random_keys])
             else:
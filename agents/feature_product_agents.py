@@ -1,22 +1,239 @@
 import asyncio
-import json
+import hashlib
+import logging
 import os
 from typing import Dict, Any
 from langchain.prompts import PromptTemplate
 from response_format import Response
 import dotenv
-from embedding.faiss_embedding import EmbeddingServiceWrapper, build_hnsw_from_texts, semantic_search
+import json_utils
+from embedding.faiss_embedding import build_hnsw_from_texts, get_shared_embedder, semantic_search
+from cache_utils import LRUCache
 from agents.specific_product_agent import SpecificProductAgent
 from system_prompts.product_features_system_prompts import system_msg_extracting_product_features, samples_extracting_product_features
-from features_list import features_dict
+from features_list import features_dict, persian_to_eng_features
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# What extraction reports when the query names no feature
+_UNKNOWN_FEATURES = ["ویژگی نامشخص"]
+_UNKNOWN_PRODUCT = "نامشخص"
+_NO_FEATURE_MESSAGE = "سوال شامل ویژگی مشخصی نیست."
+
+# Default extraction template, compiled once and shared by every agent instance
+DEFAULT_PROMPT_TEMPLATE = PromptTemplate(
+    input_variables=["query"],
+    template="از متن زیر نام محصول و ویژگی‌های خواسته‌شده را استخراج کن و فقط خروجی را به صورت JSON زیر بده:\n{\"product_name\": ..., \"features\": [...]}\nمتن: {{ query }}",
+    template_format="jinja2"
+)
+
+# HNSW index over the Persian feature names. features_dict is static, so the
+# index is built once on first use and shared by every agent instance.
+_feature_index = None
+_feature_index_lock = asyncio.Lock()
+
+# Static prompt prefixes: the instructions and examples of each call are fixed,
+# so they form the whole system message and only the request-specific text goes
+# in the user message. The provider's prompt cache can then reuse the prefix.
+_EXTRACTION_FEW_SHOT_BLOCK = "\n\n".join(
+    f"مثال:\nپرسش: {s['input']}\nخروجی JSON:\n" +
+    json_utils.dumps({
+        "product_name": s["نام محصول"],
+        "features": s["ویژگی‌ها"]
+    })
+    for s in samples_extracting_product_features
+)
+_EXTRACTION_SYSTEM_PROMPT = f"{system_msg_extracting_product_features}\n\n{_EXTRACTION_FEW_SHOT_BLOCK}"
+# Strict schema: the reply always parses and always has both fields with the right types
+_EXTRACTION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "product_query",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "product_name": {"type": "string"},
+                "features": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["product_name", "features"],
+            "additionalProperties": False
+        }
+    }
+}
+
+_TRANSLATE_AND_MATCH_SYSTEM_PROMPT = """تو یک متخصص ترجمه و تطبیق ویژگی‌های محصولات هستی.
+
+قوانین ترجمه:
+۱. هر ویژگی فارسی را به انگلیسی ترجمه کن
+۲. از اصطلاحات فنی استاندارد و برای ترکیبات از underscore استفاده کن (مثل: energy_consumption)
+
+قوانین تطبیق:
+۱. ترجمه‌ها را با ویژگی‌های موجود در دیکشنری محصول مقایسه کن و بهترین تطبیق را پیدا کن (حتی اگر ۷۰٪ مشابه باشد)
+۲. فقط نام انگلیسی ویژگی از دیکشنری را به عنوان تطبیق برگردان
+۳. اگر هیچ تطبیقی وجود ندارد null برگردان
+
+خروجی فقط یک JSON به این شکل باشد:
+{"translations": ["<english_feature>", ...], "match": "<feature_key_or_null>"}"""
+
+
+async def _get_feature_index():
+    """(index, embedder, persian_feature_names) for the feature-name similarity search"""
+    global _feature_index
+    if _feature_index is None:
+        async with _feature_index_lock:
+            if _feature_index is None:
+                embedder = get_shared_embedder()
+                persian_feature_names = list(features_dict.values())
+                # A dictionary of a few hundred names needs a far sparser graph and a
+                # shorter search list than the defaults tuned for large indexes
+                if len(persian_feature_names) < 200:
+                    hnsw_params = dict(m=8, ef_construction=64, ef_search=16)
+                else:
+                    hnsw_params = dict(m=32, ef_construction=300, ef_search=128)
+                index = await build_hnsw_from_texts(persian_feature_names, embedder, metric='cosine', **hnsw_params)
+                _feature_index = (index, embedder, persian_feature_names)
+    return _feature_index
+
+
+class _LLMCache:
+    """
+    Exact-match cache of chat completions. The key is the sha256 of the whole
+    (model, messages, options) payload and the value is the reply text, so it
+    is only used for calls made with temperature=0.
+    """
+
+    def __init__(self, maxsize: int = 5000):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    @staticmethod
+    def _key(model, messages, options) -> str:
+        payload = json_utils.dumps({"model": model, "messages": messages, "options": options}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def call(self, client, model, messages, **options) -> str:
+        key = self._key(model, messages, options)
+        content = self._cache.get(key)
+        if content is None:
+            response = await client.chat.completions.create(model=model, messages=messages, **options)
+            content = response.choices[0].message.content
+            if content is not None:
+                self._cache.set(key, content)
+        return content
+
+
+_llm_cache = _LLMCache()
+
+_SQL_GET_EXTRA_FEATURES = "SELECT extra_features FROM base_products WHERE random_key = ? LIMIT 1"
+# random_key -> (raw extra_features JSON, parsed dict); one SQL + json parse per
+# product, shared by the feature, comparison and exploration agents
+_extra_features_cache = LRUCache(maxsize=4096)
+
+
+def _feature_key_tokens(feature_keys):
+    """({lowercase key: key}, [(key, set of its '_'-separated words)]) for a set of feature keys"""
+    lowered = {}
+    tokens = []
+    for key in feature_keys:
+        key_lc = key.lower()
+        lowered.setdefault(key_lc, key)
+        tokens.append((key, frozenset(filter(None, key_lc.split('_')))))
+    return lowered, tokens
+
+
+# features_dict is static, so its lookup tables are built once; the keys of a
+# product's extra_features are indexed per call
+_FEATURES_LC, _FEATURES_TOKENS = _feature_key_tokens(features_dict)
+
+
+def _closest_feature_key(name, feature_keys):
+    """
+    Closest key to an English feature name: a case-insensitive exact match,
+    otherwise the highest Jaccard similarity of their words; None at 0.3 or below
+    """
+    if feature_keys is features_dict:
+        lowered, tokens = _FEATURES_LC, _FEATURES_TOKENS
+    else:
+        lowered, tokens = _feature_key_tokens(feature_keys)
+
+    name_lc = name.lower().replace(' ', '_')
+    if name_lc in lowered:
+        return lowered[name_lc]
+    name_tokens = set(filter(None, name_lc.split('_')))
+    if not name_tokens:
+        return None
+
+    best_match = None
+    best_score = 0
+    for eng_key, key_tokens in tokens:
+        score = len(name_tokens & key_tokens) / len(name_tokens | key_tokens)
+        if score > best_score:
+            best_match = eng_key
+            best_score = score
+
+    return best_match if best_score > 0.3 else None
 
 
 class FeatureProductAgent(SpecificProductAgent):
-    def __init__(self, prompt_template: PromptTemplate, db_path: str | None = None):
-        # Properly initialize parent so we have self.prompt_template, self.client, etc.
-        super().__init__(prompt_template, db_path)
+    def __init__(self, prompt_template: PromptTemplate | None = None, db_path: str | None = None):
+        # Properly initialize parent so we have self.client, self.db, etc.
+        super().__init__(db_path)
+        self.prompt_template = prompt_template or DEFAULT_PROMPT_TEMPLATE
+
+    def _load_extra_features(self, product_random_key):
+        """
+        (raw JSON, parsed dict) of a product's extra_features, memoized by random_key.
+        Returns (None, {}) when the product is missing. The dict is shared: don't mutate it.
+        """
+        if not product_random_key:
+            return None, {}
+        cached = _extra_features_cache.get(product_random_key)
+        if cached is not None:
+            return cached
+            
+        try:
+            row = self.db.query_one(_SQL_GET_EXTRA_FEATURES, (product_random_key,))
+            if row is None or not row['extra_features']:
+                return None, {}
+            raw = row['extra_features']
+            loaded = (raw, json_utils.loads(raw))
+            _extra_features_cache.set(product_random_key, loaded)
+            return loaded
+        except Exception as e:
+            logger.error("Error getting extra features: %s", e)
+            return None, {}
+
+    def _load_extra_features_many(self, keys):
+        """
+        {random_key: (raw JSON, parsed dict)} for several products; the ones not
+        memoized yet are read with a single IN query. Missing products map to (None, {}).
+        """
+        keys = list(dict.fromkeys(k for k in keys if k))
+        loaded = {}
+        missing = []
+        for key in keys:
+            cached = _extra_features_cache.get(key)
+            if cached is not None:
+                loaded[key] = cached
+            else:
+                missing.append(key)
+        if missing:
+            try:
+                placeholders = ",".join("?" * len(missing))
+                rows = self.db.query(
+                    f"SELECT random_key, extra_features FROM base_products WHERE random_key IN ({placeholders})",
+                    missing
+                )
+                for row in rows:
+                    if row['random_key'] in loaded or not row['extra_features']:
+                        continue
+                    entry = (row['extra_features'], json_utils.loads(row['extra_features']))
+                    _extra_features_cache.set(row['random_key'], entry)
+                    loaded[row['random_key']] = entry
+            except Exception as e:
+                logger.error("Error getting extra features: %s", e)
+        return {key: loaded.get(key, (None, {})) for key in keys}
 
     async def _extract_product_name_and_features(self, query: str) -> Dict[str, Any]:
         """
@@ -26,128 +243,101 @@ class FeatureProductAgent(SpecificProductAgent):
         if not query or not query.strip():
             return {"product_name": "نامشخص", "features": ["ویژگی نامشخص"]}
 
-        system_msg = system_msg_extracting_product_features
-        samples = samples_extracting_product_features
-
-        few_shot_parts = []
-        for s in samples:
-            few_shot_parts.append(
-                f"مثال:\nپرسش: {s['input']}\nخروجی JSON:\n" +
-                json.dumps({
-                    "product_name": s["نام محصول"],
-                    "features": s["ویژگی‌ها"]
-                }, ensure_ascii=False)
-            )
-        few_shot_block = "\n\n".join(few_shot_parts)
-
         try:
             rendered = self.prompt_template.format(query=query)
             user_content = (
-                f"{few_shot_block}\n\nپرسش کاربر جدید:\n{rendered}\n\n"
+                f"پرسش کاربر جدید:\n{rendered}\n\n"
                 "فقط JSON نهایی را بده."
             )
         except Exception:
             user_content = (
-                f"{few_shot_block}\n\nپرسش کاربر جدید:\n{query}\n\n"
+                f"پرسش کاربر جدید:\n{query}\n\n"
                 "فقط JSON نهایی را بده."
             )
 
         try:
-            # Call the LLM API
-            response = await self.client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {"role": "system", "content": system_msg},
+            # Call the LLM API; repeats of the same query (and prompt template, which is
+            # part of the rendered message) are answered from the exact-key cache
+            llm_response = await _llm_cache.call(
+                self.client,
+                "gpt-4.1-mini",
+                [
+                    {"role": "system", "content": _EXTRACTION_SYSTEM_PROMPT},
                     {"role": "user", "content": user_content}
                 ],
+                temperature=0,
+                # A small JSON; Persian product names take more tokens than the ~80 an English reply would
+                max_tokens=128,
+                response_format=_EXTRACTION_RESPONSE_FORMAT
             )
-            
-            # Extract the JSON response
-            llm_response = response.choices[0].message.content.strip()
-            
-            # Parse JSON response
-            try:
-                result = json.loads(llm_response)
-                # Validate the response structure
-                if "product_name" not in result or "features" not in result:
-                    return {"product_name": "نامشخص", "features": ["ویژگی نامشخص"]}
-                
-                # Ensure features is a list
-                if not isinstance(result["features"], list):
-                    result["features"] = ["ویژگی نامشخص"]
-                
-                # Ensure product_name is not empty
-                if not result["product_name"] or not result["product_name"].strip():
-                    result["product_name"] = "نامشخص"
-                
-                return result
-                
-            except json.JSONDecodeError:
-                # If JSON parsing fails, return default values
-                return {"product_name": "نامشخص", "features": ["ویژگی نامشخص"]}
-                
+            # The schema guarantees the shape; only a refusal (no content) fails here
+            result = json_utils.loads(llm_response)
         except Exception as e:
-            print(f"Error calling LLM API: {e}")
+            logger.error("Error calling LLM API: %s", e)
             return {"product_name": "نامشخص", "features": ["ویژگی نامشخص"]}
 
+        # The schema allows an empty string; ensure product_name is not empty
+        if not result["product_name"].strip():
+            result["product_name"] = _UNKNOWN_PRODUCT
+        return result
+
+    async def _similar_feature_names(self, product_features, top_k=3):
+        """
+        The top_k Persian feature names most similar to the requested features,
+        as [(name, score)] best first, from the shared index; [] on error
+        """
+        try:
+            c, embedder, persian_feature_names = await _get_feature_index()
+            requested_features_text = " ".join(product_features)
+
+            # Search for similarity
+            hits = await semantic_search(c, [requested_features_text], embedder, top_k=top_k)
+            return [(persian_feature_names[hit['id']], hit['score']) for hit in hits[0] if hit['id'] >= 0]
+        except Exception as e:
+            logger.error("Error in embedding similarity search: %s", e)
+            return []
+
     async def _search_features(self, product_result_random_key, product_features, product_name=None):
+        if not product_features or product_features == _UNKNOWN_FEATURES:
+            return None
+        # The similarity search needs only the requested features, so it runs while
+        # the product row is read; it is cancelled if the exact-name pass finds the feature
+        similar_task = asyncio.ensure_future(self._similar_feature_names(product_features))
         try:
-            result = self.db.query(
-                "SELECT extra_features FROM base_products WHERE random_key = ? LIMIT 1",
-                (product_result_random_key,)
-            )
-            if result:
-                product_data = dict(result[0])
-                extra_features_str = product_data['extra_features']
-                extra_features_dict = json.loads(extra_features_str)
-                for feature in product_features:
-                    for eng_feature in extra_features_dict.keys():
-                        # Extract search in features_dict to see persian name of feature is here report it not all them are do embedding search
-                        if eng_feature in features_dict:
-                            persian_feature_name = features_dict[eng_feature]
-                            # Check if this Persian feature name matches any of the requested features
-                            for requested_feature in product_features:
-                                if persian_feature_name in requested_feature or requested_feature in persian_feature_name:
-                                    feature_value = extra_features_dict[eng_feature]
-                                    print(f"Found exact match: {persian_feature_name} = {feature_value}")
-                                    return feature_value
-                        
-                        # If feature not found, do embedding search similarity with features and persian name in feature dict
-                        try:
-                            # Get all Persian feature names from features_dict
-                            persian_feature_names = list(features_dict.values())
-                            
-                            # Use faiss_embedding.py for embedding similarity search
-                            embedder = EmbeddingServiceWrapper()
-                            requested_features_text = " ".join(product_features)
-                            
-                            # Build HNSW index from Persian feature names
-                            c = await build_hnsw_from_texts(persian_feature_names, embedder, metric='cosine', m=32, ef_construction=300, ef_search=128)
-                            
-                            # Search for similarity
-                            hits = await semantic_search(c, [requested_features_text], embedder, top_k=1)
-                            
-                            # If similarity is more than 0.75, report the value of the feature
-                            if hits[0][0]['score'] > 0.75:
-                                best_match_index = hits[0][0]['id']
-                                best_match = persian_feature_names[best_match_index]
-                                
-                                # Find the English key for this Persian feature name
-                                eng_key = None
-                                for eng_key, persian_value in features_dict.items():
-                                    if persian_value == best_match:
-                                        eng_key = eng_key
-                                        break
-                                
-                                if eng_key and eng_key in extra_features_dict:
-                                    feature_value = extra_features_dict[eng_key]
-                                    print(f"Found similar match: {best_match} (similarity: {hits[0][0]['score']:.3f}) = {feature_value}")
-                                    return feature_value
-                        except Exception as e:
-                            print(f"Error in embedding similarity search: {e}")
-                            continue
-                        
-                        # If nothing found, continue to next feature
+            # Parsed once per product and memoized; only a miss pays for the hop to a
+            # worker thread, where the DB read runs
+            loaded = _extra_features_cache.get(product_result_random_key)
+            if loaded is None:
+                loaded = await asyncio.to_thread(self._load_extra_features, product_result_random_key)
+            extra_features_str, extra_features_dict = loaded
+            if extra_features_str:
+                # Persian names of the product's keys that features_dict knows, found in one pass;
+                # each requested feature is then matched against them by substring
+                persian_candidates = [(features_dict[eng_feature], eng_feature) for eng_feature in extra_features_dict if eng_feature in features_dict]
+                for requested_feature in product_features:
+                    for persian_feature_name, eng_feature in persian_candidates:
+                        if persian_feature_name in requested_feature or requested_feature in persian_feature_name:
+                            feature_value = extra_features_dict[eng_feature]
+                            logger.debug("Found exact match: %s = %s", persian_feature_name, feature_value)
+                            return feature_value
+
+                # If feature not found, use the embedding search similarity with features and persian name in feature dict
+                # The best hit may name a feature this product doesn't have, so the
+                # top hits are tried in order
+                for best_match, score in await similar_task:
+                    # If similarity is more than 0.75, report the value of the feature
+                    if score <= 0.75:
+                        break
+
+                    # Find the English key for this Persian feature name
+                    eng_key = persian_to_eng_features.get(best_match)
+
+                    if eng_key and eng_key in extra_features_dict:
+                        feature_value = extra_features_dict[eng_key]
+                        logger.debug("Found similar match: %s (similarity: %.3f) = %s", best_match, score, feature_value)
+                        return feature_value
+
+                # If nothing found, ask the LLM
                 feature_value_name = await self._find_features_with_llm(product_result_random_key,
                                                                    product_features,
                                                                    extra_features_dict, product_name)
@@ -159,149 +349,83 @@ class FeatureProductAgent(SpecificProductAgent):
 
 
         except Exception as e:
-            print(f"Error in feature extraction: {e}")
+            logger.error("Error in feature extraction: %s", e)
             return None
+        finally:
+            if not similar_task.done():
+                similar_task.cancel()
 
 
-    async def translation_features_to_english(self, product_features, product_name=None):
-        """ ask the llm to translate the persian feature name to english based on category type of product use the feature_dict as a sample"""
-            
+    async def _translate_and_match(self, product_features, extra_features_dict, product_name=None):
+        """
+        Translate the requested Persian features to English and pick the closest
+        key of extra_features_dict, in a single LLM call. Returns the key or None.
+        """
+        if not product_features or not extra_features_dict:
+            return None
+
         try:
-            # Create feature dictionary samples for context
-            feature_samples = []
-            for eng_key, persian_value in list(features_dict.items())[:10]:  # Use first 10 as samples
-                feature_samples.append(f"{eng_key}: {persian_value}")
-            feature_samples_str = "\n".join(feature_samples)
-            
-            system_msg = f"""کلمه گقته شده را به انگلیسی بیان کن: این کلمه یک ویژگی محصول است.
+            feature_keys_str = "\n".join(extra_features_dict.keys())
 
-            محصول مورد نظر: {product_name if product_name else 'نامشخص'}
-            
-            در بخش زیر نمونه هایی اورده شده است:
-            {feature_samples_str}
-            
-            قوانین ترجمه:
-            ۱.  ویژگی فارسی را به انگلیسی ترجمه کن
-            ۲. از اصطلاحات فنی استاندارد استفاده کن
-            ۳. برای ترکیبات، از underscore استفاده کن (مثل: energy_consumption)
-            ۴. فقط نام انگلیسی ویژگی را برگردان
-            ۵. هر ویژگی را در یک خط جداگانه بنویس
-            ۶. اگر ترجمه دقیق نمی‌دانی، بهترین حدس خود را بزن
-            ۷. از کلمات ساده و قابل فهم استفاده کن"""
-            
-            user_content = f"""کلمه ای که قرار است ترجمه کنی.
-            {', '.join(product_features)}
-            
-             
-             لطفاً این ویژگی‌ را به انگلیسی ترجمه کن:
-            بسیار مهم: خر.جی حتما باید به صورت یک کلمه انگلیسی که ترجمه کلمه گفته شده می باشد.
-            """
-            
-            response = await self.client.chat.completions.create(
-                model=os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_msg},
-                    {"role": "user", "content": user_content}
-                ]
-            )
-            
-            # Parse the response and split by lines
-            translated_features = response.choices[0].message.content.strip().split('\n')
-            # Clean up each feature
-            translated_features = [feature.strip() for feature in translated_features if feature.strip()]
-            
-            return translated_features
-            
-        except Exception as e:
-            print(f"Error translating features: {e}")
-            return product_features  # Return original if translation fails
+            user_content = f"""محصول مورد نظر: {product_name if product_name else 'نامشخص'}
 
-    async def find_feature_name(self, product_features_english_translation, features_dict, product_name=None):
-        """ ask the llm to based on feature dict find the most similar feature name in the feature dict and return it if not found return None the outout must bne just """
-        # if not product_features_english_translation or not features_dict:
-        #     return None
-            
-        try:
-            # Create feature dictionary samples for context
-            feature_samples = []
-            for eng_key, persian_value in list(features_dict.items())[:15]:  # Use first 15 as samples
-                feature_samples.append(f"{eng_key}: {persian_value}")
-            feature_samples_str = "\n\n".join(feature_samples)
-            
-            system_msg = f"""تو یک متخصص تطبیق ویژگی‌های محصولات هستی.
+            ویژگی‌های موجود در دیکشنری محصول:
+            {feature_keys_str}
 
-            محصول مورد نظر: {product_name if product_name else 'نامشخص'}
-            
-            ویژگی‌های موجود در دیکشنری:
-            {feature_samples_str}
-            
-            قوانین تطبیق:
-            ۱. ویژگی‌های ترجمه شده را با ویژگی‌های موجود در دیکشنری مقایسه کن
-            ۲. بهترین تطبیق را پیدا کن (حتی اگر ۷۰٪ مشابه باشد)
-            ۳. فقط نام انگلیسی ویژگی از دیکشنری را برگردان
-            ۴. اگر تطبیق مناسبی پیدا نکردی، نزدیک‌ترین مورد را انتخاب کن
-            ۵. هیچ توضیح اضافی نده
-            ۶. حتماً یک پاسخ بده، حتی اگر مطمئن نیستی
-            
-            مثال:
-            اگر ویژگی "resolution" ترجمه شده و در دیکشنری "display_resolution" وجود دارد، "display_resolution" را برگردان"""
-            
-            user_content = f"""ویژگی‌های ترجمه شده برای تطبیق:
-            {', '.join(product_features_english_translation)}
-            
-            لطفاً بهترین تطبیق را از دیکشنری پیدا کن:"""
-            
-            response = await self.client.chat.completions.create(
-                model=os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_msg},
+            ویژگی‌های درخواست شده:
+            {', '.join(product_features)}"""
+
+            content = await _llm_cache.call(
+                self.client,
+                os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini",
+                [
+                    {"role": "system", "content": _TRANSLATE_AND_MATCH_SYSTEM_PROMPT},
                     {"role": "user", "content": user_content}
-                ]
+                ],
+                temperature=0,
+                # A short JSON: one translation per feature plus the matched key
+                max_tokens=32 * len(product_features) + 32,
+                response_format={"type": "json_object"}
             )
-            
-            # Parse the response
-            result = response.choices[0].message.content.strip()
-            
-            # Check if result is in the features_dict
-            if result in features_dict:
-                return result
-            elif result.lower() == "none" or result.lower() == "null":
-                return None
-            else:
-                # Try to find partial match with better logic
-                best_match = None
-                best_score = 0
-                
-                for eng_key in features_dict.keys():
-                    # Check for exact substring match
-                    if result.lower() in eng_key.lower():
-                        if len(result) / len(eng_key) > best_score:
-                            best_match = eng_key
-                            best_score = len(result) / len(eng_key)
-                    elif eng_key.lower() in result.lower():
-                        if len(eng_key) / len(result) > best_score:
-                            best_match = eng_key
-                            best_score = len(eng_key) / len(result)
-                    # Check for word-level matching
-                    elif any(word in eng_key.lower() for word in result.lower().split('_')):
-                        if 0.5 > best_score:  # Lower threshold for word matching
-                            best_match = eng_key
-                            best_score = 0.5
-                
-                return best_match if best_score > 0.3 else None
-            
+
+            result = json_utils.loads(content)
+            match = result.get("match")
+            if isinstance(match, str) and match in extra_features_dict:
+                return match
+            # Fall back to partial matching of the suggested key, then of each translation
+            translations = result.get("translations")
+            candidates = [match] + (translations if isinstance(translations, list) else [])
+            for candidate in candidates:
+                if isinstance(candidate, str) and candidate.strip() and candidate.lower() not in ("none", "null"):
+                    best_match = _closest_feature_key(candidate.strip(), extra_features_dict)
+                    if best_match:
+                        return best_match
+            return None
+
         except Exception as e:
-            print(f"Error finding feature name: {e}")
+            logger.error("Error translating and matching features: %s", e)
             return None
 
     async def _find_features_with_llm(self, random_key, product_features, extra_features_dict, product_name=None):
-        product_features_english_translation =  await self.translation_features_to_english(product_features, product_name)
-        feature_name = await self.find_feature_name(product_features_english_translation, extra_features_dict)
-        return feature_name
+        if len(product_features) <= 1:
+            return await self._translate_and_match(product_features, extra_features_dict, product_name)
+        # Each requested feature is translated and matched on its own, concurrently;
+        # the first match in request order wins, so the result doesn't depend on latency
+        results = await asyncio.gather(*(
+            self._translate_and_match([feature], extra_features_dict, product_name)
+            for feature in product_features
+        ))
+        return next((feature_name for feature_name in results if feature_name), None)
 
     async def process_query(self, query: str) -> Response:
         result = await self._extract_product_name_and_features(query)
         product_name, product_features = result["product_name"], result["features"]
+        # Nothing to look up: skip the product search and the whole matching pipeline
+        if not product_features or product_features == _UNKNOWN_FEATURES:
+            return Response(message=_NO_FEATURE_MESSAGE, base_random_keys=[], member_random_keys=[])
+        # No product named: nothing to search for
+        if product_name == _UNKNOWN_PRODUCT:
+            return Response(message=f"هیچ ویژگی‌ای برای محصول '{product_name}' یافت نشد.", base_random_keys=[], member_random_keys=[])
         product_result = await self.search_product(product_name)
         product_result_random_key = product_result['random_key'] if product_result else None
         result_requested_features_list = await self._search_features(product_result_random_key, product_features, product_name) if product_result_random_key else []
@@ -321,13 +445,7 @@ class FeatureProductAgent(SpecificProductAgent):
 import time
 
 async def main():
-    prompt_template = PromptTemplate(
-        input_variables=["query"],
-        template="از متن زیر نام محصول و ویژگی‌های خواسته‌شده را استخراج کن و فقط خروجی را به صورت JSON زیر بده:\n{\"product_name\": ..., \"features\": [...]}\nمتن: {{ query }}",
-        template_format="jinja2"
-    )
-
-    agent = FeatureProductAgent(prompt_template)
+    agent = FeatureProductAgent()
 
     test_queries = [
         "هیچ ویژگی‌ای برای محصول 'ست کابینت و روشویی دلفین مدل ZN-R13-W-6040 به همراه آینه و باکس' یافت نشد.",
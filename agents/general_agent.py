@@ -1,9 +1,11 @@
+import asyncio
 import os
 import json
+import logging
+import re
 from typing import Dict, Any, List
-from openai import AsyncOpenAI
+from openai_client import get_client
 from langchain.output_parsers import PydanticOutputParser
-from langchain.schema import OutputParserException
 from langchain.prompts import PromptTemplate
 import dotenv
 from response_format import Response
@@ -11,91 +13,216 @@ from response_format import Response
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Parser and system prompt don't depend on the request; the jinja2 template is
+# compiled and rendered once at import instead of for every GeneralAgent.
+_PARSER = PydanticOutputParser(pydantic_object=Response)
+
+# System prompt template using jinja2 to avoid brace conflicts in JSON examples
+_SYSTEM_TEMPLATE = PromptTemplate(
+    template=(
+        "You are a general assistant that answers various questions.\n"
+        "Always output valid json that matches the provided schema.\n"
+        "Goal: Extract explicitly requested random keys from varied natural language phrasings.\n\n"
+        "VERB TRIGGERS (case-insensitive): return, output, print, show, give, send, provide.\n"
+        "BASE KEY TRIGGERS (any of): 'base random', 'base random key', 'base key', 'random key'.\n"
+        "MEMBER KEY TRIGGERS (any of): 'member random', 'member random key', 'member key'.\n"
+        "When a trigger phrase appears, capture every contiguous token (alphanumeric / dash / underscore) that follows it until punctuation, a conjunction (and / &), another trigger phrase, or end of line.\n"
+        "UUID (8-4-4-4-12 hex) tokens ALWAYS go to base_random_keys even if a member trigger preceded them (no duplication).\n"
+        "If the phrase is only 'random key' (without 'member') treat as BASE.\n"
+        "Never fabricate tokens. Preserve original casing and characters (including multiple dashes).\n"
+        "Do not split on internal dashes or underscores.\n"
+        "Never put the same exact token in both lists (base takes precedence).\n"
+        "If no keys found for a list, that list is empty.\n"
+        "message: short natural confirmation or direct answer (e.g. 'pong', 'Base random key extracted', 'Member random keys extracted', 'Both key types extracted', or an answer to a general question).\n\n"
+        "Edge Handling:\n"
+        "- Multiple keys after one trigger separated by spaces are all captured.\n"
+        "- If a verb trigger appears after keys already captured, ignore it for those keys.\n"
+        "- Ignore surrounding quotes unless part of the token.\n\n"
+        "Examples:\n"
+        "User: ping -> {\"message\": \"pong\", \"base_random_keys\": [], \"member_random_keys\": []}\n"
+        "User: return base random dfdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"dfdf\"], \"member_random_keys\": []}\n"
+        "User: return base random key dfdsdvsvxcvxcvf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"dfdsdvsvxcvxcvf\"], \"member_random_keys\": []}\n"
+        "User: return random key dfdASaew23rewfsdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"dfdASaew23rewfsdf\"], \"member_random_keys\": []}\n"
+        "User: output base random 334345434rfdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"334345434rfdf\"], \"member_random_keys\": []}\n"
+        "User: output base random key df24325345345df -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"df24325345345df\"], \"member_random_keys\": []}\n"
+        "User: print base random key 23233534ytgdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"23233534ytgdf\"], \"member_random_keys\": []}\n"
+        "User: return base random 123e4567-e89b-12d3-a456-426614174000 -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"123e4567-e89b-12d3-a456-426614174000\"], \"member_random_keys\": []}\n"
+        "User: return member random efs45454gdf -> {\"message\": \"Member random key extracted\", \"base_random_keys\": [], \"member_random_keys\": [\"efs45454gdf\"]}\n"
+        "User: return member key abc-def-123 -> {\"message\": \"Member random key extracted\", \"base_random_keys\": [], \"member_random_keys\": [\"abc-def-123\"]}\n"
+        "User: return both base random 123e4567-e89b-12d3-a456-426614174000 and member random efs45454gdf -> {\"message\": \"Both key types extracted\", \"base_random_keys\": [\"123e4567-e89b-12d3-a456-426614174000\"], \"member_random_keys\": [\"efs45454gdf\"]}\n"
+        "User: show member random k1 k2 k3 -> {\"message\": \"Member random keys extracted\", \"base_random_keys\": [], \"member_random_keys\": [\"k1\", \"k2\", \"k3\"]}\n"
+        "User: give base random key A1 B2 C3 and member random X9 -> {\"message\": \"Both key types extracted\", \"base_random_keys\": [\"A1\", \"B2\", \"C3\"], \"member_random_keys\": [\"X9\"]}\n"
+        "User: What is the capital of France? -> {\"message\": \"Paris\", \"base_random_keys\": [], \"member_random_keys\": []}\n\n"
+        "{{ format_instructions }}"
+    ),
+    input_variables=[],
+    partial_variables={"format_instructions": _PARSER.get_format_instructions()},
+    template_format="jinja2"
+)
+_SYSTEM_PROMPT = _SYSTEM_TEMPLATE.format()
+# Bump when _SYSTEM_TEMPLATE changes
+_PROMPT_CACHE_KEY = "general_agent_v1"
+# Request options that never change, built once instead of on every call
+_RESPONSE_FORMAT = {"type": "json_object"}
+# Same long system prefix on every call: route to the same prompt-cache shard
+_EXTRA_BODY = {"prompt_cache_key": _PROMPT_CACHE_KEY}
+
+
+class _LLMMicroBatcher:
+    """
+    Collects chat completions submitted within a short window and sends them
+    as one concurrent burst. Identical requests in the same window (the same
+    ping or key-extraction command from several users) share a single call.
+    The window only applies under load: a request arriving to an empty queue
+    is sent immediately.
+    """
+
+    def __init__(self, window_ms: float = 20, max_batch: int = 32):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._inflight = set()
+
+    async def submit(self, client, **params):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            # Queue and worker are bound to the running event loop
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((client, params, future))
+        return await future
+
+    async def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                # A lone request goes out at once; the window only collects under load
+                if not self._queue.empty():
+                    await asyncio.sleep(self.window)
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                groups = {}
+                for client, params, future in batch:
+                    key = (id(client), json.dumps(params, sort_keys=True, ensure_ascii=False))
+                    groups.setdefault(key, (client, params, []))[2].append(future)
+                # Fired as a task so the next window starts collecting right away
+                burst = asyncio.ensure_future(asyncio.gather(
+                    *(self._call(client, params, futures) for client, params, futures in groups.values())
+                ))
+                self._inflight.add(burst)
+                burst.add_done_callback(self._inflight.discard)
+                batch = []
+        finally:
+            # The worker stopped (error or cancellation): fail every request not yet sent,
+            # so no caller waits forever; the next submit starts a new worker
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("GeneralAgent micro-batcher stopped"))
+
+    @staticmethod
+    async def _call(client, params, futures):
+        try:
+            result = await client.chat.completions.create(**params)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result(result)
+
+
+_batcher = _LLMMicroBatcher(window_ms=float(os.getenv("GENERAL_BATCH_WINDOW_MS", "20")))
+
+# Single-trigger key commands ("return base random key X", "show member key k1 k2")
+# follow the system prompt's rules deterministically, so they skip the LLM.
+# Anything with a second trigger, a conjunction or punctuation is left to the model.
+_KEY_COMMAND_PATTERN = re.compile(
+    r"^(?:return|output|print|show|give|send|provide)\s+"
+    r"(?P<trigger>member\s+random\s+key|member\s+random|member\s+key|"
+    r"base\s+random\s+key|base\s+random|base\s+key|random\s+key)"
+    r"\s*:?\s+(?P<keys>[\w-]+(?:\s+[\w-]+)*)$",
+    re.IGNORECASE,
+)
+_KEY_WORDS = frozenset({"and", "base", "member", "random", "key", "keys"})
+_UUID_PATTERN = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+
+
+def _command_response(query: str):
+    """Response for ping / single key-extraction commands, or None when the LLM is needed"""
+    text = query.strip()
+    if text.lower() == "ping":
+        return Response(message="pong", base_random_keys=[], member_random_keys=[])
+    match = _KEY_COMMAND_PATTERN.match(text)
+    if not match:
+        return None
+    keys = match.group("keys").split()
+    if any(key.lower() in _KEY_WORDS for key in keys):
+        return None
+    if match.group("trigger").lower().startswith("member"):
+        # UUIDs always belong to base_random_keys; leave that split to the model
+        if any(_UUID_PATTERN.match(key) for key in keys):
+            return None
+        return Response(message="null", base_random_keys=[], member_random_keys=list(dict.fromkeys(keys)))
+    return Response(message="null", base_random_keys=list(dict.fromkeys(keys)), member_random_keys=[])
 
 
 class GeneralAgent:
     def __init__(self, config: Dict[str, Any]):
         self.config = config
-        self.client = AsyncOpenAI(
-            api_key=config['OPENAI_API_KEY'],
-            base_url=os.getenv("OPENAI_URL")
-        )
+        self.client = get_client()
         self.model = os.getenv("MODEL")
         # Pydantic parser
-        self.parser = PydanticOutputParser(pydantic_object=Response)
+        self.parser = _PARSER
 
         # System prompt template using jinja2 to avoid brace conflicts in JSON examples
-        self.system_template = PromptTemplate(
-            template=(
-                "You are a general assistant that answers various questions.\n"
-                "Always output valid json that matches the provided schema.\n"
-                "Goal: Extract explicitly requested random keys from varied natural language phrasings.\n\n"
-                "VERB TRIGGERS (case-insensitive): return, output, print, show, give, send, provide.\n"
-                "BASE KEY TRIGGERS (any of): 'base random', 'base random key', 'base key', 'random key'.\n"
-                "MEMBER KEY TRIGGERS (any of): 'member random', 'member random key', 'member key'.\n"
-                "When a trigger phrase appears, capture every contiguous token (alphanumeric / dash / underscore) that follows it until punctuation, a conjunction (and / &), another trigger phrase, or end of line.\n"
-                "UUID (8-4-4-4-12 hex) tokens ALWAYS go to base_random_keys even if a member trigger preceded them (no duplication).\n"
-                "If the phrase is only 'random key' (without 'member') treat as BASE.\n"
-                "Never fabricate tokens. Preserve original casing and characters (including multiple dashes).\n"
-                "Do not split on internal dashes or underscores.\n"
-                "Never put the same exact token in both lists (base takes precedence).\n"
-                "If no keys found for a list, that list is empty.\n"
-                "message: short natural confirmation or direct answer (e.g. 'pong', 'Base random key extracted', 'Member random keys extracted', 'Both key types extracted', or an answer to a general question).\n\n"
-                "Edge Handling:\n"
-                "- Multiple keys after one trigger separated by spaces are all captured.\n"
-                "- If a verb trigger appears after keys already captured, ignore it for those keys.\n"
-                "- Ignore surrounding quotes unless part of the token.\n\n"
-                "Examples:\n"
-                "User: ping -> {\"message\": \"pong\", \"base_random_keys\": [], \"member_random_keys\": []}\n"
-                "User: return base random dfdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"dfdf\"], \"member_random_keys\": []}\n"
-                "User: return base random key dfdsdvsvxcvxcvf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"dfdsdvsvxcvxcvf\"], \"member_random_keys\": []}\n"
-                "User: return random key dfdASaew23rewfsdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"dfdASaew23rewfsdf\"], \"member_random_keys\": []}\n"
-                "User: output base random 334345434rfdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"334345434rfdf\"], \"member_random_keys\": []}\n"
-                "User: output base random key df24325345345df -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"df24325345345df\"], \"member_random_keys\": []}\n"
-                "User: print base random key 23233534ytgdf -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"23233534ytgdf\"], \"member_random_keys\": []}\n"
-                "User: return base random 123e4567-e89b-12d3-a456-426614174000 -> {\"message\": \"Base random key extracted\", \"base_random_keys\": [\"123e4567-e89b-12d3-a456-426614174000\"], \"member_random_keys\": []}\n"
-                "User: return member random efs45454gdf -> {\"message\": \"Member random key extracted\", \"base_random_keys\": [], \"member_random_keys\": [\"efs45454gdf\"]}\n"
-                "User: return member key abc-def-123 -> {\"message\": \"Member random key extracted\", \"base_random_keys\": [], \"member_random_keys\": [\"abc-def-123\"]}\n"
-                "User: return both base random 123e4567-e89b-12d3-a456-426614174000 and member random efs45454gdf -> {\"message\": \"Both key types extracted\", \"base_random_keys\": [\"123e4567-e89b-12d3-a456-426614174000\"], \"member_random_keys\": [\"efs45454gdf\"]}\n"
-                "User: show member random k1 k2 k3 -> {\"message\": \"Member random keys extracted\", \"base_random_keys\": [], \"member_random_keys\": [\"k1\", \"k2\", \"k3\"]}\n"
-                "User: give base random key A1 B2 C3 and member random X9 -> {\"message\": \"Both key types extracted\", \"base_random_keys\": [\"A1\", \"B2\", \"C3\"], \"member_random_keys\": [\"X9\"]}\n"
-                "User: What is the capital of France? -> {\"message\": \"Paris\", \"base_random_keys\": [], \"member_random_keys\": []}\n\n"
-                "{{ format_instructions }}"
-            ),
-            input_variables=[],
-            partial_variables={"format_instructions": self.parser.get_format_instructions()},
-            template_format="jinja2"
-        )
+        self.system_template = _SYSTEM_TEMPLATE
+        # Rendered once at import; kept on the instance for callers that read it
+        self._system_prompt = _SYSTEM_PROMPT
 
     async def process_query(self, query: str) -> Response:
-        system_prompt = self.system_template.format()
+        command = _command_response(query)
+        if command is not None:
+            return command
+        system_prompt = self._system_prompt
         try:
-            chat_response = await self.client.chat.completions.create(
+            chat_response = await _batcher.submit(
+                self.client,
                 model=self.model,
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": query}
                 ],
-                response_format={"type": "json_object"}
+                response_format=_RESPONSE_FORMAT,
+                extra_body=_EXTRA_BODY
             )
             content = chat_response.choices[0].message.content
             try:
                 data = json.loads(content)
-                if data["base_random_keys"] or data["member_random_keys"]:
-                    data["message"] = "null"
-                content = json.dumps(data)
-                return self.parser.parse(content)
-            except OutputParserException:
-                data = json.loads(content)
-                message = data["message"]
-                if data["base_random_keys"] or data["member_random_keys"]:
-                    message = "null"
-                return Response(
-                    message=message,
-                    base_random_keys=list(data.get("base_random_keys", []) or []),
-                    member_random_keys=list(data.get("member_random_keys", []) or [])
-                )
+            except json.JSONDecodeError:
+                # Not bare JSON (e.g. wrapped in a code fence): let the parser dig it out
+                data = self.parser.parse(content).model_dump()
+            base_random_keys = list(data.get("base_random_keys") or [])
+            member_random_keys = list(data.get("member_random_keys") or [])
+            message = "null" if base_random_keys or member_random_keys else data.get("message", "")
+            return Response(
+                message=message,
+                base_random_keys=base_random_keys,
+                member_random_keys=member_random_keys
+            )
         except Exception as e:
+            logger.error("Error in GeneralAgent.process_query: %s", e)
             return Response(message=str(e), base_random_keys=[], member_random_keys=[])
 
 
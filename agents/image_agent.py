@@ -1,36 +1,55 @@
 import base64
-import requests
+import hashlib
 import os
 import logging
-from openai import AsyncOpenAI
+import aiohttp
+from openai_client import get_client
 from typing import Dict, Any
 import dotenv
 from response_format import Response
+from cache_utils import LRUCache
+from api.session_manager import get_http_session
 dotenv.load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Image downloads share the app-wide aiohttp session; this only caps a single fetch
+_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=10)
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# The same image is often asked about again while browsing, and each answer costs a
+# download plus a Vision call. Answers are keyed by (query, sha256 of the image data
+# or URL); downloads by URL, so different queries on one image share the fetch.
+# Encoded images can be megabytes, hence the much smaller download cache.
+_answer_cache = LRUCache(maxsize=512, ttl=3600)
+_download_cache = LRUCache(maxsize=32, ttl=3600)
+
 
 class ImageAgent:
     def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            base_url=os.getenv("OPENAI_URL"),
-        )
+        self.client = get_client()
     
-    def get_base64_encoded_image(self, image_url: str) -> str:
+    async def get_base64_encoded_image(self, image_url: str) -> str:
         """
         Download image from URL and encode it to base64.
         """
+        cached = _download_cache.get(image_url)
+        if cached is not None:
+            return cached
         try:
-            response = requests.get(image_url)
-            response.raise_for_status()
-            image_data = response.content
-            base64_image = base64.b64encode(image_data).decode("utf-8")
-            assert base64.b64decode(base64_image) == image_data
+            session = await get_http_session()
+            async with session.get(image_url, timeout=_DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                # One growable buffer instead of a chunk list joined into bytes by read()
+                image_data = bytearray()
+                async for chunk in response.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+                    image_data += chunk
+            # base64 output is pure ASCII, and a fresh encoding needs no round-trip check
+            base64_image = base64.b64encode(image_data).decode("ascii")
+            _download_cache.set(image_url, base64_image)
             return base64_image
         except Exception as e:
-            print(f"Error downloading image: {e}")
+            logger.error("Error downloading image: %s", e)
             return None
     
     async def process_query(self, query: str, image_data: str) -> Response:
@@ -44,18 +63,22 @@ class ImageAgent:
         Returns:
             Answer about the image based on the query
         """
+        cache_key = (query, hashlib.sha256(image_data.encode("utf-8")).hexdigest())
+        cached = _answer_cache.get(cache_key)
+        if cached is not None:
+            return cached.model_copy(deep=True)
         try:
             # Check if image_data is a data URL, URL, or raw base64
             if image_data.startswith('data:image/'):
                 # Extract base64 data from data URL
                 try:
                     header, base64_image = image_data.split(',', 1)
-                    logger.info(f"Extracted base64 data from data URL: {len(base64_image)} characters")
+                    logger.info("Extracted base64 data from data URL: %d characters", len(base64_image))
                 except ValueError:
                     return Response(message="فرمت داده تصویر نامعتبر است.", base_random_keys=[], member_random_keys=[])
             elif image_data.startswith(('http://', 'https://')):
                 # Download and encode image from URL
-                base64_image = self.get_base64_encoded_image(image_data)
+                base64_image = await self.get_base64_encoded_image(image_data)
                 if not base64_image:
                     return Response(message="متأسفم، نتوانستم تصویر را دانلود کنم. لطفاً URL تصویر را بررسی کنید.", base_random_keys=[], member_random_keys=[])
             else:
@@ -98,13 +121,14 @@ class ImageAgent:
                 temperature=0.3
             )
             res = Response(message=response.choices[0].message.content, base_random_keys=[], member_random_keys=[])
+            _answer_cache.set(cache_key, res.model_copy(deep=True))
             return res
             
         except Exception as e:
-            print(f"Error in process_image_query: {e}")
+            logger.error("Error in process_image_query: %s", e)
             res = Response(message=f"متأسفم، خطایی در تحلیل تصویر رخ داد: {str(e)}", base_random_keys=[], member_random_keys=[])
             return res
-    
+
     async def identify_main_object(self, image_data: str) -> Response:
         """
         Identify the main object or concept in the image.
@@ -1,7 +1,7 @@
 import base64
-import requests
 import os
 import logging
+import aiohttp
 from openai import AsyncOpenAI
 from typing import Dict, Any
 import dotenv
@@ -11,6 +11,7 @@ from system_prompts.extract_brand_from_image_system_prompt import extract_brand_
 from system_prompts.extract_phrased_name_from_image_system_prompt import extract_phrased_name_from_image_system_prompt
 from system_prompts.extract_final_dedicion_product_image_system_prompt import extract_final_dedicion_product_image_system_prompt
 from response_format import Response
+from api.session_manager import get_http_session
 from db.base import DatabaseBaseLoader
 from features_list import features_dict
 from agents.specific_product_agent import SpecificProductAgent
@@ -18,6 +19,7 @@ import os
 import sys
 import time
 import json
+import json_utils
 from typing import Dict, Any, List
 import re
 from openai import AsyncOpenAI
@@ -35,24 +37,67 @@ dotenv.load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Image downloads share the app-wide aiohttp session; this only caps a single fetch
+_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=10)
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Patterns for digging JSON (or quoted names) out of free-form vision replies,
+# compiled once instead of on every response
+_JSON_OBJECT_PATTERN = re.compile(r'\{.*\}', re.DOTALL)
+_QUOTED_PATTERN = re.compile(r'"([^"]+)"')
+
+# Name lookups ranked by match quality (exact before partial) so one query
+# replaces the sequential fallback round-trips
+_SQL_MATCH_CATEGORY = """
+    SELECT id, title FROM categories
+    WHERE title = ? OR title LIKE ?
+    ORDER BY title = ? DESC, rowid
+    LIMIT 1
+"""
+_SQL_MATCH_BRAND = """
+    SELECT id, title FROM brands
+    WHERE title = ? OR title LIKE ? OR LOWER(title) = LOWER(?)
+    ORDER BY title = ? DESC, title LIKE ? DESC, rowid
+    LIMIT 1
+"""
+
+
+def _iter_candidate_lines(candidate_products, features_candidate_products):
+    """Lines of the candidates block of the final-decision prompt, joined once by the caller"""
+    yield "محصولات کاندید:\n"
+    for i, (candidate, features) in enumerate(zip(candidate_products, features_candidate_products), 1):
+        yield f"\n{i}. نام محصول: {candidate.get('persian_name', 'نامشخص')}\n"
+        yield f"   کلید تصادفی: {candidate.get('random_key', 'نامشخص')}\n"
+        yield f"   امتیاز شباهت: {candidate.get('similarity', 0)}\n"
+        yield f"   نوع تطبیق: {candidate.get('match_type', 'نامشخص')}\n"
+        if not features.get('features'):
+            yield "   ویژگی‌ها: هیچ ویژگی‌ای یافت نشد\n"
+            continue
+        yield "   ویژگی‌ها:\n"
+        for feature_name, feature_value in features['features'].items():
+            yield f"     - {feature_name}: {feature_value}\n"
+
 
 class ProductImageAgent(SpecificProductAgent):
     def __init__(self):
         super().__init__()
 
-    def get_base64_encoded_image(self, image_url: str) -> str:
+    async def get_base64_encoded_image(self, image_url: str) -> str:
         """
         Download image from URL and encode it to base64.
         """
         try:
-            response = requests.get(image_url)
-            response.raise_for_status()
-            image_data = response.content
-            base64_image = base64.b64encode(image_data).decode("utf-8")
-            assert base64.b64decode(base64_image) == image_data
-            return base64_image
+            session = await get_http_session()
+            async with session.get(image_url, timeout=_DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                # One growable buffer instead of a chunk list joined into bytes by read()
+                image_data = bytearray()
+                async for chunk in response.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+                    image_data += chunk
+            # base64 output is pure ASCII, and a fresh encoding needs no round-trip check
+            return base64.b64encode(image_data).decode("ascii")
         except Exception as e:
-            print(f"Error downloading image: {e}")
+            logger.error("Error downloading image: %s", e)
             return None
 
     async def _map_image_to_category(self, base64_image):
@@ -87,20 +132,18 @@ class ProductImageAgent(SpecificProductAgent):
             )
             
             # Parse the JSON response
-            import json
-            import re
             try:
                 response_content = response.choices[0].message.content
                 logger.info(f"Category extraction response: {response_content}")
                 
                 # Try to extract JSON from the response if it's wrapped in markdown or has extra text
-                json_match = re.search(r'\{.*\}', response_content, re.DOTALL)
+                json_match = _JSON_OBJECT_PATTERN.search(response_content)
                 if json_match:
                     json_content = json_match.group(0)
                 else:
                     json_content = response_content
                 
-                category_data = json.loads(json_content)
+                category_data = json_utils.loads(json_content)
                 category_name = category_data.get("category_name", "نامشخص")
             except json.JSONDecodeError as e:
                 logger.error(f"Failed to parse category JSON response: {e}")
@@ -114,19 +157,10 @@ class ProductImageAgent(SpecificProductAgent):
             # Query database to find matching category
             db = DatabaseBaseLoader()
             try:
-                # Try exact match first
-                results = db.query(
-                    "SELECT id, title FROM categories WHERE title = ?", 
-                    (category_name,)
-                )
-                
-                if results:
-                    return results[0]['id'], results[0]['title']
-                
-                # Try partial match
-                results = db.query(
-                    "SELECT id, title FROM categories WHERE title LIKE ?", 
-                    (f"%{category_name}%",)
+                # Exact match first, then partial match, in one round-trip
+                results = await db.aquery(
+                    _SQL_MATCH_CATEGORY,
+                    (category_name, f"%{category_name}%", category_name)
                 )
                 
                 if results:
@@ -174,20 +208,18 @@ class ProductImageAgent(SpecificProductAgent):
             )
             
             # Parse the JSON response
-            import json
-            import re
             try:
                 response_content = response.choices[0].message.content
                 logger.info(f"Brand extraction response: {response_content}")
                 
                 # Try to extract JSON from the response if it's wrapped in markdown or has extra text
-                json_match = re.search(r'\{.*\}', response_content, re.DOTALL)
+                json_match = _JSON_OBJECT_PATTERN.search(response_content)
                 if json_match:
                     json_content = json_match.group(0)
                 else:
                     json_content = response_content
                 
-                brand_data = json.loads(json_content)
+                brand_data = json_utils.loads(json_content)
                 brand_name = brand_data.get("brand_name", "نامشخص")
             except json.JSONDecodeError as e:
                 logger.error(f"Failed to parse brand JSON response: {e}")
@@ -201,28 +233,10 @@ class ProductImageAgent(SpecificProductAgent):
             # Query database to find matching brand
             db = DatabaseBaseLoader()
             try:
-                # Try exact match first
-                results = db.query(
-                    "SELECT id, title FROM brands WHERE title = ?", 
-                    (brand_name,)
-                )
-                
-                if results:
-                    return results[0]['id'], results[0]['title']
-                
-                # Try partial match
-                results = db.query(
-                    "SELECT id, title FROM brands WHERE title LIKE ?", 
-                    (f"%{brand_name}%",)
-                )
-                
-                if results:
-                    return results[0]['id'], results[0]['title']
-                
-                # Try case-insensitive match
-                results = db.query(
-                    "SELECT id, title FROM brands WHERE LOWER(title) = LOWER(?)", 
-                    (brand_name,)
+                # Exact, partial and case-insensitive matches, ranked in one round-trip
+                results = await db.aquery(
+                    _SQL_MATCH_BRAND,
+                    (brand_name, f"%{brand_name}%", brand_name, brand_name, f"%{brand_name}%")
                 )
                 
                 if results:
@@ -282,22 +296,20 @@ class ProductImageAgent(SpecificProductAgent):
             )
             
             # Parse the JSON response
-            import json
-            import re
             
             try:
                 response_content = response.choices[0].message.content
                 logger.info(f"Raw response content: {response_content}")
                 
                 # Try to extract JSON from the response if it's wrapped in markdown or has extra text
-                json_match = re.search(r'\{.*\}', response_content, re.DOTALL)
+                json_match = _JSON_OBJECT_PATTERN.search(response_content)
                 if json_match:
                     json_content = json_match.group(0)
                     logger.info(f"Extracted JSON content: {json_content}")
                 else:
                     json_content = response_content
                 
-                phrased_data = json.loads(json_content)
+                phrased_data = json_utils.loads(json_content)
                 phrased_names = phrased_data.get("phrased_names", [])
                 confidence = phrased_data.get("confidence", "نامشخص")
                 
@@ -318,7 +330,7 @@ class ProductImageAgent(SpecificProductAgent):
                 # Try to extract names manually as a fallback
                 try:
                     # Look for quoted strings that might be product names
-                    quoted_names = re.findall(r'"([^"]+)"', response_content)
+                    quoted_names = _QUOTED_PATTERN.findall(response_content)
                     if quoted_names:
                         logger.info(f"Extracted names as fallback: {quoted_names}")
                         return quoted_names[:5]  # Return up to 5 names
@@ -348,22 +360,22 @@ class ProductImageAgent(SpecificProductAgent):
                 # Try exact match first
                 try:
                     if category_id and brand_id:
-                        result = db.query(
+                        result = await db.aquery(
                             "SELECT random_key, persian_name FROM base_products WHERE persian_name = ? AND category_id = ? AND brand_id = ? LIMIT 1",
                             (phrased_name, category_id, brand_id)
                         )
                     elif category_id:
-                        result = db.query(
+                        result = await db.aquery(
                             "SELECT random_key, persian_name FROM base_products WHERE persian_name = ? AND category_id = ? LIMIT 1",
                             (phrased_name, category_id)
                         )
                     elif brand_id:
-                        result = db.query(
+                        result = await db.aquery(
                             "SELECT random_key, persian_name FROM base_products WHERE persian_name = ? AND brand_id = ? LIMIT 1",
                             (phrased_name, brand_id)
                         )
                     else:
-                        result = db.query(
+                        result = await db.aquery(
                             "SELECT random_key, persian_name FROM base_products WHERE persian_name = ? LIMIT 1",
                             (phrased_name,)
                         )
@@ -401,25 +413,25 @@ class ProductImageAgent(SpecificProductAgent):
                         
                         try:
                             if category_id and brand_id:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ? AND category_id = ? AND brand_id = ?",
                                     (like_pattern, like_pattern_2, like_pattern_3, category_id, brand_id)
                                 )
                             elif category_id:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ? AND category_id = ?",
                                     (like_pattern, like_pattern_2, like_pattern_3, category_id)
                                 )
                             elif brand_id:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ? AND brand_id = ?",
                                     (like_pattern, like_pattern_2, like_pattern_3, brand_id)
                                 )
                             else:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ? LIMIT 2",
                                     (like_pattern, like_pattern_2, like_pattern_3)
@@ -481,25 +493,25 @@ class ProductImageAgent(SpecificProductAgent):
                         
                         try:
                             if category_id and brand_id:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? AND category_id = ? AND brand_id = ?",
                                     (like_pattern, like_pattern_2, category_id, brand_id)
                                 )
                             elif category_id:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? AND category_id = ?",
                                     (like_pattern, like_pattern_2, category_id)
                                 )
                             elif brand_id:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? AND brand_id = ?",
                                     (like_pattern, like_pattern_2, brand_id)
                                 )
                             else:
-                                rows = db.query(
+                                rows = await db.aquery(
                                     "SELECT random_key, persian_name FROM base_products "
                                     "WHERE persian_name LIKE ? AND persian_name LIKE ? LIMIT 5",
                                     (like_pattern, like_pattern_2)
@@ -571,75 +583,49 @@ class ProductImageAgent(SpecificProductAgent):
         if not candidate_products:
             return []
         
-        features_list = []
+        keys = [c.get("random_key") for c in candidate_products if c.get("random_key")]
+        raw_features = {}
         db = DatabaseBaseLoader()
-        
         try:
-            for candidate in candidate_products:
-                random_key = candidate.get("random_key")
-                if not random_key:
-                    continue
-                
-                # Get product features from database
-                try:
-                    result = db.query(
-                        "SELECT extra_features FROM base_products WHERE random_key = ?",
-                        (random_key,)
-                    )
-                    
-                    if result and result[0]["extra_features"]:
-                        # Parse JSON features
-                        import json
-                        try:
-                            features_json = json.loads(result[0]["extra_features"])
-                            
-                            # Convert feature names to Persian using features_dict
-                            persian_features = {}
-                            for key, value in features_json.items():
-                                persian_key = features_dict.get(key, key)  # Use original key if not found in dict
-                                persian_features[persian_key] = value
-                            
-                            features_list.append({
-                                "random_key": random_key,
-                                "persian_name": candidate.get("persian_name", ""),
-                                "features": persian_features,
-                                "similarity": candidate.get("similarity", 0),
-                                "match_type": candidate.get("match_type", "")
-                            })
-                        except json.JSONDecodeError:
-                            # If JSON parsing fails, add empty features
-                            features_list.append({
-                                "random_key": random_key,
-                                "persian_name": candidate.get("persian_name", ""),
-                                "features": {},
-                                "similarity": candidate.get("similarity", 0),
-                                "match_type": candidate.get("match_type", "")
-                            })
-                    else:
-                        # No features found
-                        features_list.append({
-                            "random_key": random_key,
-                            "persian_name": candidate.get("persian_name", ""),
-                            "features": {},
-                            "similarity": candidate.get("similarity", 0),
-                            "match_type": candidate.get("match_type", "")
-                        })
-                        
-                except Exception as e:
-                    logger.error(f"Error getting features for {random_key}: {e}")
-                    # Add entry with empty features
-                    features_list.append({
-                        "random_key": random_key,
-                        "persian_name": candidate.get("persian_name", ""),
-                        "features": {},
-                        "similarity": candidate.get("similarity", 0),
-                        "match_type": candidate.get("match_type", "")
-                    })
-            
-            return features_list
-            
+            # All candidates' features in one round-trip
+            placeholders = ",".join("?" * len(keys))
+            rows = await db.aquery(
+                f"SELECT random_key, extra_features FROM base_products WHERE random_key IN ({placeholders})",
+                keys
+            ) if keys else []
+            raw_features = {row["random_key"]: row["extra_features"] for row in rows}
+        except Exception as e:
+            logger.error(f"Error getting features for candidates: {e}")
         finally:
             db.close()
+        
+        features_list = []
+        for candidate in candidate_products:
+            random_key = candidate.get("random_key")
+            if not random_key:
+                continue
+            
+            # Parse the JSON once, straight into Persian feature names (original key if not in features_dict)
+            persian_features = {}
+            raw = raw_features.get(random_key)
+            if raw:
+                try:
+                    persian_features = {
+                        features_dict.get(key, key): value for key, value in json_utils.loads(raw).items()
+                    }
+                except (json.JSONDecodeError, AttributeError):
+                    # If JSON parsing fails, add empty features
+                    persian_features = {}
+            
+            features_list.append({
+                "random_key": random_key,
+                "persian_name": candidate.get("persian_name", ""),
+                "features": persian_features,
+                "similarity": candidate.get("similarity", 0),
+                "match_type": candidate.get("match_type", "")
+            })
+        
+        return features_list
 
     async def _get_final_dicision(self, base64_image, candidate_products, features_candidate_products, category_name, brand_name):
         """Make final decision on best matching product using vision API and candidate comparison."""
@@ -655,19 +641,7 @@ class ProductImageAgent(SpecificProductAgent):
                 context_info += f"برند محصول: {brand_name}\n"
             
             # Prepare candidate products information for the prompt
-            candidates_info = "محصولات کاندید:\n"
-            for i, (candidate, features) in enumerate(zip(candidate_products, features_candidate_products), 1):
-                candidates_info += f"\n{i}. نام محصول: {candidate.get('persian_name', 'نامشخص')}\n"
-                candidates_info += f"   کلید تصادفی: {candidate.get('random_key', 'نامشخص')}\n"
-                candidates_info += f"   امتیاز شباهت: {candidate.get('similarity', 0)}\n"
-                candidates_info += f"   نوع تطبیق: {candidate.get('match_type', 'نامشخص')}\n"
-                
-                if features.get('features'):
-                    candidates_info += "   ویژگی‌ها:\n"
-                    for feature_name, feature_value in features['features'].items():
-                        candidates_info += f"     - {feature_name}: {feature_value}\n"
-                else:
-                    candidates_info += "   ویژگی‌ها: هیچ ویژگی‌ای یافت نشد\n"
+            candidates_info = "".join(_iter_candidate_lines(candidate_products, features_candidate_products))
             
             # Prepare the user message
             user_message = f"تصویر را با محصولات کاندید زیر مقایسه کن و بهترین تطبیق را انتخاب کن:\n\n{candidates_info}"
@@ -703,24 +677,22 @@ class ProductImageAgent(SpecificProductAgent):
             )
             
             # Parse the JSON response
-            import json
-            import re
             try:
                 response_content = response.choices[0].message.content
                 logger.info(f"Decision response: {response_content}")
                 
                 # Try to extract JSON from the response if it's wrapped in markdown or has extra text
-                json_match = re.search(r'\{.*\}', response_content, re.DOTALL)
+                json_match = _JSON_OBJECT_PATTERN.search(response_content)
                 if json_match:
                     json_content = json_match.group(0)
                 else:
                     json_content = response_content
                 
-                decision_data = json.loads(json_content)
+                decision_data = json_utils.loads(json_content)
                 selected_product = decision_data.get("selected_product", {})
                 random_key = selected_product.get("random_key")
                 
-                if random_key and random_key != "null":
+                if random_key not in (None, "", "null"):
                     return random_key
                 else:
                     # If no product selected, return the best candidate based on similarity
@@ -768,7 +740,7 @@ class ProductImageAgent(SpecificProductAgent):
                     return Response(message="فرمت داده تصویر نامعتبر است.", base_random_keys=[], member_random_keys=[])
             elif image_data.startswith(('http://', 'https://')):
                 # Download and encode image from URL
-                base64_image = self.get_base64_encoded_image(image_data)
+                base64_image = await self.get_base64_encoded_image(image_data)
                 if not base64_image:
                     return Response(message="متأسفم، نتوانستم تصویر را دانلود کنم. لطفاً URL تصویر را بررسی کنید.", base_random_keys=[], member_random_keys=[])
             else:
@@ -789,7 +761,7 @@ class ProductImageAgent(SpecificProductAgent):
             return Response(message="null", base_random_keys=[random_key] if random_key else [], member_random_keys=[])
 
         except Exception as e:
-            print(f"Error in process_image_query: {e}")
+            logger.error("Error in process_image_query: %s", e)
             return Response(message=f"متأسفم، خطایی در تحلیل تصویر رخ داد: {str(e)}", base_random_keys=[], member_random_keys=[])
 
     async def identify_main_object(self, image_data: str) -> Response:
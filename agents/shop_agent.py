@@ -1,5 +1,6 @@
 import asyncio
 import json
+import json_utils
 import os
 from typing import Dict, Any
 from langchain.prompts import PromptTemplate
@@ -9,6 +10,12 @@ from agents.specific_product_agent import SpecificProductAgent
 from system_prompts.shop_system_prompts import route_task_shop_system_prompt, route_task_shop_samples
 dotenv.load_dotenv()
 
+# Few-shot block of the task router, built once at import instead of per call
+_ROUTE_SHOP_FEW_SHOT = "\n".join(
+    f"ورودی: {sample['input']}\nخروجی: {json_utils.dumps(sample)}"
+    for sample in route_task_shop_samples
+)
+
 
 class ShoppingAgent(SpecificProductAgent):
     def __init__(self, db_path: str | None = None):
@@ -37,12 +44,7 @@ class ShoppingAgent(SpecificProductAgent):
 
         try:
             # استفاده از نمونه‌ها برای few-shot learning
-            few_shot_examples = "\n".join([
-                f"ورودی: {sample['input']}\nخروجی: {json.dumps(sample, ensure_ascii=False, separators=(',', ':'))}"
-                for sample in route_task_shop_samples  # استفاده از 3 نمونه اول
-            ])
-            
-            user_content = f"{few_shot_examples}\n\nورودی: {query}\nخروجی:"
+            user_content = f"{_ROUTE_SHOP_FEW_SHOT}\n\nورودی: {query}\nخروجی:"
             
             model_name = os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini"
             
@@ -59,7 +61,7 @@ class ShoppingAgent(SpecificProductAgent):
             
             # تلاش برای پارس کردن JSON
             try:
-                result = json.loads(response_text)
+                result = json_utils.loads(response_text)
                 # اعتبارسنجی ساختار مورد انتظار
                 if all(key in result for key in ["task_type", "product_name", "shop_name", "location", "has_warranty"]):
                     return result
@@ -71,7 +73,7 @@ class ShoppingAgent(SpecificProductAgent):
             json_match = re.search(r'\{[^}]*\}', response_text)
             if json_match:
                 try:
-                    result = json.loads(json_match.group())
+                    result = json_utils.loads(json_match.group())
                     if all(key in result for key in ["task_type", "product_name", "shop_name", "location", "has_warranty"]):
                         return result
                 except json.JSONDecodeError:
@@ -296,29 +298,29 @@ class ShoppingAgent(SpecificProductAgent):
         if product_result:
             product_random_key = product_result['random_key'] if product_result else None
             if location:
-                city_id = self._get_city_id(location)
+                city_id = await asyncio.to_thread(self._get_city_id, location)
             else:
                 city_id = None
             if task_type == "mean_price":
-                answer = self._find_mean_price(product_random_key, city_id, has_warranty)
+                answer = await asyncio.to_thread(self._find_mean_price, product_random_key, city_id, has_warranty)
                 if answer is not None:
                     message = f"{answer:.2f}"
                 else:
                     message = "0.00"
             elif task_type == "max_price":
-                answer = self._find_max_price(product_random_key,  city_id, has_warranty)
+                answer = await asyncio.to_thread(self._find_max_price, product_random_key, city_id, has_warranty)
                 if answer is not None:
                     message = f"{answer:.2f}"
                 else:
                     message = "0.00"
             elif task_type == "min_price":
-                answer = self._find_min_price(product_random_key, city_id, has_warranty)
+                answer = await asyncio.to_thread(self._find_min_price, product_random_key, city_id, has_warranty)
                 if answer is not None:
                     message = f"{answer:.2f}"
                 else:
                     message = "0.00"
             elif task_type == "shop_count":
-                answer = self._find_shop_count(product_random_key, city_id, has_warranty)
+                answer = await asyncio.to_thread(self._find_shop_count, product_random_key, city_id, has_warranty)
                 if answer is not None:
                     message = str(answer)
                 else:
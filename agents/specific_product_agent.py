@@ -1,10 +1,14 @@
+import asyncio
+import logging
 import os
 import sys
 import time
+import unicodedata
 import json
-from typing import Dict, Any, List
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
 import re
-from openai import AsyncOpenAI
+import sqlite3
 from langchain.prompts import PromptTemplate
 import dotenv
 
@@ -12,23 +16,101 @@ import dotenv
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from response_format import Response
+from cache_utils import LRUCache
+from openai_client import get_client
 from embedding.classic_embedding import EmbeddingService, EmbeddingSimilarity
-from embedding.faiss_embedding import EmbeddingServiceWrapper, build_hnsw_from_texts, semantic_search
+from embedding.faiss_embedding import build_hnsw_from_texts, get_shared_embedder, semantic_search
 from system_prompts.extract_name_system_prompt import extracting_name_system_prompt, extracting_name_samples
 from system_prompts.find_important_part_system_prompt import find_important_part_system_prompt, \
     find_important_part_samples
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Few-shot blocks never change; build them once instead of on every call.
+_EXTRACT_NAME_FEW_SHOT = "\n".join(
+    f"ورودی: {sample['input']}\nخروجی: {sample['extracted_name']}"
+    for sample in extracting_name_samples[:5]  # استفاده از 5 نمونه اول
+)
+_IMPORTANT_PART_FEW_SHOT = "\n".join(
+    f"ورودی: {sample['input']}\nخروجی:\n" + "\n".join(sample['important_parts'])
+    for sample in find_important_part_samples
+)
+
+# Deterministic shapes of "I want <name>" requests; anything else goes to the LLM.
+# A quoted span is only taken when it is an exact catalog name (see _extract_product_name)
+_QUOTED_NAME_PATTERN = re.compile(r'[«"]([^«»"]{3,120})[»"]')
+_NAME_TEMPLATE_PATTERNS = (
+    re.compile(r'^(?:من\s+)?(?:به\s+)?دنبال\s+(?:خرید\s+)?(?:یک\s+|یه\s+)?(.{3,120}?)\s+(?:هستم|می[\u200c ]?گردم)\s*[.!؟?]?$'),
+    re.compile(r'^(?:یک\s+|یه\s+)?(.{3,120}?)\s+(?:را\s+)?می[\u200c ]?(?:خواهم|خواستم)\s*[.!؟?]?$'),
+)
+# A relative clause ("... که ۱ عددی است") means the name needs trimming the patterns can't do
+_CLAUSE_PATTERN = re.compile(r'(?:^|\s)که(?:\s|$)|[،,]\s*$')
+
+# Progressive prefix search as a range probe on idx_base_products_persian_name_lc
+# (db.create_db): same matches as LIKE 'prefix%' (ASCII case-insensitive), but
+# the index B-tree is walked instead of scanning every name on each miss
+_SQL_NAME_PREFIX = (
+    "SELECT random_key, persian_name FROM base_products "
+    "WHERE lower(persian_name) >= lower(?) AND lower(persian_name) < lower(?) || char(1114111) LIMIT 100"
+)
+
+# A unique FTS hit is trusted only for a query of at least two words that covers
+# at least half of the matched name; shorter, vaguer names go on to the LLM/embedding steps
+_FTS_MIN_WORDS = 2
+_FTS_MIN_COVERAGE = 0.5
+
+# Stage deadlines of process_query, so a slow LLM or a locked database fails the
+# request quickly. The database deadline only stops waiting: the query keeps
+# running in its worker thread (and holds its connection) until SQLite returns.
+_EXTRACTION_STAGE_TIMEOUT = float(os.getenv("PRODUCT_EXTRACTION_TIMEOUT", "15"))
+_DB_STAGE_TIMEOUT = float(os.getenv("PRODUCT_DB_TIMEOUT", "2"))
+_SEARCH_STAGE_TIMEOUT = float(os.getenv("PRODUCT_SEARCH_TIMEOUT", "10"))
+
+# search_product results keyed by the normalized name; subclasses (shop, feature,
+# comparison agents) resolve the same names turn after turn. Misses are cached too,
+# since they cost the most (LLM call + LIKE scans + embeddings).
+_search_cache = LRUCache(maxsize=512, ttl=300)
+
+# Header lines the model sometimes echoes back; str.startswith checks the whole tuple in one call
+_IMPORTANT_PART_HEADERS = ("بخش", "نام محصول", "ورودی", "خروجی")
+
+# Token normalization for the LIKE fallback, compiled / built once
+_ARABIC_TO_PERSIAN = str.maketrans({'ي': 'ی', 'ك': 'ک'})
+_PUNCTUATION_PATTERN = re.compile(r'[^\w\u0600-\u06FF]+')
+# Expanded list of common Persian stopwords
+_STOPWORDS = frozenset({
+    'و', 'با', 'که', 'برای', 'از', 'تا', 'در', 'به', 'یک', 'را', 'است', 'هست',
+})
+
+# Queries mix Arabic/Persian letters and Persian/Arabic/ASCII digits; the catalog
+# spells digits either way, so exact lookups try each digit spelling
+_TO_ASCII_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "01234567890123456789")
+_TO_PERSIAN_DIGITS = str.maketrans("0123456789٠١٢٣٤٥٦٧٨٩", "۰۱۲۳۴۵۶۷۸۹۰۱۲۳۴۵۶۷۸۹")
+
+
+@lru_cache(maxsize=4096)
+def _normalize(text: str) -> str:
+    """NFC, Persian Yeh/Kaf, trimmed; memoized since a query is normalized at several steps"""
+    return unicodedata.normalize("NFC", text).translate(_ARABIC_TO_PERSIAN).strip()
+
+
+@lru_cache(maxsize=4096)
+def _name_variants(name: str) -> tuple:
+    """The name as given, normalized, and with Persian / ASCII digits; deduplicated, in that order"""
+    normalized = _normalize(name)
+    return tuple(dict.fromkeys((
+        name, normalized, normalized.translate(_TO_PERSIAN_DIGITS), normalized.translate(_TO_ASCII_DIGITS)
+    )))
+
 
 class SpecificProductAgent:
     def __init__(self, db_path: str | None = None, embedding_similarity=None):
         self.db_path = db_path or os.getenv("PRODUCTS_DB_PATH") or "products.db"
         self._conn = None
-        self.client = AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            base_url=os.getenv("OPENAI_URL"),
-        )
+        # Shared across instances: keeps the HTTP connections to the API warm
+        self.client = get_client()
         self.embedding_similarity = embedding_similarity or EmbeddingSimilarity(
             embedding_service if 'embedding_service' in globals() else EmbeddingService({
                 'OPENAI_API_KEY': os.getenv("OPENAI_API_KEY"),
@@ -45,14 +127,16 @@ class SpecificProductAgent:
         if not query or not query.strip():
             return "نامشخص"
 
-        try:
-            # استفاده از نمونه‌ها برای few-shot learning
-            few_shot_examples = "\n".join([
-                f"ورودی: {sample['input']}\nخروجی: {sample['extracted_name']}"
-                for sample in extracting_name_samples[:5]  # استفاده از 5 نمونه اول
-            ])
+        normalized = _normalize(query)
+        quoted = _QUOTED_NAME_PATTERN.search(normalized)
+        if quoted and await self._find_exact(quoted.group(1).strip()):
+            return quoted.group(1).strip()
+        matched = self._extract_product_name_by_pattern(normalized)
+        if matched:
+            return matched
 
-            user_content = f"{few_shot_examples}\n\nورودی: {query}\nخروجی:"
+        try:
+            user_content = f"{_EXTRACT_NAME_FEW_SHOT}\n\nورودی: {query}\nخروجی:"
 
             model_name = os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini"
 
@@ -77,22 +161,26 @@ class SpecificProductAgent:
             return extracted if extracted else "نامشخص"
 
         except Exception as e:
-            print(f"Error in _extract_product_name: {e}")
+            logger.error("Error in _extract_product_name: %s", e)
             return "نامشخص"
 
+    @staticmethod
+    def _extract_product_name_by_pattern(query: str) -> Optional[str]:
+        """Return the product name when the query has a fixed request shape, else None (use the LLM)."""
+        text = query.strip()
+        for pattern in _NAME_TEMPLATE_PATTERNS:
+            m = pattern.match(text)
+            if m and not _CLAUSE_PATTERN.search(m.group(1)):
+                return m.group(1).strip()
+        return None
+
     async def _extract_most_important_part(self, product_name: str) -> List[str]:
         """Return list of important parts (phrases) of product name using LLM."""
         if not product_name or product_name == "نامشخص":
             return []
 
         try:
-            # استفاده از نمونه‌ها برای few-shot learning
-            few_shot_examples = "\n".join([
-                f"ورودی: {sample['input']}\nخروجی:\n" + "\n".join(sample['important_parts'])
-                for sample in find_important_part_samples  # استفاده از 3 نمونه اول
-            ])
-
-            user_content = f"{few_shot_examples}\n\nورودی: {product_name}\nخروجی:"
+            user_content = f"{_IMPORTANT_PART_FEW_SHOT}\n\nورودی: {product_name}\nخروجی:"
 
             model_name = os.getenv("OPENAI_MODEL") or os.getenv("CHAT_MODEL") or "gpt-4o-mini"
 
@@ -109,49 +197,98 @@ class SpecificProductAgent:
             if not raw or raw == "نامشخص":
                 return []
 
-            # Normalize lines, drop header variants
-            lines = [l.strip() for l in raw.splitlines() if l.strip()]
-            cleaned = []
-            for l in lines:
-                if l.startswith("بخش") or l.startswith("نام محصول") or l.startswith("ورودی") or l.startswith("خروجی"):
-                    continue
-                cleaned.append(l)
-
-            # Deduplicate preserving order
-            seen = set()
-            parts = []
-            for c in cleaned:
-                if c not in seen:
-                    seen.add(c)
-                    parts.append(c)
-            return parts
+            # Normalize lines, drop header variants and deduplicate preserving order, in one pass
+            lines = (l.strip() for l in raw.splitlines())
+            return list(dict.fromkeys(
+                l for l in lines if l and not l.startswith(_IMPORTANT_PART_HEADERS)
+            ))
 
         except Exception as e:
-            print(f"Error in _extract_most_important_part: {e}")
+            logger.error("Error in _extract_most_important_part: %s", e)
             return []
 
+    async def _find_exact(self, product_name: str) -> Dict[str, Any]:
+        """
+        Exact persian_name lookup off the event loop, over the name's spelling
+        variants in one indexed query (as given wins); {} when there is no such product.
+        """
+        variants = _name_variants(product_name)
+        placeholders = ",".join("?" * len(variants))
+        try:
+            row = await self.db.aquery_one(
+                f"SELECT random_key, persian_name FROM base_products WHERE persian_name IN ({placeholders}) "
+                "ORDER BY persian_name = ? DESC LIMIT 1",
+                (*variants, product_name)
+            )
+        except Exception:
+            return {}
+        if not row:
+            return {}
+        return {
+            "random_key": row["random_key"],
+            "persian_name": row["persian_name"],
+            "similarity": 1.0,
+            "match_type": "exact",
+        }
+
+    def _fts_unique_match(self, product_name: str) -> Dict[str, Any]:
+        """
+        Partial-name lookup on base_products_fts (db.create_db): every word of the
+        name must match. Returns the product only when the match is unambiguous and
+        the name is specific enough (_FTS_MIN_WORDS, _FTS_MIN_COVERAGE), {} otherwise
+        or when the FTS table doesn't exist.
+        """
+        words = [w for w in (w.replace('"', '') for w in product_name.split()) if w]
+        if len(words) < _FTS_MIN_WORDS:
+            return {}
+        match = " ".join(f'"{w}"' for w in words)
+        try:
+            rows = self.db.query(
+                "SELECT b.random_key, b.persian_name FROM base_products_fts f "
+                "JOIN base_products b ON b.rowid = f.rowid "
+                "WHERE base_products_fts MATCH ? LIMIT 2",
+                (match,)
+            )
+        except sqlite3.OperationalError:
+            return {}
+        if len(rows) != 1:
+            return {}
+        coverage = len(" ".join(words)) / max(len(rows[0]["persian_name"]), 1)
+        if coverage < _FTS_MIN_COVERAGE:
+            return {}
+        return {
+            "random_key": rows[0]["random_key"],
+            "persian_name": rows[0]["persian_name"],
+            "similarity": min(coverage, 1.0),
+            "match_type": "fuzzy",
+        }
+
     async def search_product(self, product_name: str) -> Dict[str, Any]:
         """
         Exact match -> progressive LIKE (truncate from end) -> embedding similarity ranking.
+        Results are memoized per normalized name for a few minutes.
         """
         if not product_name or product_name == "نامشخص":
             return {}
 
+        key = _normalize(product_name).lower()
+        cached = _search_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+        result = await self._search_product(product_name)
+        _search_cache.set(key, dict(result))
+        return result
+
+    async def _search_product(self, product_name: str) -> Dict[str, Any]:
         # Exact match
-        try:
-            result = self.db.query(
-                "SELECT random_key, persian_name FROM base_products WHERE persian_name = ? LIMIT 1",
-                (product_name,)
-            )
-            if result:
-                return {
-                    "random_key": result[0]["random_key"],
-                    "persian_name": result[0]["persian_name"],
-                    "similarity": 1.0,
-                    "match_type": "exact",
-                }
-        except Exception:
-            pass
+        exact = await self._find_exact(product_name)
+        if exact:
+            return exact
+
+        # Indexed partial match before the LLM-driven LIKE scans below
+        partial = await asyncio.to_thread(self._fts_unique_match, product_name)
+        if partial:
+            return partial
 
         # IMPORTANT PARTS BASED LIKE SEARCH (before progressive token truncation)
         important_parts = await self._extract_most_important_part(product_name)
@@ -171,7 +308,7 @@ class SpecificProductAgent:
                 like_pattern_2 = f"%{part2}%"
                 like_pattern_3 = f"%{part3}%"
                 try:
-                    rows = self.db.query(
+                    rows = await self.db.aquery(
                         "SELECT random_key, persian_name FROM base_products "
                         "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ?",
                         (like_pattern, like_pattern_2, like_pattern_3)
@@ -203,7 +340,7 @@ class SpecificProductAgent:
                     part_candidates = temp_part_candidates
 
             if len(part_candidates) >= 40:
-                print(" i am here")
+                logger.debug("%d part candidates, narrowing with 4-part combinations", len(part_candidates))
                 for idx, (part, part2, part3, part4) in enumerate(itertools.combinations(unique_parts, 4)):
                     if idx >= max_combos:
                         break
@@ -212,7 +349,7 @@ class SpecificProductAgent:
                     like_pattern_3 = f"%{part3}%"
                     like_pattern_4 = f"%{part4}%"
                     try:
-                        rows = self.db.query(
+                        rows = await self.db.aquery(
                             "SELECT random_key, persian_name FROM base_products "
                             "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ?",
                             (like_pattern, like_pattern_2, like_pattern_3, like_pattern_4)
@@ -267,7 +404,7 @@ class SpecificProductAgent:
                     }
 
             if part_candidates:
-                embedder = EmbeddingServiceWrapper()
+                embedder = get_shared_embedder()
                 # q_emb = await self.embedding_similarity.get_embedding(product_name)
                 cand_names = [c["persian_name"] for c in part_candidates]
                 p = [product_name, ]
@@ -290,7 +427,7 @@ class SpecificProductAgent:
                     like_pattern = f"%{part}%"
                     like_pattern_2 = f"%{part2}%"
                     try:
-                        rows = self.db.query(
+                        rows = await self.db.aquery(
                             "SELECT random_key, persian_name FROM base_products "
                             "WHERE persian_name LIKE ? AND persian_name LIKE ? AND persian_name LIKE ?",
                             (like_pattern, like_pattern_2)
@@ -341,7 +478,7 @@ class SpecificProductAgent:
                         break
                     like_pattern = f"%{part}%"
                     try:
-                        rows = self.db.query(
+                        rows = await self.db.aquery(
                             "SELECT random_key, persian_name FROM base_products "
                             "WHERE persian_name LIKE ? LIMIT 100",
                             (like_pattern,)
@@ -359,7 +496,7 @@ class SpecificProductAgent:
                         })
 
             if part_candidates:
-                embedder = EmbeddingServiceWrapper()
+                embedder = get_shared_embedder()
                 # q_emb = await self.embedding_similarity.get_embedding(product_name)
                 cand_names = [c["persian_name"] for c in part_candidates]
                 p = [product_name, ]
@@ -378,11 +515,11 @@ class SpecificProductAgent:
 
                     # Compute best scored candidate without sorting dicts
             end = time.time()
-            print(
-                f"Important parts DB search time: {end - start:.2f} seconds, found {len(part_candidates)} candidates from {total_parts} parts")
+            logger.debug("Important parts DB search time: %.2f seconds, found %d candidates from %d parts",
+                         end - start, len(part_candidates), total_parts)
             # print(part_candidates)
             if part_candidates:
-                embedder = EmbeddingServiceWrapper()
+                embedder = get_shared_embedder()
                 # q_emb = await self.embedding_similarity.get_embedding(product_name)
                 cand_names = [c["persian_name"] for c in part_candidates]
                 p = [product_name, ]
@@ -404,14 +541,10 @@ class SpecificProductAgent:
         candidates = []
         while tokens:
             prefix = " ".join(tokens)
-            like_pattern = f"{prefix}%"
             try:
-                result = self.db.query(
-                    "SELECT random_key, persian_name FROM base_products WHERE persian_name LIKE ? LIMIT 100",
-                    (like_pattern,)
-                )
+                result = await self.db.aquery(_SQL_NAME_PREFIX, (prefix, prefix))
                 if result:
-                    print(len(result))
+                    logger.debug("Prefix %r matched %d products", prefix, len(result))
                     for r in result:
                         candidates.append({"random_key": r["random_key"], "persian_name": r["persian_name"]})
                     break
@@ -449,19 +582,13 @@ class SpecificProductAgent:
 
     def norm(self, token: str) -> str:
         """Normalize token by removing punctuation and standardizing characters"""
-        PUNCTUATION_PATTERN = re.compile(r'[^\w\u0600-\u06FF]+')
         t = token.strip()
-        t = t.replace('ي', 'ی').replace('ك', 'ک')
-        t = PUNCTUATION_PATTERN.sub('', t)
+        t = t.translate(_ARABIC_TO_PERSIAN)
+        t = _PUNCTUATION_PATTERN.sub('', t)
         return t
 
     def trim_trailing_stopwords(self, tokens):
         """Remove ALL stopwords from anywhere in the token list"""
-        # Expanded list of common Persian stopwords
-        STOPWORDS = {
-            'و', 'با', 'که', 'برای', 'از', 'تا', 'در', 'به', 'یک', 'را', 'است', 'هست',
-        }
-
         # Create a copy to avoid modifying the original list
         tokens = tokens.copy()
 
@@ -471,7 +598,7 @@ class SpecificProductAgent:
             normalized_token = self.norm(token)
 
             # Check if the normalized token is a stopword
-            if normalized_token not in STOPWORDS and token not in STOPWORDS:
+            if normalized_token not in _STOPWORDS and token not in _STOPWORDS:
                 filtered_tokens.append(token)
 
         return filtered_tokens
@@ -480,8 +607,28 @@ class SpecificProductAgent:
         """
         Orchestrate extraction + search.
         """
-        product_name = await self._extract_product_name(query)
-        result = await self.search_product(product_name)
+        # Users often paste the exact catalog name; look it up while the extraction LLM call is in flight
+        extraction = asyncio.create_task(self._extract_product_name(query))
+        try:
+            async with asyncio.timeout(_DB_STAGE_TIMEOUT):
+                result = await self._find_exact((query or "").strip())
+        except TimeoutError:
+            result = {}
+        if result:
+            extraction.cancel()
+        else:
+            try:
+                async with asyncio.timeout(_EXTRACTION_STAGE_TIMEOUT):
+                    product_name = await extraction
+            except TimeoutError:
+                logger.error("Product name extraction timed out after %ss", _EXTRACTION_STAGE_TIMEOUT)
+                product_name = "نامشخص"
+            try:
+                async with asyncio.timeout(_SEARCH_STAGE_TIMEOUT):
+                    result = await self.search_product(product_name)
+            except TimeoutError:
+                logger.error("Product search timed out after %ss", _SEARCH_STAGE_TIMEOUT)
+                result = {}
         base_keys = [result["random_key"]] if result else []
         if result:
             msg = "null"
@@ -491,8 +638,6 @@ class SpecificProductAgent:
         return Response(message=msg, base_random_keys=base_keys, member_random_keys=[])
 
 
-import asyncio
-
 embedding_service = EmbeddingService({
     'OPENAI_API_KEY': os.getenv("OPENAI_API_KEY"),
     'OPENAI_URL': os.getenv("OPENAI_URL")
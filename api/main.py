@@ -12,7 +12,7 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 
@@ -28,6 +28,11 @@ from .validators import (
 from .logging_config import setup_logging, log_http_request, log_chat_interaction
 from .session_manager import cleanup_sessions
 from router import Router
+from db.base import close_all_connections
+from db.create_db import ensure_indexes
+from embedding.faiss_embedding import get_shared_embedder
+from embedding.persistent_cache import warm_start
+from features_list import features_dict
 from response_format import Response
 
 # Configure enhanced logging
@@ -59,9 +64,18 @@ async def initialize_services():
     global router
     
     try:
+        # Make sure the query-path indexes exist on the mounted database
+        try:
+            await asyncio.to_thread(ensure_indexes)
+        except Exception as e:
+            logger.warning(f"Could not ensure database indexes: {e}")
+        
         # Initialize router with existing configuration
         router = Router()
         
+        # Fill the embedding cache in the background; requests don't wait for it
+        asyncio.create_task(warm_feature_embeddings())
+        
         logger.info("All services initialized successfully!")
         
     except Exception as e:
@@ -69,6 +83,15 @@ async def initialize_services():
         raise
 
 
+async def warm_feature_embeddings():
+    """Pre-embed the feature-name vocabulary into the on-disk embedding cache"""
+    try:
+        count = await warm_start(features_dict.values(), get_shared_embedder())
+        logger.info(f"Feature embeddings warmed: {count} texts")
+    except Exception as e:
+        logger.warning(f"Could not warm feature embeddings: {e}")
+
+
 async def cleanup_services():
     """Cleanup all services and close connections"""
     global router
@@ -79,6 +102,8 @@ async def cleanup_services():
             router = None
             logger.info("Router cleaned up successfully!")
         
+        close_all_connections()
+        
         # Cleanup HTTP sessions
         await cleanup_sessions()
         logger.info("HTTP sessions cleaned up successfully!")
@@ -160,7 +185,10 @@ async def log_requests(request: Request, call_next):
     
     # Log response content for POST requests
     response_content = None
-    if request.method == "POST" and response.status_code == 200:
+    # Streamed (NDJSON) responses are passed through untouched; buffering them here
+    # would hold every line back until the whole answer is done
+    if (request.method == "POST" and response.status_code == 200
+            and response.headers.get("content-type", "").startswith("application/json")):
         try:
             # Get response body
             response_body = b""
@@ -376,6 +404,103 @@ async def download_page():
     return FileResponse("download_logs.html")
 
 
+def _parse_chat_request(request: ChatRequest):
+    """(user_query, image_query) of a chat request; raises HTTPException on invalid input"""
+    # Validate request
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="No messages provided")
+
+    # Validate chat ID
+    if not validate_chat_id(request.chat_id):
+        raise HTTPException(status_code=400, detail="Invalid chat ID format")
+
+    # Process all messages to extract text and image content
+    user_query = ""
+    image_query = None
+
+    logger.info(f"Processing {len(request.messages)} messages")
+
+    for i, message in enumerate(request.messages):
+        logger.info(f"Message {i+1}: type={message.type}, content_length={len(message.content)}")
+
+        # Validate message type
+        validate_message_type(message.type)
+
+        if message.type == "text":
+            # Extract text content and append to user query
+            text_content = validate_text_content(message.content)
+            if user_query:
+                user_query += " " + text_content
+            else:
+                user_query = text_content
+
+            # Check if text contains image URL pattern @https://
+            import re
+            image_url_pattern = r'@(https?://[^\s]+)'
+            image_matches = re.findall(image_url_pattern, message.content)
+            if image_matches:
+                # Use the first image URL found
+                image_query = image_matches[0]
+                logger.info(f"Found image URL in text: {image_query}")
+
+        elif message.type == "image":
+            # Handle image content - could be base64 data URL or regular URL
+            image_content = message.content.strip()
+
+            # Check if it's a base64 data URL
+            if image_content.startswith('data:image/'):
+                # Extract base64 data from data URL
+                try:
+                    # Format: data:image/jpeg;base64,/9j/4AAQSkZJRgABAQ...
+                    header, base64_data = image_content.split(',', 1)
+                    image_query = base64_data
+                    logger.info(f"Found base64 image data: {len(base64_data)} characters")
+                except ValueError:
+                    raise HTTPException(status_code=400, detail="Invalid base64 image format")
+            elif image_content.startswith(('http://', 'https://')):
+                # Handle URL format
+                image_query = image_content
+                logger.info(f"Found image URL: {image_query}")
+            else:
+                # Assume it's raw base64 data without data URL prefix
+                image_query = image_content
+                logger.info(f"Found raw base64 image data: {len(image_content)} characters")
+
+    # Ensure we have at least some text content
+    if not user_query.strip():
+        user_query = "تصویر"  # Default text for image-only requests
+
+    return user_query, image_query
+
+
+def _to_chat_response(response: Response) -> ChatResponse:
+    """Sanitized ChatResponse for a router Response"""
+    # Convert Response object to ChatResponse format
+    response_message = response.message
+    base_random_keys = response.base_random_keys
+    member_random_keys = response.member_random_keys
+
+    logger.info(f"Router response - message: {repr(response_message)}, base_keys: {base_random_keys}, member_keys: {member_random_keys}")
+
+    # Handle null message case first - return None for JSON null
+    if response_message is None or response_message == "null":
+        response_message = None
+    else:
+        response_message = sanitize_response_message(response_message)
+
+    base_random_keys = validate_random_keys(base_random_keys, max_count=200)
+    member_random_keys = validate_random_keys(member_random_keys, max_count=200)
+
+    # Log response details
+    logger.info(f"Chat response prepared - Message: {repr(response_message)}, Keys count: {len(base_random_keys or [])}")
+
+    return ChatResponse(
+        message=response_message,
+        base_random_keys=base_random_keys,
+        member_random_keys=member_random_keys
+    )
+
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
@@ -391,94 +516,15 @@ async def chat(
     chat_start_time = time.time()
     
     try:
-        # Validate request
-        if not request.messages:
-            raise HTTPException(status_code=400, detail="No messages provided")
-        
-        # Validate chat ID
-        if not validate_chat_id(request.chat_id):
-            raise HTTPException(status_code=400, detail="Invalid chat ID format")
-        
-        # Process all messages to extract text and image content
-        user_query = ""
-        image_query = None
-        
-        logger.info(f"Processing {len(request.messages)} messages")
-        
-        for i, message in enumerate(request.messages):
-            logger.info(f"Message {i+1}: type={message.type}, content_length={len(message.content)}")
-            
-            # Validate message type
-            validate_message_type(message.type)
-            
-            if message.type == "text":
-                # Extract text content and append to user query
-                text_content = validate_text_content(message.content)
-                if user_query:
-                    user_query += " " + text_content
-                else:
-                    user_query = text_content
-                    
-                # Check if text contains image URL pattern @https://
-                import re
-                image_url_pattern = r'@(https?://[^\s]+)'
-                image_matches = re.findall(image_url_pattern, message.content)
-                if image_matches:
-                    # Use the first image URL found
-                    image_query = image_matches[0]
-                    logger.info(f"Found image URL in text: {image_query}")
-                    
-            elif message.type == "image":
-                # Handle image content - could be base64 data URL or regular URL
-                image_content = message.content.strip()
-                
-                # Check if it's a base64 data URL
-                if image_content.startswith('data:image/'):
-                    # Extract base64 data from data URL
-                    try:
-                        # Format: data:image/jpeg;base64,/9j/4AAQSkZJRgABAQ...
-                        header, base64_data = image_content.split(',', 1)
-                        image_query = base64_data
-                        logger.info(f"Found base64 image data: {len(base64_data)} characters")
-                    except ValueError:
-                        raise HTTPException(status_code=400, detail="Invalid base64 image format")
-                elif image_content.startswith(('http://', 'https://')):
-                    # Handle URL format
-                    image_query = image_content
-                    logger.info(f"Found image URL: {image_query}")
-                else:
-                    # Assume it's raw base64 data without data URL prefix
-                    image_query = image_content
-                    logger.info(f"Found raw base64 image data: {len(image_content)} characters")
-        
-        # Ensure we have at least some text content
-        if not user_query.strip():
-            user_query = "تصویر"  # Default text for image-only requests
-            
+        user_query, image_query = _parse_chat_request(request)
+
         logger.info(f"Final query: '{user_query}', Image: {image_query is not None}")
         
         # Process the query through the existing router
         response = await router_instance.route(request.chat_id, user_query, image_query)
 
-        # Convert Response object to ChatResponse format
-        response_message = response.message
-        base_random_keys = response.base_random_keys
-        member_random_keys = response.member_random_keys
+        chat_response = _to_chat_response(response)
 
-        logger.info(f"Router response - message: {repr(response_message)}, base_keys: {base_random_keys}, member_keys: {member_random_keys}")
-        
-        # Handle null message case first - return None for JSON null
-        if response_message is None or response_message == "null":
-            response_message = None
-        else:
-            response_message = sanitize_response_message(response_message)
-        
-        base_random_keys = validate_random_keys(base_random_keys, max_count=200)
-        member_random_keys = validate_random_keys(member_random_keys, max_count=200)
-        
-        # Log response details
-        logger.info(f"Chat response prepared - Message: {repr(response_message)}, Keys count: {len(base_random_keys or [])}")
-        
         # Calculate total processing time
         total_process_time = time.time() - chat_start_time
         
@@ -487,18 +533,11 @@ async def chat(
             chat_id=request.chat_id,
             user_query=user_query,
             agent_type="ROUTER",  # Since we're using the router directly
-            response_message=response_message,
-            keys_count=len(base_random_keys or []),
+            response_message=chat_response.message,
+            keys_count=len(chat_response.base_random_keys or []),
             process_time=total_process_time
         )
         
-        # Create and return the response
-        chat_response = ChatResponse(
-            message=response_message,
-            base_random_keys=base_random_keys,
-            member_random_keys=member_random_keys
-        )
-        
         logger.info(f"Returning ChatResponse - message: {repr(chat_response.message)}")
         return chat_response
         
@@ -524,6 +563,50 @@ async def chat(
             )
 
 
+@app.post("/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    router_instance: Router = Depends(get_router)
+):
+    """
+    Same as /chat, but streamed as NDJSON: one ChatResponse per line. A comparison
+    sends its explanation progressively as it is written; the last line is the
+    final response (with the winner's key), identical to what /chat returns.
+    """
+    logger.info(f"Streaming chat request received - Chat ID: {request.chat_id}, Messages count: {len(request.messages)}")
+    try:
+        user_query, image_query = _parse_chat_request(request)
+    except TorobAPIException as e:
+        logger.error(f"Torob API error: {e.message}")
+        raise HTTPException(status_code=400, detail=e.message)
+
+    async def lines():
+        chat_start_time = time.time()
+        chat_response = None
+        try:
+            async for response in router_instance.route_stream(request.chat_id, user_query, image_query):
+                chat_response = _to_chat_response(response)
+                yield chat_response.model_dump_json() + "\n"
+        except Exception as e:
+            logger.error(f"Unexpected error processing streaming chat request: {e}")
+            chat_response = ChatResponse(
+                message="متأسفم، خطایی در پردازش درخواست شما رخ داده است. لطفا دوباره تلاش کنید.",
+                base_random_keys=None,
+                member_random_keys=None
+            )
+            yield chat_response.model_dump_json() + "\n"
+        log_chat_interaction(
+            chat_id=request.chat_id,
+            user_query=user_query,
+            agent_type="ROUTER",
+            response_message=chat_response.message if chat_response else None,
+            keys_count=len(chat_response.base_random_keys or []) if chat_response else 0,
+            process_time=time.time() - chat_start_time
+        )
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """Global exception handler"""
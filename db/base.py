@@ -13,14 +13,74 @@ Usage:
 Author: Torob AI Team
 """
 
+import asyncio
 import sqlite3
 import os
+import threading
 from db.config import get_db_path
 
+# Connection pool: one connection per (thread, database file), shared by every
+# loader. Agents are built per request and run queries through
+# asyncio.to_thread, so this bounds the pool to the worker threads and keeps
+# each connection's compiled-statement cache warm across requests.
+_pool = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+# Bumped by close_all_connections so other threads drop their closed handles
+_pool_generation = 0
+
+# Compiled statements kept per connection, keyed by SQL text
+STATEMENT_CACHE_SIZE = 256
+
+
+def _open_connection(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute("PRAGMA foreign_keys = ON")
+    # WAL lets the pooled readers run while an agent writes (exploration state);
+    # NORMAL sync is durable under WAL without an fsync per commit
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+    except sqlite3.OperationalError:
+        pass  # read-only location: keep the default journal
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.row_factory = sqlite3.Row
+    with _all_connections_lock:
+        _all_connections.append(conn)
+    return conn
+
+
+def _pooled_connection(db_path):
+    conns = getattr(_pool, "conns", None)
+    if conns is None or getattr(_pool, "generation", None) != _pool_generation:
+        conns = _pool.conns = {}
+        _pool.generation = _pool_generation
+    conn = conns.get(db_path)
+    if conn is None:
+        conn = conns[db_path] = _open_connection(db_path)
+    return conn
+
+
+def close_all_connections():
+    """Close every pooled connection (call once at shutdown)."""
+    global _pool_generation
+    with _all_connections_lock:
+        _pool_generation += 1
+        for conn in _all_connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _all_connections.clear()
+
+
 class DatabaseBaseLoader:
     """
     Simple base class for database operations.
     Handles connection, queries, and proper cleanup.
+    
+    Queries run on the calling thread's pooled connection, so the same SQL
+    text reuses its prepared statement and parallel asyncio.to_thread
+    queries don't serialize on one connection.
     """
     
     def __init__(self, db_path=None):
@@ -39,9 +99,12 @@ class DatabaseBaseLoader:
         if not os.path.exists(self.db_path):
             raise FileNotFoundError(f"Database not found at {self.db_path}")
         
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.execute("PRAGMA foreign_keys = ON")
-        self.conn.row_factory = sqlite3.Row
+        self.conn = _pooled_connection(self.db_path)
+
+    def _connection(self):
+        if not self.conn:
+            raise RuntimeError("No database connection")
+        return _pooled_connection(self.db_path)
     
     def query(self, sql, params=None):
         """
@@ -54,11 +117,22 @@ class DatabaseBaseLoader:
         Returns:
             list: Query results
         """
-        if not self.conn:
-            raise RuntimeError("No database connection")
-        
-        cursor = self.conn.execute(sql, params or ())
+        cursor = self._connection().execute(sql, params or ())
         return cursor.fetchall()
+
+    def query_one(self, sql, params=None):
+        """
+        Execute a SELECT query and return the first row (or None).
+        
+        Args:
+            sql (str): SQL query string
+            params (tuple, optional): Query parameters
+            
+        Returns:
+            sqlite3.Row | None: First result row
+        """
+        cursor = self._connection().execute(sql, params or ())
+        return cursor.fetchone()
     
     def execute(self, sql, params=None):
         """
@@ -71,18 +145,29 @@ class DatabaseBaseLoader:
         Returns:
             int: Number of affected rows
         """
-        if not self.conn:
-            raise RuntimeError("No database connection")
-        
-        cursor = self.conn.execute(sql, params or ())
-        self.conn.commit()
+        conn = self._connection()
+        cursor = conn.execute(sql, params or ())
+        conn.commit()
         return cursor.rowcount
+
+    # Awaitable variants for async callers: the query runs on a worker
+    # thread's pooled connection, so the event loop is never blocked and
+    # concurrent chats overlap their database I/O.
+    async def aquery(self, sql, params=None):
+        """Async query(): list of rows."""
+        return await asyncio.to_thread(self.query, sql, params)
+
+    async def aquery_one(self, sql, params=None):
+        """Async query_one(): first row or None."""
+        return await asyncio.to_thread(self.query_one, sql, params)
+
+    async def aexecute(self, sql, params=None):
+        """Async execute(): number of affected rows."""
+        return await asyncio.to_thread(self.execute, sql, params)
     
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        """Release this loader; pooled connections stay open for other loaders."""
+        self.conn = None
 
 if __name__ == "__main__":
     db = DatabaseBaseLoader()
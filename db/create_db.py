@@ -265,6 +265,140 @@ CREATE INDEX IF NOT EXISTS idx_final_clicks_shop      ON final_clicks(shop_id);
 CREATE INDEX IF NOT EXISTS idx_final_clicks_ts        ON final_clicks(timestamp);
 """
 
+# Indexes for the agents' hot query paths. Kept apart from `ddl` because the
+# loaders recreate tables with pandas.to_sql(if_exists='replace'), which drops
+# indexes; ensure_indexes() re-applies this script after loading and at API startup.
+index_ddl = """
+-- Per-product member lookups answered from the index alone: product stats
+-- (count / avg / min / max price) and the exploration agent's member search
+-- (filter on base_random_key, ORDER BY price, random_key). Supersedes idx_members_brk_price.
+DROP INDEX IF EXISTS idx_members_brk_price;
+CREATE INDEX IF NOT EXISTS idx_members_brk_price_rk ON members(base_random_key, price, random_key, shop_id);
+-- Shop filters of the member search (city, warranty, minimum score)
+CREATE INDEX IF NOT EXISTS idx_shops_city_warranty_score ON shops(city_id, has_warranty, score);
+-- Exact product-name lookups of the specific-product agent
+CREATE INDEX IF NOT EXISTS idx_base_products_persian_name ON base_products(persian_name);
+-- Their progressive prefix search (range on lower(name), i.e. LIKE 'prefix%' semantics)
+CREATE INDEX IF NOT EXISTS idx_base_products_persian_name_lc ON base_products(lower(persian_name));
+"""
+
+
+# Full-text indexes over the catalog names, used by the exploration agent to
+# resolve brand/category/city names before falling back to embeddings, and by
+# the specific-product agent for partial product names instead of LIKE '%..%' scans.
+# External-content FTS5 tables kept in sync by triggers; the trigram tokenizer
+# matches substrings, so partial or misspelled-suffix names still hit.
+# (table, column, rowid column). base_products is keyed by TEXT, so its FTS rows follow the
+# implicit rowid; VACUUM may renumber that, which the rebuild after each load repairs.
+catalog_fts_tables = (
+    ("brands", "title", "id"),
+    ("categories", "title", "id"),
+    ("cities", "name", "id"),
+    ("base_products", "persian_name", "rowid"),
+)
+
+catalog_fts_ddl = """
+CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({column}, content='{table}', content_rowid='{key}', tokenize='{tokenizer}');
+CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN
+    INSERT INTO {table}_fts(rowid, {column}) VALUES (new.{key}, new.{column});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN
+    INSERT INTO {table}_fts({table}_fts, rowid, {column}) VALUES ('delete', old.{key}, old.{column});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE ON {table} BEGIN
+    INSERT INTO {table}_fts({table}_fts, rowid, {column}) VALUES ('delete', old.{key}, old.{column});
+    INSERT INTO {table}_fts(rowid, {column}) VALUES (new.{key}, new.{column});
+END;
+"""
+
+catalog_fts_rebuild = "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')"
+
+
+def ensure_catalog_fts(con, rebuild=False):
+    """
+    Create the catalog FTS5 tables and their sync triggers. An index is only
+    rebuilt (a full scan of its table) when it is new, when its triggers were
+    dropped because a loader replaced the table, or when rebuild is set;
+    otherwise the triggers already keep it in sync.
+    """
+    for table, column, key in catalog_fts_tables:
+        existing = {row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE name IN (?, ?)", (f"{table}_fts", f"{table}_fts_ai")
+        )}
+        stale = rebuild or len(existing) < 2
+        # trigram needs SQLite >= 3.34; older builds fall back to word tokens
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                con.executescript(catalog_fts_ddl.format(table=table, column=column, key=key, tokenizer=tokenizer))
+                if stale:
+                    con.execute(catalog_fts_rebuild.format(table=table))
+                    con.commit()
+                break
+            except sqlite3.OperationalError as e:
+                if "tokenizer" in str(e):
+                    continue
+                # Table not loaded yet, or SQLite built without FTS5
+                print(f"  [WARNING] Skipping full-text index on {table}: {e}")
+                break
+
+
+def ensure_indexes(db_path=None, rebuild_fts=False):
+    """
+    Create any missing query-path indexes on an existing database (idempotent).
+    Loaders pass rebuild_fts=True so the full-text indexes pick up the new rows.
+    """
+    db_path = db_path or DB_PATH
+    con = sqlite3.connect(db_path)
+    try:
+        for statement in index_ddl.split(";"):
+            sql = "\n".join(line for line in statement.splitlines() if not line.strip().startswith("--")).strip()
+            if not sql:
+                continue
+            try:
+                con.execute(sql)
+            except sqlite3.OperationalError as e:
+                # Table not loaded yet (e.g. single-table loads); applied on the next run
+                print(f"  [WARNING] Skipping index: {e}")
+        con.commit()
+        # The loaders replace tables, which drops the triggers; recreate and resync
+        ensure_catalog_fts(con, rebuild=rebuild_fts)
+    finally:
+        con.close()
+
+# Per-product aggregates over members/shops/cities. The catalog only changes when
+# the loaders run, so the comparison agent reads one indexed row instead of
+# aggregating members on every request. Rebuilt by refresh_product_stats().
+product_stats_select = """
+SELECT m.base_random_key                                            AS random_key,
+       COUNT(DISTINCT m.shop_id)                                    AS shop_count,
+       AVG(m.price)                                                 AS mean_price,
+       MIN(m.price)                                                 AS min_price,
+       MAX(m.price)                                                 AS max_price,
+       COUNT(DISTINCT CASE WHEN s.has_warranty = 1 THEN m.shop_id END) AS warranty_count,
+       COUNT(DISTINCT c.id)                                         AS city_count
+FROM members m
+LEFT JOIN shops s  ON m.shop_id = s.id
+LEFT JOIN cities c ON s.city_id = c.id
+"""
+
+
+def refresh_product_stats(db_path=None):
+    """(Re)build the product_stats table; the old table stays readable until the swap."""
+    db_path = db_path or DB_PATH
+    con = sqlite3.connect(db_path)
+    try:
+        con.execute("DROP TABLE IF EXISTS product_stats_new")
+        con.execute(f"CREATE TABLE product_stats_new AS {product_stats_select} GROUP BY m.base_random_key")
+        with con:
+            con.execute("DROP TABLE IF EXISTS product_stats")
+            con.execute("ALTER TABLE product_stats_new RENAME TO product_stats")
+            con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_ps_rk ON product_stats(random_key)")
+        count = con.execute("SELECT COUNT(*) FROM product_stats").fetchone()[0]
+        print(f"  [OK] product_stats refreshed for {count:,} products")
+    finally:
+        con.close()
+
+
 def init_db(db_path=None, force_recreate=False):
     """Initialize the Torob database with complete schema.
     
@@ -315,6 +449,7 @@ def init_db(db_path=None, force_recreate=False):
                     if product_count > 0:
                         print(f"✅ Database already exists with {product_count:,} products: {db_path}")
                         print(f"📊 Dataset is already loaded. Skipping database creation.")
+                        ensure_indexes(db_path)
                         return True
                     else:
                         print(f"⚠️ Database exists but is empty. Recreating...")
@@ -333,6 +468,7 @@ def init_db(db_path=None, force_recreate=False):
         try:
             # Execute the complete DDL script
             con.executescript(ddl)
+            con.executescript(index_ddl)
             con.commit()
             
             # Verify tables were created
@@ -476,6 +612,9 @@ if __name__ == "__main__":
     # Check command line arguments
     if len(sys.argv) > 1 and sys.argv[1] == '--info':
         show_schema_info()
+    elif len(sys.argv) > 1 and sys.argv[1] == '--refresh-stats':
+        # Run after every data load (or from a nightly job)
+        refresh_product_stats()
     elif len(sys.argv) > 1 and sys.argv[1] == '--force':
         # Force recreate database
         print("🔄 Force recreating database...")
@@ -499,6 +638,7 @@ if __name__ == "__main__":
             print(f"\n💡 Options:")
             print(f"   --info: Show schema information")
             print(f"   --force: Force recreate database")
+            print(f"   --refresh-stats: Rebuild the product_stats table")
         else:
             print(f"❌ Database creation failed!")
             sys.exit(1)
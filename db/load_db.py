@@ -2,6 +2,7 @@ import sqlite3
 import pandas as pd
 import os
 from db.config import get_db_path, get_backup_path, ensure_data_directory
+from db.create_db import ensure_indexes, refresh_product_stats
 
 # Global dictionaries to store string-to-integer ID mappings
 id_mappings = {
@@ -237,6 +238,9 @@ def load_all_data():
         load_final_clicks(con, backup_path)  # depends on base_views, shops
         
         con.commit()
+        # to_sql(if_exists='replace') dropped the schema indexes; restore the hot-path ones
+        ensure_indexes(db_path, rebuild_fts=True)
+        refresh_product_stats(db_path)
         print("=" * 50)
         print("[SUCCESS] All data loaded successfully!")
         
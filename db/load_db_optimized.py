@@ -24,6 +24,7 @@ import os
 import gc
 import argparse
 from db.config import get_db_path, get_backup_path, ensure_data_directory
+from db.create_db import ensure_indexes, refresh_product_stats
 
 # Global dictionaries to store string-to-integer ID mappings
 id_mappings = {
@@ -532,6 +533,15 @@ def load_all_data_optimized(chunk_size: int = 10000, table_name: str = None):
             # Force garbage collection
             gc.collect()
         
+        # to_sql(if_exists='replace') dropped the schema indexes; restore the hot-path ones
+        ensure_indexes(db_path, rebuild_fts=True)
+        # Stats depend on members/shops/cities; skip when none of them was (re)loaded
+        if {name for name, _ in loading_order} & {'members', 'shops', 'cities'}:
+            try:
+                refresh_product_stats(db_path)
+            except sqlite3.OperationalError as e:
+                print(f"  [WARNING] product_stats not refreshed: {e}")
+        
         print("\n" + "=" * 60)
         print("[SUCCESS] All data loaded successfully!")
         
@@ -0,0 +1,60 @@
+import hashlib
+import os
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+
+from cache_utils import LRUCache
+from embedding.faiss_embedding import EmbeddingServiceWrapper, get_shared_embedder
+
+
+class CachedEmbedder:
+    """
+    In-memory LRU+TTL front for an embedder, for short strings that users
+    repeat across turns (brand, category and city names).
+
+    Keys are sha256(model:text) and vectors are kept as float16 to halve the
+    memory; only cache misses are sent to the wrapped embedder, in one batch.
+    Exposes the same ``embed_batch`` interface, so it can be passed anywhere
+    an ``EmbeddingServiceWrapper`` is expected.
+    """
+
+    def __init__(self, embedder: EmbeddingServiceWrapper, maxsize: int = 10000, ttl: float = 3600):
+        self.embedder = embedder
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    @property
+    def dim_fallback(self) -> int:
+        return self.embedder.dim_fallback
+
+    @property
+    def enabled(self) -> bool:
+        return self.embedder.enabled
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(f"{os.getenv('EMBEDDING_MODEL', '')}:{text}".encode("utf-8")).hexdigest()
+
+    async def embed_batch(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim_fallback), dtype=np.float32)
+
+        keys = [self._key(t) for t in texts]
+        vectors = [self._cache.get(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            fresh = await self.embedder.embed_batch([texts[i] for i in missing])
+            for i, vec in zip(missing, fresh):
+                vectors[i] = np.asarray(vec, dtype=np.float16)
+                self._cache.set(keys[i], vectors[i])
+        return np.vstack(vectors).astype(np.float32)
+
+    async def embed_one(self, text: str) -> np.ndarray:
+        return (await self.embed_batch([text]))[0]
+
+
+@lru_cache(maxsize=1)
+def get_cached_embedder() -> CachedEmbedder:
+    """Process-wide CachedEmbedder over the shared embedder"""
+    return CachedEmbedder(get_shared_embedder())
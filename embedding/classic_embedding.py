@@ -1,4 +1,4 @@
-from openai import AsyncOpenAI
+from openai_client import get_client
 from typing import List, Dict, Any
 import dotenv
 import os
@@ -9,10 +9,7 @@ dotenv.load_dotenv()
 class EmbeddingService:
     def __init__(self, config: Dict[str, Any]):
         self.config = config
-        self.client = AsyncOpenAI(
-            api_key=config['OPENAI_API_KEY'],
-            base_url=os.getenv("OPENAI_URL")
-        )
+        self.client = get_client()
         self.model = os.getenv("EMBEDDING_MODEL")
 
     async def run(self, text: str):
@@ -10,9 +10,10 @@ import pickle
 import hashlib
 from functools import lru_cache
 
-# Try to reuse existing embedding service if available
+# Try to reuse existing embedding service if available (AsyncOpenAI, so the
+# API calls never block the event loop)
 try:
-    from embedding import EmbeddingService as _EmbeddingService
+    from embedding.classic_embedding import EmbeddingService as _EmbeddingService
 except Exception:  # pragma: no cover - fallback
     _EmbeddingService = None
 
@@ -51,10 +52,10 @@ class EmbeddingServiceWrapper:
         except FileNotFoundError:
             return {}
 
-    def _save_cache(self):
-        """Save embeddings cache to disk"""
+    def _save_cache(self, snapshot: Optional[Dict[str, List[float]]] = None):
+        """Save embeddings cache (or a snapshot of it) to disk"""
         with open(self.cache_file, 'wb') as f:
-            pickle.dump(self.cache, f)
+            pickle.dump(self.cache if snapshot is None else snapshot, f)
 
     def _get_cache_key(self, text: str) -> str:
         """Generate cache key for text"""
@@ -72,7 +73,7 @@ class EmbeddingServiceWrapper:
         if self.session:
             await self.session.close()
         # Save cache on exit
-        self._save_cache()
+        await asyncio.to_thread(self._save_cache, dict(self.cache))
 
     async def embed_one(self, text: str) -> List[float]:
         # Check cache first
@@ -148,13 +149,23 @@ class EmbeddingServiceWrapper:
             if cache_key in self.cache:
                 results[i] = self.cache[cache_key]
 
-        # Save cache periodically
+        # Save cache periodically; pickling and the write run in a worker thread
+        # on a snapshot, so other requests keep embedding meanwhile
         if len(self.cache) % 1000 == 0:
-            self._save_cache()
+            await asyncio.to_thread(self._save_cache, dict(self.cache))
 
         return np.array(results, dtype=np.float32)
 
 
+@lru_cache(maxsize=1)
+def get_shared_embedder() -> EmbeddingServiceWrapper:
+    """
+    Process-wide embedder. Building one loads the pickle cache from disk and
+    the client, so request-scoped code should share this instance.
+    """
+    return EmbeddingServiceWrapper()
+
+
 # ---------------- FAISS HNSW Index ---------------- #
 class FaissHNSWIndex:
     """
@@ -248,6 +259,12 @@ class FaissHNSWIndex:
 
 
 # ---------------- High-level Builders ---------------- #
+def _add_in_chunks(index: FaissHNSWIndex, vecs: np.ndarray, ids: List[int], chunk_size: int = 10000):
+    """Add vectors in chunks to avoid memory spikes"""
+    for i in range(0, len(vecs), chunk_size):
+        index.add(vecs[i:i + chunk_size], ids=ids[i:i + chunk_size])
+
+
 async def build_hnsw_from_texts(texts: List[str], embedder: EmbeddingServiceWrapper,
                                 metric: str = 'cosine', m: int = 32, ef_construction: int = 200,
                                 ef_search: int = 64, ids: Optional[List[int]] = None,
@@ -281,12 +298,8 @@ async def build_hnsw_from_texts(texts: List[str], embedder: EmbeddingServiceWrap
     index = FaissHNSWIndex(dim, metric=metric, m=m, ef_construction=ef_construction, ef_search=ef_search,
                            use_id_map=True)
 
-    # Add vectors in chunks to avoid memory spikes
-    chunk_size = 10000
-    for i in range(0, len(vecs), chunk_size):
-        chunk_vecs = vecs[i:i + chunk_size]
-        chunk_ids = all_ids[i:i + chunk_size]
-        index.add(chunk_vecs, ids=chunk_ids)
+    # Graph construction is CPU-bound; keep it off the event loop
+    await asyncio.to_thread(_add_in_chunks, index, vecs, all_ids)
 
     return index
 
@@ -299,8 +312,8 @@ async def semantic_search(index: FaissHNSWIndex, query_texts: List[str], embedde
     # Batch embed queries
     q_vecs = await embedder.embed_batch(query_texts)
 
-    # Batch search
-    scores, idx = index.search(q_vecs, k=top_k)
+    # Batch search (graph traversal runs in a worker thread)
+    scores, idx = await asyncio.to_thread(index.search, q_vecs, top_k)
 
     results: List[List[Dict[str, Any]]] = []
     for qi in range(scores.shape[0]):
@@ -0,0 +1,74 @@
+import os
+import asyncio
+import hashlib
+import logging
+from typing import Iterable, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# One .npy file per embedded text: <EMBEDDING_CACHE_DIR>/<hash[:2]>/<hash>.npy
+CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.join("cache", "emb"))
+
+
+def _cache_path(text: str) -> str:
+    # The model is part of the key so switching EMBEDDING_MODEL never mixes vector spaces
+    digest = hashlib.sha256(f"{os.getenv('EMBEDDING_MODEL', '')}:{text}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, digest[:2], f"{digest}.npy")
+
+
+def _load(path: str):
+    try:
+        return np.load(path)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+
+
+def _save(path: str, vector: np.ndarray) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, vector)
+    os.replace(tmp_path, path)
+
+
+def _load_many(paths: List[str]) -> list:
+    return [_load(p) for p in paths]
+
+
+def _save_many(items) -> None:
+    for path, vector in items:
+        try:
+            _save(path, vector)
+        except OSError as e:
+            logger.error("Error writing embedding cache: %s", e)
+
+
+async def embed_cached(texts: List[str], embedder) -> np.ndarray:
+    """
+    Embed texts through an on-disk cache that survives restarts.
+    Only texts without a cached vector are sent (in one batch) to the embedder.
+    The file reads and writes run in a worker thread, off the event loop.
+    """
+    if not texts:
+        return np.zeros((0, getattr(embedder, "dim_fallback", 0)), dtype=np.float32)
+
+    paths = [_cache_path(t) for t in texts]
+    vectors = await asyncio.to_thread(_load_many, paths)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        fresh = await embedder.embed_batch([texts[i] for i in missing])
+        # Random fallback vectors (no credentials) must not outlive the process
+        persist = getattr(embedder, "enabled", True)
+        for i, vec in zip(missing, fresh):
+            vectors[i] = np.asarray(vec, dtype=np.float32)
+        if persist:
+            await asyncio.to_thread(_save_many, [(paths[i], vectors[i]) for i in missing])
+    return np.vstack(vectors).astype(np.float32)
+
+
+async def warm_start(texts: Iterable[str], embedder) -> int:
+    """Pre-embed a closed vocabulary (e.g. features_dict values); returns how many texts were given"""
+    texts = list(dict.fromkeys(texts))
+    await embed_cached(texts, embedder)
+    return len(texts)
@@ -0,0 +1,105 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+import faiss
+
+from embedding.cached_embedder import get_cached_embedder
+from embedding.faiss_embedding import EmbeddingServiceWrapper
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    Cache of LLM results keyed by the meaning of the query rather than its bytes.
+
+    Every namespace (e.g. ``(method_name, model_name)``) owns its own
+    ``IndexFlatIP`` over L2-normalized query embeddings, so results of
+    different tasks never collide. Entries expire after ``ttl`` seconds and
+    the least recently used ones are evicted past ``maxsize``; whole
+    namespaces are evicted the same way past ``max_spaces``.
+    """
+
+    def __init__(self, threshold: float = 0.92, ttl: float = 300, maxsize: int = 1000,
+                 embedder: Optional[EmbeddingServiceWrapper] = None, max_spaces: int = 256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_spaces = max_spaces
+        self._embedder = embedder
+        self._spaces: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+
+    @property
+    def embedder(self) -> EmbeddingServiceWrapper:
+        if self._embedder is None:
+            # The LRU front means a query looked up in several namespaces is embedded once
+            self._embedder = get_cached_embedder()
+        return self._embedder
+
+    def _space(self, namespace: Hashable, dim: int) -> Dict[str, Any]:
+        space = self._spaces.get(namespace)
+        if space is None:
+            space = {
+                "index": faiss.IndexIDMap(faiss.IndexFlatIP(dim)),
+                "entries": OrderedDict(),
+                "next_id": 0,
+            }
+            self._spaces[namespace] = space
+            while len(self._spaces) > self.max_spaces:
+                self._spaces.popitem(last=False)
+        self._spaces.move_to_end(namespace)
+        return space
+
+    def _remove(self, space: Dict[str, Any], entry_id: int) -> None:
+        space["entries"].pop(entry_id, None)
+        space["index"].remove_ids(np.array([entry_id], dtype=np.int64))
+
+    async def embed(self, text: str) -> np.ndarray:
+        vec = (await self.embedder.embed_batch([text])).astype(np.float32)
+        faiss.normalize_L2(vec)
+        return vec
+
+    async def lookup(self, namespace: Hashable, text: str,
+                     threshold: Optional[float] = None) -> Tuple[Any, Optional[np.ndarray]]:
+        """
+        Return ``(cached_value, query_vec)``. ``cached_value`` is None on a miss;
+        pass ``query_vec`` back to ``store`` so the query is embedded only once.
+        """
+        try:
+            vec = await self.embed(text)
+        except Exception as e:
+            logger.error("Error embedding query for semantic cache: %s", e)
+            return None, None
+
+        space = self._spaces.get(namespace)
+        if space is None or space["index"].ntotal == 0:
+            return None, vec
+
+        scores, ids = space["index"].search(vec, 1)
+        entry_id, score = int(ids[0, 0]), float(scores[0, 0])
+        entry = space["entries"].get(entry_id)
+        if entry is None:
+            return None, vec
+        stored_at, value = entry
+        if time.time() - stored_at > self.ttl:
+            self._remove(space, entry_id)
+            return None, vec
+        if score < (self.threshold if threshold is None else threshold):
+            return None, vec
+        space["entries"].move_to_end(entry_id)
+        return value, vec
+
+    def store(self, namespace: Hashable, vec: Optional[np.ndarray], value: Any) -> None:
+        if vec is None:
+            return
+        space = self._space(namespace, vec.shape[1])
+        entry_id = space["next_id"]
+        space["next_id"] += 1
+        space["index"].add_with_ids(vec, np.array([entry_id], dtype=np.int64))
+        space["entries"][entry_id] = (time.time(), value)
+        while len(space["entries"]) > self.maxsize:
+            oldest_id = next(iter(space["entries"]))
+            self._remove(space, oldest_id)
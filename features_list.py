@@ -92,3 +92,49 @@ features_dict = {
     "max_height": "حداکثر ارتفاع",
     "sensor_type": "نوع سنسور"
 }
+
+
+# ---- Reverse lookups (Persian -> English), built once at import ----
+persian_to_eng_features = {}
+for _eng, _fa in features_dict.items():
+    persian_to_eng_features.setdefault(_fa, _eng)
+
+_feature_order = {fa: i for i, fa in enumerate(persian_to_eng_features)}
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# trigram -> Persian names containing it; names shorter than 3 chars have no
+# trigrams and are always checked.
+_feature_trigram_index = {}
+for _fa in persian_to_eng_features:
+    for _tri in _trigrams(_fa):
+        _feature_trigram_index.setdefault(_tri, set()).add(_fa)
+_short_feature_names = [fa for fa in persian_to_eng_features if len(fa) < 3]
+
+
+def find_feature_key(persian_name):
+    """
+    English features_dict key for a Persian feature name: an exact match first,
+    otherwise the first entry that contains or is contained in the name.
+    Substring candidates come from the trigram index instead of a full scan.
+    """
+    if persian_name is None:
+        return None
+    exact = persian_to_eng_features.get(persian_name)
+    if exact:
+        return exact
+
+    if len(persian_name) < 3:
+        candidates = persian_to_eng_features.keys()
+    else:
+        candidates = set(_short_feature_names)
+        for tri in _trigrams(persian_name):
+            candidates |= _feature_trigram_index.get(tri, set())
+
+    matches = [fa for fa in candidates if persian_name in fa or fa in persian_name]
+    if not matches:
+        return None
+    return persian_to_eng_features[min(matches, key=_feature_order.__getitem__)]
@@ -0,0 +1,34 @@
+"""
+Fast JSON helpers for the agents' hot paths.
+
+Uses orjson when it is installed (it always writes UTF-8, i.e. the
+equivalent of ensure_ascii=False) and falls back to the standard library.
+orjson.JSONDecodeError subclasses json.JSONDecodeError, so existing
+``except json.JSONDecodeError`` handlers keep working.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """Parse JSON from str or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
+    """Serialize to a compact (or 2-space indented) str without escaping non-ASCII"""
+    if orjson is not None:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=option).decode("utf-8")
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2, sort_keys=sort_keys)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys)
@@ -0,0 +1,34 @@
+"""
+Process-wide AsyncOpenAI clients.
+
+The router and the agents are instantiated per request; giving each instance
+its own AsyncOpenAI meant a fresh httpx pool, so every request paid new TCP +
+TLS handshakes. Clients built here are shared and keep their connections warm.
+"""
+
+import os
+from functools import lru_cache
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+# Pool sized for the router fanning out to several agents across concurrent users
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+# Per-request deadline (the SDK default is 10 minutes) and the SDK's own retries,
+# which back off with jitter and only fire on transient errors: timeouts,
+# connection errors, 408/409/429 and 5xx
+_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+
+@lru_cache(maxsize=None)
+def get_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> AsyncOpenAI:
+    """Shared AsyncOpenAI for (api_key, base_url); defaults to OPENAI_API_KEY / OPENAI_URL"""
+    return AsyncOpenAI(
+        api_key=api_key or os.getenv("OPENAI_API_KEY"),
+        base_url=base_url or os.getenv("OPENAI_URL"),
+        timeout=_TIMEOUT,
+        max_retries=_MAX_RETRIES,
+        http_client=httpx.AsyncClient(limits=_LIMITS),
+    )
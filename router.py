@@ -6,12 +6,13 @@ from agents.specific_product_agent import SpecificProductAgent
 from agents.feature_product_agents import FeatureProductAgent
 import os
 import json
+import re
 import sqlite3
-from openai import AsyncOpenAI
-from langchain.prompts import PromptTemplate
+from typing import AsyncIterator
 
 from db.base import DatabaseBaseLoader
 from response_format import Response
+from openai_client import get_client
 import dotenv
 from agents.image_agent import ImageAgent
 from agents.product_image_agent import ProductImageAgent
@@ -19,14 +20,37 @@ from system_prompts.router_scenario_type import router_scenario_system_prompt, r
 from system_prompts.route_image_task_system_prompt import route_image_task_system_prompt, route_image_task_samples
 dotenv.load_dotenv()
 
+# Instruction + few-shot part of the classifier prompts; it doesn't depend on
+# the query, so it is built once instead of on every routed request
+_SCENARIO_PROMPT_PREFIX = f"{router_scenario_system_prompt}\n\nExamples:\n" + "".join(
+    f"Input: {sample['input']}\nOutput: {{\"scenario_type\": \"{sample['scenario_type']}\"}}\n\n"
+    for sample in router_scenario_type_samples[:50]  # Use first 50 examples
+)
+_IMAGE_TASK_PROMPT_PREFIX = f"{route_image_task_system_prompt}\n\nExamples:\n" + "".join(
+    f"Input: {sample['input']}\nOutput: {sample['output']}\n\n"
+    for sample in route_image_task_samples[:10]  # Use first 10 examples
+)
+
+# Valid labels in priority order, plus one alternation per list so a free-text
+# reply is scanned once instead of once per label
+_SCENARIO_TYPES = ("general", "exploration", "specific_product", "feature_product", "shop", "comparison")
+_IMAGE_TASK_TYPES = ("find_main_object", "find_base_product_and_main_object")
+_SCENARIO_TYPE_PATTERN = re.compile("|".join(map(re.escape, sorted(_SCENARIO_TYPES, key=len, reverse=True))))
+_IMAGE_TASK_TYPE_PATTERN = re.compile("|".join(map(re.escape, sorted(_IMAGE_TASK_TYPES, key=len, reverse=True))))
+
+
+def _first_type_in(pattern, types, text, default):
+    """The highest-priority label mentioned anywhere in text, else default"""
+    found = set(pattern.findall(text.lower()))
+    return next((t for t in types if t in found), default)
+
+
 class Router:
     def __init__(self, db_path: str | None = None, embedding_similarity=None):
         self.db_path = db_path or os.getenv("PRODUCTS_DB_PATH") or "products.db"
         self._conn = None
-        self.client = AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            base_url=os.getenv("OPENAI_URL"),
-        )
+        # Shared across instances: keeps the HTTP connections to the API warm
+        self.client = get_client()
         from db.base import DatabaseBaseLoader
         self.db = DatabaseBaseLoader()
     
@@ -42,13 +66,8 @@ class Router:
         Returns one of: 'general', 'exploration', 'specific_product', 'feature_product', 'shop', 'comparison'
         """
         try:
-            # Prepare few-shot examples for the LLM
-            examples_text = ""
-            for sample in router_scenario_type_samples[:50]:  # Use first 10 examples
-                examples_text += f"Input: {sample['input']}\nOutput: {{\"scenario_type\": \"{sample['scenario_type']}\"}}\n\n"
-            
             # Create the prompt
-            prompt = f"{router_scenario_system_prompt}\n\nExamples:\n{examples_text}\n\nInput: {query}\nOutput:"
+            prompt = f"{_SCENARIO_PROMPT_PREFIX}\n\nInput: {query}\nOutput:"
             
             # Call OpenAI API
             response = await self.client.chat.completions.create(
@@ -58,7 +77,9 @@ class Router:
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.1,
-                max_tokens=50
+                max_tokens=50,
+                # Long static prefix (instructions + 50 examples) ahead of the query: keep it on one cache shard
+                extra_body={"prompt_cache_key": "router_scenario_v1"}
             )
             
             # Parse the response
@@ -70,19 +91,14 @@ class Router:
                 scenario_type = result.get("scenario_type", "general")
                 
                 # Validate scenario type
-                valid_types = ["general", "exploration", "specific_product", "feature_product", "shop", "comparison"]
-                if scenario_type not in valid_types:
+                if scenario_type not in _SCENARIO_TYPES:
                     return "general"
                 
                 return scenario_type
                 
             except json.JSONDecodeError:
                 # If JSON parsing fails, try to extract scenario type from text
-                for valid_type in ["general", "exploration", "specific_product", "feature_product", "shop", "comparison"]:
-                    if valid_type in response_text.lower():
-                        return valid_type
-                
-                return "general"
+                return _first_type_in(_SCENARIO_TYPE_PATTERN, _SCENARIO_TYPES, response_text, "general")
                 
         except Exception as e:
             print(f"Error in _scenario_task: {e}")
@@ -115,13 +131,8 @@ class Router:
         Returns one of: 'find_main_object', 'find_base_product_and_main_object'
         """
         try:
-            # Prepare few-shot examples for the LLM
-            examples_text = ""
-            for sample in route_image_task_samples[:10]:  # Use first 10 examples
-                examples_text += f"Input: {sample['input']}\nOutput: {sample['output']}\n\n"
-            
             # Create the prompt
-            prompt = f"{route_image_task_system_prompt}\n\nExamples:\n{examples_text}\n\nInput: {query}\nOutput:"
+            prompt = f"{_IMAGE_TASK_PROMPT_PREFIX}\n\nInput: {query}\nOutput:"
             
             # Call OpenAI API
             response = await self.client.chat.completions.create(
@@ -131,36 +142,26 @@ class Router:
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.1,
-                max_tokens=50
+                max_tokens=50,
+                extra_body={"prompt_cache_key": "router_image_task_v1"}
             )
             
             # Parse the response
             response_text = response.choices[0].message.content.strip()
             
             # Validate task type
-            valid_types = ["find_main_object", "find_base_product_and_main_object"]
-            if response_text in valid_types:
+            if response_text in _IMAGE_TASK_TYPES:
                 return response_text
             
             # If response doesn't match exactly, try to find a valid type in the response
-            for valid_type in valid_types:
-                if valid_type in response_text.lower():
-                    return valid_type
-            
-            # Default to find_main_object if no valid type found
-            return "find_main_object"
+            # (default to find_main_object if no valid type found)
+            return _first_type_in(_IMAGE_TASK_TYPE_PATTERN, _IMAGE_TASK_TYPES, response_text, "find_main_object")
                 
         except Exception as e:
             print(f"Error in _route_image_task: {e}")
             return "find_main_object"
 
     async def route(self, chat_id: str, query: str, image_query: str) -> Response:
-        # Create another PromptTemplate for FeatureProductAgent (if needed)
-        feature_prompt_template = PromptTemplate(
-            input_variables=["query"],
-            template="از متن زیر نام محصول و ویژگی‌های خواسته‌شده را استخراج کن و فقط خروجی را به صورت JSON زیر بده:\n{\"product_name\": ..., \"features\": [...]}\nمتن: {{ query }}",
-            template_format="jinja2"
-        )
         if image_query:
             image_task = await self._route_image_task(query)
             print("image_task:",  image_task)
@@ -174,34 +175,53 @@ class Router:
         else:
             does_have_any_open_exploration_chat_with_this_id = self._does_have_any_open_exploration_chat_with_this_id(chat_id)
             scenario_type = await self._scenario_task(query)
-            res = Response(message="", base_random_keys=[], member_random_keys=[])
             print(f"scenario_type: {scenario_type} \n for query: {query}")
-            if scenario_type == "exploration" or does_have_any_open_exploration_chat_with_this_id:
-                exploration_agent = ExplorationAgent(feature_prompt_template)
-                res = await exploration_agent.process_query(query, chat_id)
-            elif scenario_type == "general":
-                config = {
-                 "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
-                "OPENAI_URL": os.getenv("OPENAI_URL"),
-                 "MODEL": os.getenv("MODEL", "gpt-4o-mini")
-                }
-                general_agent = GeneralAgent(config)
-                res =  await general_agent.process_query(query)
-            elif scenario_type == "shop":
-                shopping_agent = ShoppingAgent()
-                return await shopping_agent.process_query(query)
-            elif scenario_type == "comparison":
-                comparison_agent = ComparisonAgent(feature_prompt_template)
-                res = await comparison_agent.process_query(query)
-            elif scenario_type == "specific_product":
-                specific_product_agent = SpecificProductAgent()
-                res =  await specific_product_agent.process_query(query)
-            elif scenario_type == "feature_product":
-                feature_product_agent = FeatureProductAgent(feature_prompt_template)
-                res = await feature_product_agent.process_query(query)
-            else:
-                res = Response(message="متأسفم، نتوانستم محصولات را برای مقایسه پیدا کنم.", base_random_keys=[], member_random_keys=[])
-            return res
+            return await self._route_text(chat_id, query, scenario_type, does_have_any_open_exploration_chat_with_this_id)
+
+    async def route_stream(self, chat_id: str, query: str, image_query: str) -> AsyncIterator[Response]:
+        """
+        Same routing as route, but a comparison yields partial Responses while its
+        final answer is written; other scenarios yield their single Response.
+        The last Response yielded is the final one.
+        """
+        if image_query:
+            yield await self.route(chat_id, query, image_query)
+            return
+        does_have_any_open_exploration_chat_with_this_id = self._does_have_any_open_exploration_chat_with_this_id(chat_id)
+        scenario_type = await self._scenario_task(query)
+        if scenario_type == "comparison" and not does_have_any_open_exploration_chat_with_this_id:
+            async for res in ComparisonAgent().process_query_stream(query):
+                yield res
+        else:
+            yield await self._route_text(chat_id, query, scenario_type, does_have_any_open_exploration_chat_with_this_id)
+
+    async def _route_text(self, chat_id: str, query: str, scenario_type: str, has_open_exploration: bool) -> Response:
+        if scenario_type == "exploration" or has_open_exploration:
+            exploration_agent = ExplorationAgent()
+            res = await exploration_agent.process_query(query, chat_id)
+        elif scenario_type == "general":
+            config = {
+             "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
+            "OPENAI_URL": os.getenv("OPENAI_URL"),
+             "MODEL": os.getenv("MODEL", "gpt-4o-mini")
+            }
+            general_agent = GeneralAgent(config)
+            res =  await general_agent.process_query(query)
+        elif scenario_type == "shop":
+            shopping_agent = ShoppingAgent()
+            return await shopping_agent.process_query(query)
+        elif scenario_type == "comparison":
+            comparison_agent = ComparisonAgent()
+            res = await comparison_agent.process_query(query)
+        elif scenario_type == "specific_product":
+            specific_product_agent = SpecificProductAgent()
+            res =  await specific_product_agent.process_query(query)
+        elif scenario_type == "feature_product":
+            feature_product_agent = FeatureProductAgent()
+            res = await feature_product_agent.process_query(query)
+        else:
+            res = Response(message="متأسفم، نتوانستم محصولات را برای مقایسه پیدا کنم.", base_random_keys=[], member_random_keys=[])
+        return res
 
 async def main():
     router = Router()
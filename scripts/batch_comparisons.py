@@ -0,0 +1,49 @@
+"""
+Batch Comparisons - Torob AI Assistant
+
+Answers a file of comparison queries offline through the OpenAI Batch API:
+routing and product lookups run right away, and the final decisions of all
+queries (feature, shop, warranty, city and general comparisons) go into one
+batch job, which is cheaper than online calls but can take up to 24 hours.
+
+Usage:
+    # One query per line in queries.txt; one JSON answer per line in answers.jsonl
+    python -m scripts.batch_comparisons queries.txt answers.jsonl
+
+    # Poll the batch job every 5 minutes instead of the default 30 seconds
+    COMPARISON_BATCH_POLL_SECONDS=300 python -m scripts.batch_comparisons queries.txt answers.jsonl
+"""
+
+import argparse
+import asyncio
+
+import json_utils
+from agents.comparison_agent import ComparisonAgent
+
+
+async def run(input_path: str, output_path: str) -> int:
+    """Answer every query in input_path and write them to output_path; returns the count"""
+    with open(input_path, encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    if not queries:
+        return 0
+
+    responses = await ComparisonAgent().process_queries_batch(queries)
+    with open(output_path, "w", encoding="utf-8") as f:
+        for query, response in zip(queries, responses):
+            f.write(json_utils.dumps({"query": query, **response.model_dump()}) + "\n")
+    return len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer comparison queries through the OpenAI Batch API")
+    parser.add_argument("input", help="Text file with one comparison query per line")
+    parser.add_argument("output", help="JSONL file to write the answers to")
+    args = parser.parse_args()
+
+    count = asyncio.run(run(args.input, args.output))
+    print(f"✅ Answered {count} comparison queries -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()